@@ -0,0 +1 @@
+Reuse persistent HTTPS connections, and resume TLS sessions, when pushing associations to replication peers.
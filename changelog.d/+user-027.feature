@@ -0,0 +1 @@
+Compress replication pushes to peers which advertise that they can decode compressed bodies.
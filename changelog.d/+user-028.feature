@@ -0,0 +1 @@
+Add tools to export and import snapshots of the associations, to bootstrap new replication peers.
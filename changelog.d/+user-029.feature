@@ -0,0 +1 @@
+Add an optional anti-entropy check which compares hash trees of the associations with each replication peer and repairs any divergence, enabled with `replication.antientropy_interval`.
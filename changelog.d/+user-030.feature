@@ -0,0 +1 @@
+Keep several batches of associations in flight to each replication peer, configurable with `replication.push_window`.
@@ -0,0 +1 @@
+Negotiate a binary framing for replication pushes with peers which support it.
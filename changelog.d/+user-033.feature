@@ -0,0 +1 @@
+Delete replicated deletions of local associations once every replication peer has received them, configurable with `replication.tombstone_compaction_interval`.
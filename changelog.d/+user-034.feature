@@ -0,0 +1 @@
+Delete superseded rows from the global associations table, configurable with `associations.history_compaction_interval`.
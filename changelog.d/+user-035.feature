@@ -0,0 +1 @@
+Delete expired associations from the database.
@@ -0,0 +1 @@
+Add replication lag and throughput metrics, and an internal endpoint reporting the replication status of each peer.
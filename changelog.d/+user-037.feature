@@ -0,0 +1 @@
+Queue bind notifications to homeservers in the database, so that they survive a restart and are retried with a backoff.
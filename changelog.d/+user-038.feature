@@ -0,0 +1 @@
+Share a single pool of connections between federation requests, configurable with the `federation.*` options.
@@ -0,0 +1 @@
+Cache homeserver signing keys in a bounded cache, and fetch each key only once when several requests need it at the same time.
@@ -0,0 +1 @@
+Coalesce concurrent SRV lookups for the same name, and cache the absence of SRV records.
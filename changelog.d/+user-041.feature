@@ -0,0 +1 @@
+Send emails without blocking other requests, over SMTP connections which are reused between emails.
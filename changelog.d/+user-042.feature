@@ -0,0 +1 @@
+Queue outgoing emails in the database and send them in rate-limited batches, configurable with the `email.queue.*` options.
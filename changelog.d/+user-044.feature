@@ -0,0 +1 @@
+Queue outgoing text messages in the database and send them with per-country rate limits, configurable in the `sms` section.
@@ -0,0 +1 @@
+Replace the manual garbage collection run every second with tuned thresholds, and freeze the objects created at startup, configurable with the `gc.*` options.
@@ -0,0 +1 @@
+Add a detector which logs what's blocking the reactor when it stalls, and an internal endpoint reporting the worst offenders.
@@ -0,0 +1 @@
+Export per-servlet HTTP metrics and per-method database metrics to Prometheus.
@@ -0,0 +1 @@
+Add an optional slow query log which records the query plan of slow SQL statements, and an internal endpoint reporting them.
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the performance of sydent.util.ttlcache.TTLCache with the implementation
+it replaced, which kept its entries in a SortedList by expiry time.
+
+Usage: python scripts-dev/ttlcache_benchmark.py [size ...]
+"""
+
+import argparse
+import random
+import time
+
+import attr
+from sortedcontainers import SortedList
+
+from sydent.util.ttlcache import TTLCache
+
+SENTINEL = object()
+
+
+class SortedListTTLCache(object):
+    """The previous TTLCache implementation, without a maximum size."""
+
+    def __init__(self, cache_name, timer=time.time):
+        self._data = {}
+        self._expiry_list = SortedList()
+        self._timer = timer
+
+    def set(self, key, value, ttl):
+        expiry = self._timer() + ttl
+
+        self.expire()
+        e = self._data.pop(key, SENTINEL)
+        if e != SENTINEL:
+            self._expiry_list.remove(e)
+
+        entry = _CacheEntry(expiry_time=expiry, key=key, value=value)
+        self._data[key] = entry
+        self._expiry_list.add(entry)
+
+    def get(self, key, default=SENTINEL):
+        self.expire()
+        e = self._data.get(key, SENTINEL)
+        if e == SENTINEL:
+            if default == SENTINEL:
+                raise KeyError(key)
+            return default
+        return e.value
+
+    def pop(self, key, default=SENTINEL):
+        self.expire()
+        e = self._data.pop(key, SENTINEL)
+        if e == SENTINEL:
+            if default == SENTINEL:
+                raise KeyError(key)
+            return default
+        self._expiry_list.remove(e)
+        return e.value
+
+    def __len__(self):
+        self.expire()
+        return len(self._data)
+
+    def expire(self):
+        now = self._timer()
+        while self._expiry_list:
+            first_entry = self._expiry_list[0]
+            if first_entry.expiry_time - now > 0.0:
+                break
+            del self._data[first_entry.key]
+            del self._expiry_list[0]
+
+
+@attr.s(frozen=True, slots=True)
+class _CacheEntry(object):
+    expiry_time = attr.ib()
+    key = attr.ib()
+    value = attr.ib()
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def run(cache_class, size, ttls, lookups):
+    """
+    Fills a cache with size entries, looks up random keys, replaces a tenth of the
+    entries and removes another tenth, then lets everything expire.
+
+    :return: The time taken (in seconds) by each phase.
+    :rtype: dict[str, float]
+    """
+    timer = FakeTimer()
+    cache = cache_class("bench", timer=timer)
+    results = {}
+
+    start = time.perf_counter()
+    for key in range(size):
+        # Keep time moving, so that each operation has to check for expired entries.
+        timer.now += 0.00001
+        cache.set(key, key, ttls[key])
+    results["set"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for key in lookups:
+        cache.get(key, None)
+    results["get"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for key in range(0, size, 10):
+        cache.set(key, key, ttls[key])
+    for key in range(5, size, 10):
+        cache.pop(key, None)
+    results["update"] = time.perf_counter() - start
+
+    timer.now += 3600
+    start = time.perf_counter()
+    assert len(cache) == 0
+    results["expire"] = time.perf_counter() - start
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "sizes",
+        nargs="*",
+        type=int,
+        default=[10000, 100000, 1000000],
+        help="Numbers of entries to benchmark with",
+    )
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print(
+        "%-10s %-12s %10s %10s %10s %10s"
+        % ("entries", "impl", "set", "get", "update", "expire")
+    )
+    for size in args.sizes:
+        ttls = [rng.uniform(60, 1800) for _ in range(size)]
+        lookups = [rng.randrange(size * 2) for _ in range(size)]
+
+        for name, cache_class in (
+            ("sortedlist", SortedListTTLCache),
+            ("bucketed", TTLCache),
+        ):
+            results = run(cache_class, size, ttls, lookups)
+            print(
+                "%-10d %-12s %9.3fs %9.3fs %9.3fs %9.3fs"
+                % (
+                    size,
+                    name,
+                    results["set"],
+                    results["get"],
+                    results["update"],
+                    results["expire"],
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
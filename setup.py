@@ -42,6 +42,7 @@ setup(
     description="Reference Matrix Identity Verification and Lookup Server",
     install_requires=[
         "signedjson==1.1.1",
+        "canonicaljson>=1.0.0",
         "unpaddedbase64==1.1.0",
         "Twisted>=16.0.0",
         # twisted warns about about the absence of this
@@ -53,6 +54,7 @@ setup(
         "sortedcontainers>=2.1.0",
         "six>=1.10",
         "pyyaml>=3.11",
+        "prometheus_client>=0.4.0",
         "mock>=3.0.5",
         "flake8==3.9.2",
         "black==21.5b1",
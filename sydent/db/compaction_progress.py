@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Actions on the compaction_progress table which is defined in the migration process in
+# sqlitedb.py
+
+
+class CompactionProgressStore:
+    def __init__(self, sydent):
+        self.sydent = sydent
+
+    def getLastId(self, name):
+        """
+        Retrieves how far a compaction task has got through its table.
+
+        :param name: The name of the compaction task.
+        :type name: str
+
+        :return: The last ID the task has processed, or -1 if it hasn't started.
+        :rtype: int
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT lastId FROM compaction_progress WHERE name = ?", (name,)
+        )
+        row = res.fetchone()
+
+        if not row:
+            return -1
+
+        return row[0]
+
+    def setLastId(self, name, lastId):
+        """
+        Records how far a compaction task has got through its table.
+
+        :param name: The name of the compaction task.
+        :type name: str
+        :param lastId: The last ID the task has processed.
+        :type lastId: int
+        """
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "INSERT OR REPLACE INTO compaction_progress (name, lastId) VALUES (?, ?)",
+            (name, lastId),
+        )
+        self.sydent.db.commit()
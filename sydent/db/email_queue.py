@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Actions on the email_queue table which is defined in the migration process in
+# sqlitedb.py
+
+
+class EmailQueueStore:
+    def __init__(self, sydent):
+        self.sydent = sydent
+
+    def addEmail(self, mailFrom, mailTo, domain, message, createdAt):
+        """
+        Queues an email to send.
+
+        :param mailFrom: The address to send the email from.
+        :type mailFrom: unicode
+        :param mailTo: The address to send the email to.
+        :type mailTo: unicode
+        :param domain: The domain of the address to send the email to.
+        :type domain: unicode
+        :param message: The email, with its headers.
+        :type message: bytes
+        :param createdAt: The time in milliseconds the email was queued at. It is due
+            to be sent straight away.
+        :type createdAt: int
+        """
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "INSERT INTO email_queue "
+            "(mailFrom, mailTo, domain, message, attempts, createdTs, nextAttemptTs) "
+            "VALUES (?, ?, ?, ?, 0, ?, ?)",
+            (mailFrom, mailTo, domain, message, createdAt, createdAt),
+        )
+        self.sydent.db.commit()
+
+    def getDueEmails(self, now, limit):
+        """
+        Retrieves the emails which are due to be sent, oldest first, without their
+        content.
+
+        :param now: The current time in milliseconds.
+        :type now: int
+        :param limit: The maximum number of emails to return.
+        :type limit: int
+
+        :return: The ID, recipient domain and number of previous attempts of each
+            email.
+        :rtype: list[tuple[int, unicode, int]]
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT id, domain, attempts FROM email_queue "
+            "WHERE nextAttemptTs <= ? ORDER BY nextAttemptTs, id LIMIT ?",
+            (now, limit),
+        )
+        return res.fetchall()
+
+    def getEmails(self, emailIds):
+        """
+        Retrieves the emails to send.
+
+        :param emailIds: The IDs of the emails.
+        :type emailIds: list[int]
+
+        :return: The sender, recipient and content of each email still in the queue,
+            by ID.
+        :rtype: dict[int, tuple[unicode, unicode, bytes]]
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT id, mailFrom, mailTo, message FROM email_queue WHERE id IN (%s)"
+            % ",".join("?" * len(emailIds)),
+            emailIds,
+        )
+        return {row[0]: (row[1], row[2], bytes(row[3])) for row in res.fetchall()}
+
+    def deleteEmail(self, emailId):
+        """
+        Removes an email from the queue, once it has been sent or given up on.
+
+        :param emailId: The ID of the email.
+        :type emailId: int
+        """
+        cur = self.sydent.db.cursor()
+        cur.execute("DELETE FROM email_queue WHERE id = ?", (emailId,))
+        self.sydent.db.commit()
+
+    def rescheduleEmail(self, emailId, attempts, nextAttemptTs):
+        """
+        Records a failed attempt to send an email.
+
+        :param emailId: The ID of the email.
+        :type emailId: int
+        :param attempts: The number of attempts made to send it so far.
+        :type attempts: int
+        :param nextAttemptTs: The time in milliseconds of the next attempt.
+        :type nextAttemptTs: int
+        """
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "UPDATE email_queue SET attempts = ?, nextAttemptTs = ? WHERE id = ?",
+            (attempts, nextAttemptTs, emailId),
+        )
+        self.sydent.db.commit()
+
+    def getQueueStats(self):
+        """
+        :return: The number of emails in the queue, and the time in milliseconds the
+            oldest one was queued at (None if the queue is empty).
+        :rtype: tuple[int, int or None]
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute("SELECT COUNT(*), MIN(createdTs) FROM email_queue")
+        row = res.fetchone()
+        return row[0], row[1]
@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import functools
+import logging
+import re
+import sqlite3
+import sys
+import time
+
+from prometheus_client import REGISTRY
+from prometheus_client.core import CounterMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# The number of rows to fetch at once when iterating over a cursor
+ITER_CHUNK_SIZE = 256
+
+
+class _CallerTotals(object):
+    """The database work done by a function, over all its cursors."""
+
+    __slots__ = ("statements", "seconds", "rows")
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.rows = 0
+
+
+# The totals of each caller. They're only updated from the thread running the
+# database's cursors (i.e. the reactor's) and read by whole values when collected,
+# so unlike prometheus_client's metrics they don't need a lock.
+_totals_by_caller = {}
+
+
+def _totals(caller):
+    totals = _totals_by_caller.get(caller)
+    if totals is None:
+        totals = _totals_by_caller[caller] = _CallerTotals()
+    return totals
+
+
+class DatabaseCollector(object):
+    """
+    Exports the number of statements executed, the time spent executing them and
+    fetching their results, and the number of rows fetched, by the function which
+    ran them.
+    """
+
+    def collect(self):
+        statements = CounterMetricFamily(
+            "sydent_db_statements",
+            "Number of SQL statements executed, by the function which ran them",
+            labels=["caller"],
+        )
+        seconds = CounterMetricFamily(
+            "sydent_db_time_seconds",
+            "Time spent executing SQL statements and fetching their results, by the "
+            "function which ran them",
+            labels=["caller"],
+        )
+        rows = CounterMetricFamily(
+            "sydent_db_rows",
+            "Number of rows fetched from the database, by the function which fetched "
+            "them",
+            labels=["caller"],
+        )
+
+        for caller, totals in list(_totals_by_caller.items()):
+            statements.add_metric([caller], totals.statements)
+            seconds.add_metric([caller], totals.seconds)
+            rows.add_metric([caller], totals.rows)
+
+        yield statements
+        yield seconds
+        yield rows
+
+
+REGISTRY.register(DatabaseCollector())
+
+
+# The caller of each function which created cursors, and its totals, by code object,
+# so that the frame of a function is only inspected the first time it creates one
+_callers_by_code = {}
+
+
+def _callerOf(frame):
+    """
+    :param frame: The frame of a function.
+    :type frame: types.FrameType
+
+    :return: The name of the function (see _caller), and its totals.
+    :rtype: tuple[str, _CallerTotals]
+    """
+    caller = _callers_by_code.get(frame.f_code)
+    if caller is None:
+        name = _caller(frame)
+        caller = _callers_by_code[frame.f_code] = (name, _totals(name))
+    return caller
+
+
+def _caller(frame):
+    """
+    :param frame: The frame of a function.
+    :type frame: types.FrameType
+
+    :return: The name of the function, prefixed with the name of the class of the
+        object it was called on if it's a method, e.g. "PeerStore.getAllPeers".
+    :rtype: str
+    """
+    name = frame.f_code.co_name
+    obj = frame.f_locals.get("self")
+    if obj is not None:
+        name = "%s.%s" % (type(obj).__name__, name)
+    return name
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    A connection to a SQLite database whose cursors measure the statements they
+    execute. The measures are attributed to the function which created the cursor,
+    e.g. "GlobalAssociationStore.getMxids", so that the cost of each store method
+    can be told apart without instrumenting each of them.
+    """
+
+    # The log to time each statement for, if the slow query log is enabled
+    slowQueryLog = None
+
+    def cursor(self, factory=None):
+        cur = super().cursor(factory or InstrumentedCursor)
+        if isinstance(cur, InstrumentedCursor):
+            cur._caller, cur._totals = _callerOf(sys._getframe(1))
+            cur._slowQueryLog = self.slowQueryLog
+        return cur
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """A cursor counting the statements it executes, the time spent executing them
+    and fetching their results, and the number of rows fetched.
+
+    Measures are accumulated on the cursor and added to its caller's totals once per
+    statement, i.e. when its results are exhausted or the cursor moves on to another
+    statement or is closed, to keep the cost of each row down. Iterating over the
+    cursor fetches rows by chunks of ITER_CHUNK_SIZE, which are timed as a whole.
+
+    If the slow query log is enabled, each statement is also reported to it then.
+    """
+
+    _caller = None
+    _totals = None
+    _slowQueryLog = None
+    # The statement being timed for the slow query log
+    _statement = None
+    # The measures of the current statement, not yet added to the caller's totals
+    _pendingStatements = 0
+    _pendingSeconds = 0.0
+    _pendingRows = 0
+
+    def execute(self, sql, parameters=()):
+        self._endStatement()
+        if self._slowQueryLog is not None:
+            self._statement = _Statement(
+                self._caller, sql, parameters, _countParameters(parameters)
+            )
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._pendingSeconds += time.perf_counter() - start
+            self._pendingStatements += 1
+
+    def executemany(self, sql, seq_of_parameters):
+        self._endStatement()
+        if self._slowQueryLog is not None:
+            # The parameters are counted, and the first ones kept to explain the
+            # query plan with, so an iterator has to be turned into a list first.
+            seq_of_parameters = list(seq_of_parameters)
+            # Nothing will be executed if there are no parameters.
+            if seq_of_parameters:
+                self._statement = _Statement(
+                    self._caller,
+                    sql,
+                    seq_of_parameters[0],
+                    sum(_countParameters(p) for p in seq_of_parameters),
+                )
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._pendingSeconds += time.perf_counter() - start
+            self._pendingStatements += 1
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._pendingSeconds += time.perf_counter() - start
+        if row is None:
+            self._endStatement()
+        else:
+            self._pendingRows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        start = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._pendingSeconds += time.perf_counter() - start
+        self._pendingRows += len(rows)
+        if len(rows) < size:
+            self._endStatement()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._pendingSeconds += time.perf_counter() - start
+        self._pendingRows += len(rows)
+        self._endStatement()
+        return rows
+
+    def __iter__(self):
+        return self._iterChunks()
+
+    def _iterChunks(self):
+        while True:
+            rows = self.fetchmany(ITER_CHUNK_SIZE)
+            yield from rows
+            if len(rows) < ITER_CHUNK_SIZE:
+                return
+
+    def __next__(self):
+        # Only reached when next() is called on the cursor itself rather than on an
+        # iterator over it, so the rows are counted but not timed one by one.
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._endStatement()
+            raise
+        self._pendingRows += 1
+        return row
+
+    def close(self):
+        self._endStatement()
+        super().close()
+
+    def __del__(self):
+        self._endStatement()
+
+    def _endStatement(self):
+        """Adds the measures of the current statement to the caller's totals, and
+        reports it to the slow query log if it's enabled.
+        """
+        totals = self._totals
+        if totals is None or not (self._pendingStatements or self._pendingRows):
+            return
+        duration = self._pendingSeconds
+        rows = self._pendingRows
+        totals.statements += self._pendingStatements
+        totals.seconds += duration
+        totals.rows += rows
+        self._pendingStatements = 0
+        self._pendingSeconds = 0.0
+        self._pendingRows = 0
+
+        statement = self._statement
+        if statement is None:
+            return
+        self._statement = None
+        statement.duration = duration
+        statement.rows = rows
+        try:
+            self._slowQueryLog.record(self.connection, statement)
+        except Exception:
+            logger.exception("Error recording statement in the slow query log")
+
+
+class _Statement(object):
+    """A statement being timed for the slow query log."""
+
+    __slots__ = ("caller", "sql", "parameters", "parameterCount", "duration", "rows")
+
+    def __init__(self, caller, sql, parameters, parameterCount):
+        self.caller = caller
+        self.sql = sql
+        # The parameters of the statement, or of its first execution for
+        # executemany, to explain its query plan with
+        self.parameters = parameters
+        self.parameterCount = parameterCount
+        # Filled in once the statement is over
+        self.duration = 0.0
+        self.rows = 0
+
+
+class SlowQueryLog(object):
+    """
+    Aggregates the timings of the statements executed through InstrumentedCursors by
+    statement shape, i.e. their SQL with literals and lists of placeholders
+    normalised, and logs the statements slower than a threshold along with their
+    query plan. The plan is asked of SQLite only once per shape, the first time one
+    is slow.
+
+    :param threshold: The duration (in seconds) above which a statement is logged.
+    :type threshold: float
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+        # The stats of each statement shape, by normalised SQL
+        self._stats = {}
+
+    def record(self, conn, statement):
+        """
+        :param conn: The connection the statement was executed on.
+        :type conn: sqlite3.Connection
+        :param statement: The statement, once its execution and the fetching of its
+            results is over.
+        :type statement: _Statement
+        """
+        normalised = normalise_sql(statement.sql)
+        stats = self._stats.get(normalised)
+        if stats is None:
+            if len(self._stats) >= MAX_STATEMENT_SHAPES:
+                # Make room by forgetting about the shape which took the least time.
+                del self._stats[
+                    min(self._stats, key=lambda s: self._stats[s]["total_seconds"])
+                ]
+            stats = self._stats[normalised] = {
+                "count": 0,
+                "slow_count": 0,
+                "total_seconds": 0.0,
+                "max_seconds": 0.0,
+                "rows": 0,
+                "query_plan": None,
+            }
+
+        stats["count"] += 1
+        stats["total_seconds"] += statement.duration
+        stats["max_seconds"] = max(stats["max_seconds"], statement.duration)
+        stats["rows"] += statement.rows
+        stats["caller"] = statement.caller
+
+        if statement.duration < self.threshold:
+            return
+        stats["slow_count"] += 1
+
+        if stats["query_plan"] is None:
+            stats["query_plan"] = _explain(conn, statement)
+
+        logger.warning(
+            "Slow query in %s (%.3fs, %d parameters, %d rows): %s\nQuery plan:\n%s",
+            statement.caller,
+            statement.duration,
+            statement.parameterCount,
+            statement.rows,
+            normalised,
+            stats["query_plan"],
+        )
+
+    def getStatementStats(self, limit):
+        """
+        :param limit: The maximum number of statement shapes to return.
+        :type limit: int
+
+        :return: The statement shapes which took the longest overall, longest first,
+            with their timings.
+        :rtype: list[dict[str, any]]
+        """
+        statements = [dict(stats, sql=sql) for sql, stats in self._stats.items()]
+        statements.sort(key=lambda s: s["total_seconds"], reverse=True)
+        return statements[:limit]
+
+
+# Maximum number of statement shapes to keep the stats of
+MAX_STATEMENT_SHAPES = 1000
+
+# The statements SQLite can explain the query plan of
+_EXPLAINABLE_RE = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b", re.I)
+
+# Matches string and number literals
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d+)?\b")
+# Matches the list of arguments of IN, or the rows of VALUES, once their literals
+# have been replaced with placeholders
+_PLACEHOLDERS = r"\(\s*\?(?:\s*,\s*\?)*\s*\)"
+_PLACEHOLDER_LIST_RE = re.compile(
+    r"\b(IN|VALUES)\s*%s(?:\s*,\s*%s)*" % (_PLACEHOLDERS, _PLACEHOLDERS), re.I
+)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=1000)
+def normalise_sql(sql):
+    """
+    :param sql: A SQL statement.
+    :type sql: unicode
+
+    :return: The statement with its literals replaced with placeholders, lists of
+        placeholders (e.g. the arguments of IN, or the rows of VALUES) collapsed, and
+        whitespace normalised, so that statements differing only by their arguments
+        are the same.
+    :rtype: unicode
+    """
+    sql = _LITERAL_RE.sub("?", sql)
+    sql = _PLACEHOLDER_LIST_RE.sub(r"\1 (...)", sql)
+    return _WHITESPACE_RE.sub(" ", sql).strip()
+
+
+def _explain(conn, statement):
+    """
+    :param conn: The connection the statement was executed on.
+    :type conn: sqlite3.Connection
+    :param statement: The statement to explain.
+    :type statement: _Statement
+
+    :return: SQLite's query plan for the statement, one step per line, indented by
+        depth in the plan, or a note saying why there's none.
+    :rtype: unicode
+    """
+    if not _EXPLAINABLE_RE.match(statement.sql):
+        return "(not a query)"
+
+    # Use a plain cursor, so that explaining isn't itself timed.
+    cur = conn.cursor(sqlite3.Cursor)
+    try:
+        cur.execute("EXPLAIN QUERY PLAN " + statement.sql, statement.parameters)
+        rows = cur.fetchall()
+    except sqlite3.Error as e:
+        return "(failed to explain: %s)" % (e,)
+    finally:
+        cur.close()
+
+    depths = {}
+    lines = []
+    for stepId, parentId, _, detail in rows:
+        depth = depths.get(parentId, -1) + 1
+        depths[stepId] = depth
+        lines.append("  " * depth + detail)
+    return "\n".join(lines)
+
+
+def _countParameters(parameters):
+    """
+    :param parameters: The parameters bound to a statement.
+    :type parameters: sequence or dict
+
+    :return: The number of parameters.
+    :rtype: int
+    """
+    try:
+        return len(parameters)
+    except TypeError:
+        return 0
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Actions on the onbind_notifications table which is defined in the migration process
+# in sqlitedb.py
+
+import json
+
+
+class OnBindNotificationStore:
+    def __init__(self, sydent):
+        self.sydent = sydent
+
+    def addNotification(self, destination, assoc, createdAt):
+        """
+        Queues a notification of a new association to a homeserver.
+
+        :param destination: The server name of the homeserver to notify.
+        :type destination: unicode
+        :param assoc: The signed association to send to the homeserver.
+        :type assoc: dict[str, any]
+        :param createdAt: The time in milliseconds the notification was queued at. It
+            is due to be sent straight away.
+        :type createdAt: int
+        """
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "INSERT INTO onbind_notifications "
+            "(destination, assoc, attempts, createdTs, nextAttemptTs) "
+            "VALUES (?, ?, 0, ?, ?)",
+            (destination, json.dumps(assoc), createdAt, createdAt),
+        )
+        self.sydent.db.commit()
+
+    def getDueNotifications(self, now, excludeDestinations, limit):
+        """
+        Retrieves the notifications which are due to be sent, oldest first.
+
+        :param now: The current time in milliseconds.
+        :type now: int
+        :param excludeDestinations: Destinations whose notifications shouldn't be
+            returned.
+        :type excludeDestinations: collections.Iterable[unicode]
+        :param limit: The maximum number of notifications to return.
+        :type limit: int
+
+        :return: The ID, destination, signed association and number of previous
+            attempts of each notification.
+        :rtype: list[tuple[int, unicode, dict[str, any], int]]
+        """
+        excludeDestinations = list(excludeDestinations)
+
+        sql = (
+            "SELECT id, destination, assoc, attempts FROM onbind_notifications "
+            "WHERE nextAttemptTs <= ?"
+        )
+        if excludeDestinations:
+            sql += " AND destination NOT IN (%s)" % (
+                ", ".join("?" for _ in excludeDestinations),
+            )
+        sql += " ORDER BY nextAttemptTs, id LIMIT ?"
+
+        cur = self.sydent.db.cursor()
+        res = cur.execute(sql, [now] + excludeDestinations + [limit])
+
+        return [(row[0], row[1], json.loads(row[2]), row[3]) for row in res.fetchall()]
+
+    def deleteNotification(self, notificationId):
+        """
+        Removes a notification from the queue, once it has been delivered.
+
+        :param notificationId: The ID of the notification.
+        :type notificationId: int
+        """
+        cur = self.sydent.db.cursor()
+        cur.execute("DELETE FROM onbind_notifications WHERE id = ?", (notificationId,))
+        self.sydent.db.commit()
+
+    def rescheduleNotification(self, notificationId, attempts, nextAttemptTs):
+        """
+        Records a failed attempt to deliver a notification.
+
+        :param notificationId: The ID of the notification.
+        :type notificationId: int
+        :param attempts: The number of attempts made to deliver it so far.
+        :type attempts: int
+        :param nextAttemptTs: The time in milliseconds of the next attempt.
+        :type nextAttemptTs: int
+        """
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "UPDATE onbind_notifications SET attempts = ?, nextAttemptTs = ? "
+            "WHERE id = ?",
+            (attempts, nextAttemptTs, notificationId),
+        )
+        self.sydent.db.commit()
+
+    def deferDestination(self, destination, nextAttemptTs):
+        """
+        Holds back every notification to a destination until at least a given time,
+        e.g. because that destination is unreachable.
+
+        :param destination: The server name of the homeserver.
+        :type destination: unicode
+        :param nextAttemptTs: The time in milliseconds before which no notification
+            should be sent to it.
+        :type nextAttemptTs: int
+        """
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "UPDATE onbind_notifications SET nextAttemptTs = ? "
+            "WHERE destination = ? AND nextAttemptTs < ?",
+            (nextAttemptTs, destination, nextAttemptTs),
+        )
+        self.sydent.db.commit()
+
+    def getQueueStats(self):
+        """
+        :return: The number of notifications in the queue, and the time in
+            milliseconds the oldest one was queued at (None if the queue is empty).
+        :rtype: tuple[int, int or None]
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute("SELECT COUNT(*), MIN(createdTs) FROM onbind_notifications")
+        row = res.fetchone()
+        return row[0], row[1]
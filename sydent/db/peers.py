@@ -94,6 +94,21 @@ class PeerStore:
 
         return peers
 
+    def getPeerStatuses(self):
+        """
+        Retrieves the replication progress of every peer, active or not.
+
+        :return: The name, last sent version, last successful push timestamp (in
+            milliseconds) and whether it's active for each peer.
+        :rtype: list[tuple[unicode, int or None, int or None, bool]]
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "select name, lastSentVersion, lastPokeSucceededAt, active from peers "
+            "order by name"
+        )
+        return [(row[0], row[1], row[2], bool(row[3])) for row in res.fetchall()]
+
     def setLastSentVersionAndPokeSucceeded(
         self, peerName, lastSentVersion, lastPokeSucceeded
     ):
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Actions on the server_keys table which is defined in the migration process in
+# sqlitedb.py
+
+import json
+
+
+class ServerKeyStore:
+    def __init__(self, sydent):
+        self.sydent = sydent
+
+    def getServerKeys(self, serverName, now):
+        """
+        Retrieves the keys last fetched from a homeserver, if they're still valid.
+
+        :param serverName: The server name of the homeserver.
+        :type serverName: unicode
+        :param now: The current time in milliseconds.
+        :type now: int
+
+        :return: The time in milliseconds until which the keys are valid, and the
+            keys as returned by the homeserver, or None if there are no valid keys
+            for it.
+        :rtype: tuple[int, dict[unicode, dict[unicode, unicode]]] or None
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT valid_until_ts, verify_keys FROM server_keys "
+            "WHERE server_name = ? AND valid_until_ts > ?",
+            (serverName, now),
+        )
+        row = res.fetchone()
+
+        if not row:
+            return None
+
+        return row[0], json.loads(row[1])
+
+    def storeServerKeys(self, serverName, validUntilTs, verifyKeys, now):
+        """
+        Saves the keys fetched from a homeserver, and deletes the ones which have
+        expired.
+
+        :param serverName: The server name of the homeserver.
+        :type serverName: unicode
+        :param validUntilTs: The time in milliseconds until which the keys are valid.
+        :type validUntilTs: int
+        :param verifyKeys: The keys as returned by the homeserver.
+        :type verifyKeys: dict[unicode, dict[unicode, unicode]]
+        :param now: The current time in milliseconds.
+        :type now: int
+        """
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "INSERT OR REPLACE INTO server_keys "
+            "(server_name, valid_until_ts, verify_keys) VALUES (?, ?, ?)",
+            (serverName, validUntilTs, json.dumps(verifyKeys)),
+        )
+        cur.execute("DELETE FROM server_keys WHERE valid_until_ts <= ?", (now,))
+        self.sydent.db.commit()
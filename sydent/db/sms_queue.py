@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+# Actions on the sms_queue table which is defined in the migration process in
+# sqlitedb.py
+
+
+class SmsQueueStore:
+    def __init__(self, sydent):
+        self.sydent = sydent
+
+    def addMessage(self, destination, country, body, originator, createdAt):
+        """
+        Queues a text message to send.
+
+        :param destination: The MSISDN to send the message to.
+        :type destination: unicode
+        :param country: The country calling code of the MSISDN.
+        :type country: unicode
+        :param body: The content of the message.
+        :type body: unicode
+        :param originator: The originator to send the message from, if any (a dict
+            with a "type" key and a "text" key).
+        :type originator: dict[str, str] or None
+        :param createdAt: The time in milliseconds the message was queued at. It is
+            due to be sent straight away.
+        :type createdAt: int
+        """
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "INSERT INTO sms_queue "
+            "(destination, country, body, originator, attempts, createdTs, "
+            "nextAttemptTs) VALUES (?, ?, ?, ?, 0, ?, ?)",
+            (
+                destination,
+                country,
+                body,
+                json.dumps(originator) if originator is not None else None,
+                createdAt,
+                createdAt,
+            ),
+        )
+        self.sydent.db.commit()
+
+    def getDueMessages(self, now, limit):
+        """
+        Retrieves the text messages which are due to be sent, oldest first.
+
+        :param now: The current time in milliseconds.
+        :type now: int
+        :param limit: The maximum number of messages to return.
+        :type limit: int
+
+        :return: The ID, destination, country calling code, content, originator and
+            number of previous attempts of each message.
+        :rtype: list[tuple[int, unicode, unicode, unicode, dict[str, str] or None, int]]
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT id, destination, country, body, originator, attempts "
+            "FROM sms_queue WHERE nextAttemptTs <= ? ORDER BY nextAttemptTs, id "
+            "LIMIT ?",
+            (now, limit),
+        )
+        return [
+            (
+                row[0],
+                row[1],
+                row[2],
+                row[3],
+                json.loads(row[4]) if row[4] is not None else None,
+                row[5],
+            )
+            for row in res.fetchall()
+        ]
+
+    def deleteMessage(self, messageId):
+        """
+        Removes a text message from the queue, once it has been sent or given up on.
+
+        :param messageId: The ID of the message.
+        :type messageId: int
+        """
+        cur = self.sydent.db.cursor()
+        cur.execute("DELETE FROM sms_queue WHERE id = ?", (messageId,))
+        self.sydent.db.commit()
+
+    def rescheduleMessage(self, messageId, attempts, nextAttemptTs):
+        """
+        Records a failed attempt to send a text message.
+
+        :param messageId: The ID of the message.
+        :type messageId: int
+        :param attempts: The number of attempts made to send it so far.
+        :type attempts: int
+        :param nextAttemptTs: The time in milliseconds of the next attempt.
+        :type nextAttemptTs: int
+        """
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "UPDATE sms_queue SET attempts = ?, nextAttemptTs = ? WHERE id = ?",
+            (attempts, nextAttemptTs, messageId),
+        )
+        self.sydent.db.commit()
+
+    def getQueueStats(self):
+        """
+        :return: The number of text messages in the queue, and the time in
+            milliseconds the oldest one was queued at (None if the queue is empty).
+        :rtype: tuple[int, int or None]
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute("SELECT COUNT(*), MIN(createdTs) FROM sms_queue")
+        row = res.fetchone()
+        return row[0], row[1]
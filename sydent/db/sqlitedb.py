@@ -19,6 +19,9 @@ import sqlite3
 import logging
 import os
 
+from sydent.db.instrumentation import InstrumentedConnection, SlowQueryLog
+from sydent.replication.hashtree import association_digest, bucket_for_origin_id
+
 logger = logging.getLogger(__name__)
 
 
@@ -29,7 +32,11 @@ class SqliteDatabase:
         dbFilePath = self.sydent.cfg.get("db", "db.file")
         logger.info("Using DB file %s", dbFilePath)
 
-        self.db = sqlite3.connect(dbFilePath)
+        self.db = sqlite3.connect(dbFilePath, factory=InstrumentedConnection)
+        if self.sydent.cfg.getboolean("db", "slow_query_log.enabled"):
+            self.db.slowQueryLog = SlowQueryLog(
+                self.sydent.cfg.getfloat("db", "slow_query_log.threshold")
+            )
         curVer = self._getSchemaVersion()
 
         # We always run the schema files if the version is zero: either the db is
@@ -210,6 +217,167 @@ class SqliteDatabase:
             logger.info("v4 -> v5 schema migration complete")
             self._setSchemaVersion(5)
 
+        if curVer < 6:
+            # Add the leaves of the hash tree over global_threepid_associations, see
+            # sydent/replication/hashtree.py
+            cur = self.db.cursor()
+            cur.execute(
+                "CREATE TABLE global_threepid_hash_buckets ("
+                "originServer varchar(255) not null, "
+                "bucket integer not null, "
+                "hash integer not null, "
+                "count integer not null)"
+            )
+            cur.execute(
+                "CREATE UNIQUE INDEX global_threepid_hash_buckets_originServer_bucket "
+                "ON global_threepid_hash_buckets (originServer, bucket)"
+            )
+
+            buckets = {}
+            res = cur.execute(
+                "SELECT originServer, originId, medium, address, mxid, ts "
+                "FROM global_threepid_associations"
+            )
+            for row in res:
+                key = (row[0], bucket_for_origin_id(row[1]))
+                digest, count = buckets.get(key, (0, 0))
+                buckets[key] = (
+                    digest ^ association_digest(*row[1:]),
+                    count + 1,
+                )
+            cur.executemany(
+                "INSERT INTO global_threepid_hash_buckets "
+                "(originServer, bucket, hash, count) VALUES (?, ?, ?, ?)",
+                [k + v for k, v in buckets.items()],
+            )
+            self.db.commit()
+            logger.info("v5 -> v6 schema migration complete")
+            self._setSchemaVersion(6)
+
+        if curVer < 7:
+            # Index the tombstones left by deleted bindings so they can be found
+            # and compacted without scanning the whole table
+            cur = self.db.cursor()
+            cur.execute(
+                "CREATE INDEX local_threepid_associations_tombstones "
+                "ON local_threepid_associations (id) WHERE mxid IS NULL"
+            )
+            self.db.commit()
+            logger.info("v6 -> v7 schema migration complete")
+            self._setSchemaVersion(7)
+
+        if curVer < 8:
+            # Keep track of how far background compaction tasks have got, so they
+            # can carry on from there after a restart
+            cur = self.db.cursor()
+            cur.execute(
+                "CREATE TABLE compaction_progress ("
+                "name varchar(64) primary key, "
+                "lastId integer not null)"
+            )
+            self.db.commit()
+            logger.info("v7 -> v8 schema migration complete")
+            self._setSchemaVersion(8)
+
+        if curVer < 9:
+            # Allow finding the associations that have expired without scanning the
+            # whole tables
+            cur = self.db.cursor()
+            cur.execute(
+                "CREATE INDEX local_threepid_associations_notAfter "
+                "ON local_threepid_associations (notAfter)"
+            )
+            cur.execute(
+                "CREATE INDEX global_threepid_associations_notAfter "
+                "ON global_threepid_associations (notAfter)"
+            )
+            self.db.commit()
+            logger.info("v8 -> v9 schema migration complete")
+            self._setSchemaVersion(9)
+
+        if curVer < 10:
+            # Queue the bind notifications to homeservers, so that the ones that
+            # couldn't be delivered yet are retried after a restart
+            cur = self.db.cursor()
+            cur.execute(
+                "CREATE TABLE onbind_notifications ("
+                "id integer primary key autoincrement, "
+                "destination varchar(255) not null, "
+                "assoc text not null, "
+                "attempts integer not null default 0, "
+                "createdTs bigint not null, "
+                "nextAttemptTs bigint not null)"
+            )
+            cur.execute(
+                "CREATE INDEX onbind_notifications_nextAttemptTs "
+                "ON onbind_notifications (nextAttemptTs)"
+            )
+            cur.execute(
+                "CREATE INDEX onbind_notifications_destination "
+                "ON onbind_notifications (destination)"
+            )
+            self.db.commit()
+            logger.info("v9 -> v10 schema migration complete")
+            self._setSchemaVersion(10)
+
+        if curVer < 11:
+            # Keep the keys fetched from homeservers, so they don't all need to be
+            # fetched again after a restart
+            cur = self.db.cursor()
+            cur.execute(
+                "CREATE TABLE server_keys ("
+                "server_name varchar(255) primary key, "
+                "valid_until_ts bigint not null, "
+                "verify_keys text not null)"
+            )
+            self.db.commit()
+            logger.info("v10 -> v11 schema migration complete")
+            self._setSchemaVersion(11)
+
+        if curVer < 12:
+            # Queue outgoing emails, so that they can be sent at a controlled rate,
+            # and retried after a restart
+            cur = self.db.cursor()
+            cur.execute(
+                "CREATE TABLE email_queue ("
+                "id integer primary key autoincrement, "
+                "mailFrom text not null, "
+                "mailTo text not null, "
+                "domain varchar(255) not null, "
+                "message blob not null, "
+                "attempts integer not null default 0, "
+                "createdTs bigint not null, "
+                "nextAttemptTs bigint not null)"
+            )
+            cur.execute(
+                "CREATE INDEX email_queue_nextAttemptTs ON email_queue (nextAttemptTs)"
+            )
+            self.db.commit()
+            logger.info("v11 -> v12 schema migration complete")
+            self._setSchemaVersion(12)
+
+        if curVer < 13:
+            # Queue outgoing text messages, so that they can be sent at a controlled
+            # rate, and retried after a restart
+            cur = self.db.cursor()
+            cur.execute(
+                "CREATE TABLE sms_queue ("
+                "id integer primary key autoincrement, "
+                "destination varchar(32) not null, "
+                "country varchar(8) not null, "
+                "body text not null, "
+                "originator text, "
+                "attempts integer not null default 0, "
+                "createdTs bigint not null, "
+                "nextAttemptTs bigint not null)"
+            )
+            cur.execute(
+                "CREATE INDEX sms_queue_nextAttemptTs ON sms_queue (nextAttemptTs)"
+            )
+            self.db.commit()
+            logger.info("v12 -> v13 schema migration complete")
+            self._setSchemaVersion(13)
+
     def _getSchemaVersion(self):
         cur = self.db.cursor()
         res = cur.execute("PRAGMA user_version")
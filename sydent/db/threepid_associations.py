@@ -17,6 +17,7 @@ from __future__ import absolute_import
 
 from sydent.util import time_msec
 
+from sydent.replication.hashtree import association_digest, bucket_for_origin_id
 from sydent.threepid import ThreepidAssociation
 from sydent.threepid.signer import Signer
 
@@ -176,6 +177,83 @@ class LocalAssociationStore:
             # we still consider this successful in the name of idempotency:
             # the binding to be deleted is not there, so we're in the desired state.
 
+    def countTombstones(self):
+        """
+        :return: The number of local associations which record the deletion of a
+            binding, so that it can be replicated to our peers.
+        :rtype: int
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT COUNT(*) FROM local_threepid_associations WHERE mxid IS NULL"
+        )
+        return res.fetchone()[0]
+
+    def deleteTombstonesUpToId(self, maxId, limit):
+        """
+        Deletes a batch of the local associations which record the deletion of a
+        binding, up to the given ID.
+
+        :param maxId: The highest ID to delete (inclusive).
+        :type maxId: int
+        :param limit: The maximum number of associations to delete.
+        :type limit: int
+
+        :return: The number of associations deleted, and the approximate number of
+            bytes of data they held (the size of their 3PID plus 8 bytes for each of
+            their timestamps).
+        :rtype: tuple[int, int]
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT id, length(medium) + length(address) + 24 "
+            "FROM local_threepid_associations "
+            "WHERE mxid IS NULL AND id <= ? ORDER BY id LIMIT ?",
+            (maxId, limit),
+        )
+        rows = res.fetchall()
+
+        cur.executemany(
+            "DELETE FROM local_threepid_associations WHERE id = ? AND mxid IS NULL",
+            [(row[0],) for row in rows],
+        )
+        self.sydent.db.commit()
+
+        return len(rows), sum(row[1] for row in rows)
+
+    def deleteExpiredAssociations(self, limit):
+        """
+        Deletes a batch of the local associations which have ceased to be valid.
+
+        :param limit: The maximum number of associations to delete.
+        :type limit: int
+
+        :return: The number of associations deleted.
+        :rtype: int
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT id FROM local_threepid_associations "
+            "WHERE notAfter < ? ORDER BY notAfter LIMIT ?",
+            (time_msec(), limit),
+        )
+        rows = res.fetchall()
+
+        cur.executemany("DELETE FROM local_threepid_associations WHERE id = ?", rows)
+        self.sydent.db.commit()
+
+        return len(rows)
+
+    def getMaxId(self):
+        """
+        :return: The highest ID in the local associations table, or None if it's
+            empty.
+        :rtype: int or None
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute("SELECT max(id) FROM local_threepid_associations")
+        return res.fetchone()[0]
+
 
 class GlobalAssociationStore:
     def __init__(self, sydent):
@@ -332,6 +410,21 @@ class GlobalAssociationStore:
                 rawSgAssoc,
             ),
         )
+        if cur.rowcount > 0:
+            self._updateHashBuckets(
+                cur,
+                [
+                    (
+                        originServer,
+                        originId,
+                        assoc.medium,
+                        assoc.address,
+                        assoc.mxid,
+                        assoc.ts,
+                    )
+                ],
+                1,
+            )
         if commit:
             self.sydent.db.commit()
 
@@ -359,7 +452,7 @@ class GlobalAssociationStore:
 
         return row[0]
 
-    def removeAssociation(self, medium, address):
+    def removeAssociation(self, medium, address, commit=True):
         """
         Removes any association stored for the provided 3PID.
 
@@ -367,20 +460,31 @@ class GlobalAssociationStore:
         :type medium: unicode
         :param address: The address for the 3PID.
         :type address: unicode
+        :param commit: Whether to commit the database transaction after removing the
+            association.
+        :type commit: bool
         """
         cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT originServer, originId, medium, address, mxid, ts "
+            "FROM global_threepid_associations WHERE medium = ? AND address = ?",
+            (medium, address),
+        )
+        rows = res.fetchall()
         cur.execute(
             "DELETE FROM global_threepid_associations WHERE "
             "medium = ? AND address = ?",
             (medium, address),
         )
+        self._updateHashBuckets(cur, rows, -1)
         logger.info(
             "Deleted %d rows from global associations for %s/%s",
             cur.rowcount,
             medium,
             address,
         )
-        self.sydent.db.commit()
+        if commit:
+            self.sydent.db.commit()
 
     def retrieveMxidsForHashes(self, addresses):
         """Returns a mapping from hash: mxid from a list of given lookup_hash values
@@ -437,3 +541,205 @@ class GlobalAssociationStore:
             cur.execute("DROP TABLE tmp_retrieve_mxids_for_hashes")
 
         return results
+
+    def _updateHashBuckets(self, cur, rows, delta):
+        """
+        Adds associations to, or removes them from, the buckets of the hash tree (see
+        sydent.replication.hashtree). Must be called in the same transaction as the
+        change to the associations themselves.
+
+        :param cur: The cursor of the transaction adding or removing the associations.
+        :type cur: sqlite3.Cursor
+        :param rows: (originServer, originId, medium, address, mxid, ts) tuples for
+            the added or removed associations.
+        :type rows: list[tuple]
+        :param delta: 1 if the associations were added, -1 if they were removed.
+        :type delta: int
+        """
+        for originServer, originId, medium, address, mxid, ts in rows:
+            digest = association_digest(originId, medium, address, mxid, ts)
+            bucket = bucket_for_origin_id(originId)
+
+            cur.execute(
+                "INSERT OR IGNORE INTO global_threepid_hash_buckets "
+                "(originServer, bucket, hash, count) VALUES (?, ?, 0, 0)",
+                (originServer, bucket),
+            )
+            # SQLite has no XOR operator, but (a | b) - (a & b) is equivalent.
+            cur.execute(
+                "UPDATE global_threepid_hash_buckets "
+                "SET hash = (hash | ?) - (hash & ?), count = count + ? "
+                "WHERE originServer = ? AND bucket = ?",
+                (digest, digest, delta, originServer, bucket),
+            )
+
+    def getHashBuckets(self, originServer, firstBucket, lastBucket):
+        """
+        Retrieves the non-empty buckets of an origin server's hash tree within a given
+        range.
+
+        :param originServer: The server the associations were created on.
+        :type originServer: unicode
+        :param firstBucket: The first bucket to retrieve.
+        :type firstBucket: int
+        :param lastBucket: The last bucket (inclusive) to retrieve.
+        :type lastBucket: int
+
+        :return: The digest and count of each bucket, keyed by bucket.
+        :rtype: dict[int, tuple[int, int]]
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT bucket, hash, count FROM global_threepid_hash_buckets "
+            "WHERE originServer = ? AND bucket >= ? AND bucket <= ? AND count > 0",
+            (originServer, firstBucket, lastBucket),
+        )
+        return {row[0]: (row[1], row[2]) for row in res.fetchall()}
+
+    def getSignedAssociationsInOriginIdRange(self, originServer, firstId, lastId):
+        """
+        Retrieves the signed associations created on a given server within a range of
+        origin IDs.
+
+        :param originServer: The server the associations were created on.
+        :type originServer: unicode
+        :param firstId: The first origin ID to retrieve.
+        :type firstId: int
+        :param lastId: The last origin ID (inclusive) to retrieve.
+        :type lastId: int
+
+        :return: The raw signed associations, keyed by origin ID.
+        :rtype: dict[int, unicode]
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT originId, sgAssoc FROM global_threepid_associations "
+            "WHERE originServer = ? AND originId >= ? AND originId <= ?",
+            (originServer, firstId, lastId),
+        )
+        return {row[0]: row[1] for row in res.fetchall()}
+
+    def removeAssociationsFromServer(self, originServer, originIds, commit=True):
+        """
+        Removes the associations with the given origin IDs created on a given server.
+
+        :param originServer: The server the associations were created on.
+        :type originServer: unicode
+        :param originIds: The origin IDs of the associations to remove.
+        :type originIds: list[int]
+        :param commit: Whether to commit the database transaction after removing the
+            associations.
+        :type commit: bool
+        """
+        cur = self.sydent.db.cursor()
+        for originId in originIds:
+            res = cur.execute(
+                "SELECT originServer, originId, medium, address, mxid, ts "
+                "FROM global_threepid_associations "
+                "WHERE originServer = ? AND originId = ?",
+                (originServer, originId),
+            )
+            rows = res.fetchall()
+            cur.execute(
+                "DELETE FROM global_threepid_associations "
+                "WHERE originServer = ? AND originId = ?",
+                (originServer, originId),
+            )
+            self._updateHashBuckets(cur, rows, -1)
+        if commit:
+            self.sydent.db.commit()
+
+    def removeSupersededAssociations(self, afterId, limit):
+        """
+        Removes the associations in a batch of the table which can never be returned
+        by a lookup again: those for which an association for the same 3PID from the
+        same server is newer, already valid, and stays valid for at least as long.
+
+        The latest association from each server is always kept, as lastIdFromServer
+        relies on it. Only associations from the same server are compared so that
+        every server holding a copy of them removes the same ones, and their hash
+        trees still match.
+
+        :param afterId: The ID after which the batch starts.
+        :type afterId: int
+        :param limit: The number of rows in the batch.
+        :type limit: int
+
+        :return: The highest ID in the batch (or None if there were no rows after
+            afterId), and the number of associations removed.
+        :rtype: tuple[int or None, int]
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT max(id) FROM ("
+            "SELECT id FROM global_threepid_associations "
+            "WHERE id > ? ORDER BY id LIMIT ?)",
+            (afterId, limit),
+        )
+        lastId = res.fetchone()[0]
+        if lastId is None:
+            return None, 0
+
+        res = cur.execute(
+            "SELECT r.originServer, r.originId FROM global_threepid_associations r "
+            "WHERE r.id > ? AND r.id <= ? "
+            "AND r.originId < ("
+            "  SELECT max(originId) FROM global_threepid_associations "
+            "  WHERE originServer = r.originServer"
+            ") AND EXISTS ("
+            "  SELECT 1 FROM global_threepid_associations s "
+            "  WHERE s.medium = r.medium AND lower(s.address) = lower(r.address) "
+            "  AND s.originServer = r.originServer "
+            "  AND (s.ts > r.ts OR (s.ts = r.ts AND s.id > r.id)) "
+            "  AND s.notBefore < ? AND s.notAfter >= r.notAfter"
+            ")",
+            (afterId, lastId, time_msec()),
+        )
+
+        byServer = {}
+        for originServer, originId in res.fetchall():
+            byServer.setdefault(originServer, []).append(originId)
+
+        count = 0
+        for originServer, originIds in byServer.items():
+            self.removeAssociationsFromServer(originServer, originIds, commit=False)
+            count += len(originIds)
+        self.sydent.db.commit()
+
+        return lastId, count
+
+    def deleteExpiredAssociations(self, limit):
+        """
+        Deletes a batch of the global associations which have ceased to be valid.
+
+        The latest association from each server is never deleted, as
+        lastIdFromServer relies on it.
+
+        :param limit: The maximum number of associations to delete.
+        :type limit: int
+
+        :return: The number of associations deleted.
+        :rtype: int
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT r.originServer, r.originId FROM global_threepid_associations r "
+            "WHERE r.notAfter < ? "
+            "AND r.originId < ("
+            "  SELECT max(originId) FROM global_threepid_associations "
+            "  WHERE originServer = r.originServer"
+            ") ORDER BY r.notAfter LIMIT ?",
+            (time_msec(), limit),
+        )
+
+        byServer = {}
+        count = 0
+        for originServer, originId in res.fetchall():
+            byServer.setdefault(originServer, []).append(originId)
+            count += 1
+
+        for originServer, originIds in byServer.items():
+            self.removeAssociationsFromServer(originServer, originIds, commit=False)
+        self.sydent.db.commit()
+
+        return count
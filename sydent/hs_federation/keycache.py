@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import logging
+
+from prometheus_client import Counter
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from unpaddedbase64 import decode_base64
+import signedjson.key
+from signedjson.sign import SignatureVerifyException
+
+from sydent.db.server_keys import ServerKeyStore
+from sydent.util.ttlcache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# How long (in seconds) to wait before fetching the keys of a homeserver again after
+# the first failure. It doubles with each consecutive failure, up to the maximum.
+MIN_FAILURE_BACKOFF = 10
+MAX_FAILURE_BACKOFF = 30 * 60
+
+server_key_fetches = Counter(
+    "sydent_server_key_fetches_total",
+    "Number of times the keys of a homeserver were fetched from it",
+)
+server_key_fetch_failures = Counter(
+    "sydent_server_key_fetch_failures_total",
+    "Number of failed attempts to fetch the keys of a homeserver",
+)
+
+
+class _FetchFailure(object):
+    """A cached failure to fetch the keys of a homeserver."""
+
+    def __init__(self, failure):
+        self.failure = failure
+
+
+class ServerKeyCache(object):
+    """
+    Caches the verify keys of homeservers, already decoded.
+
+    Keys are cached until the valid_until_ts the homeserver gave for them, and, if
+    enabled, saved to the database so they survive a restart. Only one fetch is made
+    at a time for a given homeserver, whoever else needs its keys in the meantime
+    waits for it. Failed fetches are cached too, for a time which grows with each
+    consecutive failure, so that a broken homeserver isn't contacted again on every
+    request.
+
+    :param sydent: The Sydent instance.
+    :type sydent: sydent.sydent.Sydent
+    :param fetch: The function fetching the keys of a homeserver, returning a
+        deferred resolving to the response of its /_matrix/key/v2/server/ endpoint.
+    :type fetch: callable[[unicode], twisted.internet.defer.Deferred[dict[str, any]]]
+    """
+
+    def __init__(self, sydent, fetch):
+        self.sydent = sydent
+        self._fetch = fetch
+
+        max_size = self.sydent.cfg.getint("http", "federation.key_cache.max_size")
+        # The decoded keys of each homeserver, or a _FetchFailure
+        self._cache = TTLCache(
+            "server-keys",
+            timer=self.sydent.reactor.seconds,
+            max_size=max_size,
+            export_metrics=True,
+        )
+        # The number of consecutive failures to fetch the keys of each homeserver
+        self._failure_counts = TTLCache(
+            "server-key-failures",
+            timer=self.sydent.reactor.seconds,
+            max_size=max_size,
+            export_metrics=True,
+        )
+
+        # The deferreds waiting for a fetch in progress, by server name
+        self._in_flight = {}
+
+        self._store = None
+        if self.sydent.cfg.getboolean("http", "federation.key_cache.persist"):
+            self._store = ServerKeyStore(self.sydent)
+
+    def getVerifyKeys(self, server_name):
+        """
+        :param server_name: The server name of the homeserver.
+        :type server_name: unicode
+
+        :return: The verify keys of the homeserver, by key ID.
+        :rtype: twisted.internet.defer.Deferred[dict[unicode, signedjson.types.VerifyKey]]
+        """
+        cached = self._cache.get(server_name, None)
+        if isinstance(cached, _FetchFailure):
+            return defer.fail(cached.failure)
+        if cached is not None:
+            return defer.succeed(cached)
+
+        keys = self._loadFromStore(server_name)
+        if keys is not None:
+            return defer.succeed(keys)
+
+        d = defer.Deferred()
+        waiters = self._in_flight.get(server_name)
+        if waiters is not None:
+            waiters.append(d)
+        else:
+            self._in_flight[server_name] = [d]
+            self._fetchKeys(server_name)
+        return d
+
+    @defer.inlineCallbacks
+    def _fetchKeys(self, server_name):
+        server_key_fetches.inc()
+        try:
+            result = yield self._fetch(server_name)
+            outcome = self._processResult(server_name, result)
+        except Exception:
+            outcome = Failure()
+            # Don't keep the frames of the traceback around while it's cached.
+            outcome.cleanFailure()
+            self._fetchFailed(server_name, outcome)
+        else:
+            self._failure_counts.pop(server_name, None)
+
+        for d in self._in_flight.pop(server_name):
+            if isinstance(outcome, Failure):
+                d.errback(outcome)
+            else:
+                d.callback(outcome)
+
+    def _processResult(self, server_name, result):
+        """
+        Decodes and caches the keys returned by a homeserver.
+
+        :param server_name: The server name of the homeserver.
+        :type server_name: unicode
+        :param result: The response of the homeserver's key endpoint.
+        :type result: dict[str, any]
+
+        :return: The decoded verify keys, by key ID.
+        :rtype: dict[unicode, signedjson.types.VerifyKey]
+
+        :raise SignatureVerifyException: The response doesn't contain any key, or
+            an invalid valid_until_ts.
+        """
+        if "verify_keys" not in result:
+            raise SignatureVerifyException("No key found in response")
+
+        keys = self._decodeKeys(server_name, result["verify_keys"])
+
+        if "valid_until_ts" in result:
+            if not isinstance(result["valid_until_ts"], int):
+                raise SignatureVerifyException(
+                    "Invalid valid_until_ts received, must be an integer"
+                )
+
+            # Don't cache anything without a valid_until_ts or we wouldn't
+            # know when to expire it.
+
+            logger.info(
+                "Got keys for %s: caching until %d",
+                server_name,
+                result["valid_until_ts"],
+            )
+            self._cacheKeys(server_name, keys, result["valid_until_ts"])
+
+            if self._store is not None:
+                self._store.storeServerKeys(
+                    server_name,
+                    result["valid_until_ts"],
+                    result["verify_keys"],
+                    self._now(),
+                )
+
+        return keys
+
+    def _fetchFailed(self, server_name, failure):
+        server_key_fetch_failures.inc()
+
+        count = self._failure_counts.get(server_name, 0) + 1
+        backoff = min(
+            MAX_FAILURE_BACKOFF, MIN_FAILURE_BACKOFF * 2 ** min(count - 1, 32)
+        )
+
+        logger.warning(
+            "Failed to fetch keys for %s: %s - not trying again for %ds",
+            server_name,
+            failure.getErrorMessage(),
+            backoff,
+        )
+
+        self._cache.set(server_name, _FetchFailure(failure), backoff)
+        # Remember the failure for longer than the backoff, so that a failure after
+        # the next attempt backs off for longer.
+        self._failure_counts.set(server_name, count, backoff + MAX_FAILURE_BACKOFF)
+
+    def _loadFromStore(self, server_name):
+        """
+        :param server_name: The server name of the homeserver.
+        :type server_name: unicode
+
+        :return: The decoded keys saved for the homeserver, or None if there aren't
+            any valid ones.
+        :rtype: dict[unicode, signedjson.types.VerifyKey] or None
+        """
+        if self._store is None:
+            return None
+
+        row = self._store.getServerKeys(server_name, self._now())
+        if row is None:
+            return None
+
+        valid_until_ts, verify_keys = row
+        keys = self._decodeKeys(server_name, verify_keys)
+        self._cacheKeys(server_name, keys, valid_until_ts)
+        return keys
+
+    def _cacheKeys(self, server_name, keys, valid_until_ts):
+        ttl = (valid_until_ts - self._now()) / 1000.0
+        if ttl > 0:
+            self._cache.set(server_name, keys, ttl)
+
+    def _decodeKeys(self, server_name, verify_keys):
+        """
+        :param server_name: The server name of the homeserver.
+        :type server_name: unicode
+        :param verify_keys: The keys as returned by the homeserver.
+        :type verify_keys: dict[unicode, dict[unicode, unicode]]
+
+        :return: The keys which could be decoded, by key ID.
+        :rtype: dict[unicode, signedjson.types.VerifyKey]
+        """
+        keys = {}
+        for key_name, key_data in verify_keys.items():
+            if "key" not in key_data:
+                logger.warn(
+                    "Ignoring key %s from %s with no 'key'", key_name, server_name
+                )
+                continue
+
+            try:
+                key_bytes = decode_base64(key_data["key"])
+                keys[key_name] = signedjson.key.decode_verify_key_bytes(
+                    key_name, key_bytes
+                )
+            except Exception as e:
+                logger.warn(
+                    "Ignoring key %s from %s which couldn't be decoded: %s",
+                    key_name,
+                    server_name,
+                    e,
+                )
+
+        return keys
+
+    def _now(self):
+        """
+        :return: The current time in milliseconds, as given by the reactor's clock.
+        :rtype: int
+        """
+        return int(self.sydent.reactor.seconds() * 1000)
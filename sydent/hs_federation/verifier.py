@@ -16,15 +16,12 @@
 from __future__ import absolute_import
 
 import logging
-import time
 
 from twisted.internet import defer
-from unpaddedbase64 import decode_base64
 import signedjson.sign
-import signedjson.key
 from signedjson.sign import SignatureVerifyException
 
-from sydent.http.httpclient import FederationHttpClient
+from sydent.hs_federation.keycache import ServerKeyCache
 from sydent.util.stringutils import is_valid_matrix_server_name
 
 
@@ -58,52 +55,31 @@ class Verifier(object):
         self.sydent = sydent
         # Cache of server keys. These are cached until the 'valid_until_ts' time
         # in the result.
-        self.cache = {
-            # server_name: <result from keys query>,
-        }
+        self.key_cache = ServerKeyCache(self.sydent, self._fetchKeysForServer)
 
-    @defer.inlineCallbacks
-    def _getKeysForServer(self, server_name):
-        """Get the signing key data from a homeserver.
+    def _fetchKeysForServer(self, server_name):
+        """Fetch the signing key data from a homeserver.
 
         :param server_name: The name of the server to request the keys from.
         :type server_name: unicode
 
-        :return: The verification keys returned by the server.
-        :rtype: twisted.internet.defer.Deferred[dict[unicode, dict[unicode, unicode]]]
+        :return: The response of the homeserver.
+        :rtype: twisted.internet.defer.Deferred[dict[str, any]]
         """
-
-        if server_name in self.cache:
-            cached = self.cache[server_name]
-            now = int(time.time() * 1000)
-            if cached["valid_until_ts"] > now:
-                defer.returnValue(self.cache[server_name]["verify_keys"])
-
-        client = FederationHttpClient(self.sydent)
-        result = yield client.get_json(
+        return self.sydent.federationHttpClient.get_json(
             "matrix://%s/_matrix/key/v2/server/" % server_name, 1024 * 50
         )
 
-        if "verify_keys" not in result:
-            raise SignatureVerifyException("No key found in response")
-
-        if "valid_until_ts" in result:
-            if not isinstance(result["valid_until_ts"], int):
-                raise SignatureVerifyException(
-                    "Invalid valid_until_ts received, must be an integer"
-                )
-
-            # Don't cache anything without a valid_until_ts or we wouldn't
-            # know when to expire it.
+    def _getKeysForServer(self, server_name):
+        """Get the verify keys of a homeserver.
 
-            logger.info(
-                "Got keys for %s: caching until %d",
-                server_name,
-                result["valid_until_ts"],
-            )
-            self.cache[server_name] = result
+        :param server_name: The name of the server to request the keys from.
+        :type server_name: unicode
 
-        defer.returnValue(result["verify_keys"])
+        :return: The verification keys of the server, by key ID.
+        :rtype: twisted.internet.defer.Deferred[dict[unicode, signedjson.types.VerifyKey]]
+        """
+        return self.key_cache.getVerifyKeys(server_name)
 
     @defer.inlineCallbacks
     def verifyServerSignedJson(self, signed_json, acceptable_server_names=None):
@@ -135,13 +111,7 @@ class Verifier(object):
             server_keys = yield self._getKeysForServer(server_name)
             for key_name, sig in sigs.items():
                 if key_name in server_keys:
-                    if "key" not in server_keys[key_name]:
-                        logger.warn("Ignoring key %s with no 'key'")
-                        continue
-                    key_bytes = decode_base64(server_keys[key_name]["key"])
-                    verify_key = signedjson.key.decode_verify_key_bytes(
-                        key_name, key_bytes
-                    )
+                    verify_key = server_keys[key_name]
                     logger.info("verifying sig from key %r", key_name)
                     signedjson.sign.verify_signed_json(
                         signed_json, server_name, verify_key
@@ -153,7 +123,7 @@ class Verifier(object):
             logger.warn(
                 "No matching key found for signature block %r in server keys %r",
                 signed_json["signatures"],
-                server_keys,
+                list(server_keys),
             )
         logger.warn(
             "Unable to verify any signatures from block %r. Acceptable server names: %r",
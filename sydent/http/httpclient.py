@@ -19,8 +19,15 @@ import json
 import logging
 from io import BytesIO
 
+from prometheus_client import Counter, Gauge
 from twisted.internet import defer
-from twisted.web.client import FileBodyProducer, Agent, readBody
+from twisted.web.client import (
+    FileBodyProducer,
+    Agent,
+    HTTPConnectionPool,
+    URI,
+    readBody,
+)
 from twisted.web.http_headers import Headers
 
 from sydent.http.blacklisting_reactor import BlacklistingReactorWrapper
@@ -31,6 +38,27 @@ from sydent.util import json_decoder
 
 logger = logging.getLogger(__name__)
 
+# The maximum size (in bytes) of the ignored body of a response to read, so that the
+# connection it came on can be reused
+MAX_DISCARDED_BODY_SIZE = 64 * 1024
+
+federation_connection_requests = Counter(
+    "sydent_federation_connection_requests_total",
+    "Number of connections requested from the federation connection pool",
+)
+federation_connections_opened = Counter(
+    "sydent_federation_connections_opened_total",
+    "Number of new connections opened by the federation connection pool",
+)
+federation_requests_in_flight = Gauge(
+    "sydent_federation_requests_in_flight",
+    "Number of requests to homeservers currently being sent",
+)
+federation_requests_queued = Gauge(
+    "sydent_federation_requests_queued",
+    "Number of requests to homeservers waiting for the per-destination limit",
+)
+
 
 class HTTPClient(object):
     """A base HTTP class that contains methods for making GET and POST HTTP
@@ -106,9 +134,10 @@ class HTTPClient(object):
         # Ensure the body object is read otherwise we'll leak HTTP connections
         # as per
         # https://twistedmatrix.com/documents/current/web/howto/client.html
+        # Reading it whole, rather than giving up on it, allows the connection to be
+        # reused if it's pooled, unless the body is too large to bother.
         try:
-            # TODO Will this cause the server to think the request was a failure?
-            yield read_body_with_max_size(response, 0)
+            yield read_body_with_max_size(response, MAX_DISCARDED_BODY_SIZE)
         except BodyExceededMaxSize:
             pass
 
@@ -120,7 +149,14 @@ class SimpleHttpClient(HTTPClient):
     from Synapse.
     """
 
-    def __init__(self, sydent):
+    def __init__(self, sydent, pool=None):
+        """
+        :param sydent: The Sydent instance.
+        :type sydent: sydent.sydent.Sydent
+        :param pool: The pool of connections to use, if they should be kept open
+            between requests.
+        :type pool: twisted.web.client.HTTPConnectionPool or None
+        """
         self.sydent = sydent
         # The default endpoint factory in Twisted 14.0.0 (which we require) uses the
         # BrowserLikePolicyForHTTPS context factory which will do regular cert validation
@@ -132,23 +168,113 @@ class SimpleHttpClient(HTTPClient):
                 ip_blacklist=sydent.ip_blacklist,
             ),
             connectTimeout=15,
+            pool=pool,
         )
 
 
 class FederationHttpClient(HTTPClient):
     """HTTP client for federation requests to homeservers. Uses a
     MatrixFederationAgent.
+
+    A single instance is shared by everything that talks to homeservers (as
+    sydent.federationHttpClient), so that connections to a homeserver are reused
+    across requests, and the number of concurrent requests to any one homeserver
+    can be limited.
     """
 
     def __init__(self, sydent):
         self.sydent = sydent
+
+        reactor = BlacklistingReactorWrapper(
+            reactor=self.sydent.reactor,
+            ip_whitelist=sydent.ip_whitelist,
+            ip_blacklist=sydent.ip_blacklist,
+        )
+
+        self.pool = FederationConnectionPool(reactor)
+        self.pool.retryAutomatically = False
+        self.pool.maxPersistentPerHost = sydent.cfg.getint(
+            "http", "federation.max_persistent_per_host"
+        )
+        self.pool.cachedConnectionTimeout = sydent.cfg.getint(
+            "http", "federation.cached_connection_timeout"
+        )
+
+        self.max_concurrent_per_host = sydent.cfg.getint(
+            "http", "federation.max_concurrent_per_host"
+        )
+        # The semaphores limiting the concurrent requests to each homeserver, keyed
+        # by server name. Only the ones with requests in flight are kept.
+        self._limiters = {}
+
         self.agent = MatrixFederationAgent(
-            BlacklistingReactorWrapper(
-                reactor=self.sydent.reactor,
-                ip_whitelist=sydent.ip_whitelist,
-                ip_blacklist=sydent.ip_blacklist,
-            ),
+            reactor,
             ClientTLSOptionsFactory(sydent.cfg)
             if sydent.use_tls_for_federation
             else None,
+            pool=self.pool,
         )
+
+    def get_json(self, uri, max_size=None):
+        return self._limited(uri, super(FederationHttpClient, self).get_json, max_size)
+
+    def post_json_get_nothing(self, uri, post_json, opts):
+        return self._limited(
+            uri,
+            super(FederationHttpClient, self).post_json_get_nothing,
+            post_json,
+            opts,
+        )
+
+    @defer.inlineCallbacks
+    def _limited(self, uri, f, *args):
+        """
+        Makes a request once fewer than federation.max_concurrent_per_host requests
+        are in flight to its destination.
+
+        :param uri: The matrix:// URI to make the request to.
+        :type uri: unicode
+        :param f: The function making the request, called with the URI and args.
+        :type f: callable[..., twisted.internet.defer.Deferred]
+
+        :return: The result of the request.
+        :rtype: twisted.internet.defer.Deferred[any]
+        """
+        destination = URI.fromBytes(uri.encode("utf8")).netloc
+
+        limiter = self._limiters.get(destination)
+        if limiter is None:
+            limiter = defer.DeferredSemaphore(self.max_concurrent_per_host)
+            self._limiters[destination] = limiter
+
+        federation_requests_queued.inc()
+        try:
+            yield limiter.acquire()
+        finally:
+            federation_requests_queued.dec()
+
+        federation_requests_in_flight.inc()
+        try:
+            result = yield f(uri, *args)
+        finally:
+            federation_requests_in_flight.dec()
+            limiter.release()
+            if limiter.tokens == limiter.limit and not limiter.waiting:
+                del self._limiters[destination]
+
+        defer.returnValue(result)
+
+
+class FederationConnectionPool(HTTPConnectionPool):
+    """
+    A pool of persistent connections to homeservers, which keeps track of how often a
+    cached connection could be reused instead of opening a new one.
+    """
+
+    def getConnection(self, key, endpoint):
+        federation_connection_requests.inc()
+        return super(FederationConnectionPool, self).getConnection(key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        federation_connections_opened.inc()
+        return super(FederationConnectionPool, self)._newConnection(key, endpoint)
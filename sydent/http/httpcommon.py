@@ -14,10 +14,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gzip
 import logging
+import time
+import zlib
 from io import BytesIO
 
 import twisted.internet.ssl
+from prometheus_client import Counter, Histogram
 from twisted.internet import defer, protocol
 from twisted.internet.protocol import connectionDone
 from twisted.web._newclient import ResponseDone
@@ -25,12 +29,53 @@ from twisted.web.http import PotentialDataLoss
 from twisted.web.iweb import UNKNOWN_LENGTH
 from twisted.web import server
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 logger = logging.getLogger(__name__)
 
 # Arbitrarily limited to 512 KiB.
 MAX_REQUEST_SIZE = 512 * 1024
 
+# The content codings we can decode, in order of preference.
+SUPPORTED_CONTENT_ENCODINGS = ["gzip"]
+if zstandard is not None:
+    SUPPORTED_CONTENT_ENCODINGS.insert(0, "zstd")
+
+# The methods requests are labelled with in metrics, other methods being labelled as
+# "other" so that clients can't make up new labels.
+METRICS_METHODS = {"GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD"}
+
+# The buckets of the histograms of request and response sizes, in bytes
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+http_requests = Counter(
+    "sydent_http_requests_total",
+    "Number of HTTP requests received, by servlet, method and response code",
+    ["servlet", "method", "code"],
+)
+http_request_duration = Histogram(
+    "sydent_http_request_duration_seconds",
+    "Time taken to respond to HTTP requests, once received, by servlet and method",
+    ["servlet", "method"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+http_request_size = Histogram(
+    "sydent_http_request_size_bytes",
+    "Size of the bodies of HTTP requests, by servlet",
+    ["servlet"],
+    buckets=SIZE_BUCKETS,
+)
+http_response_size = Histogram(
+    "sydent_http_response_size_bytes",
+    "Size of the bodies of HTTP responses, by servlet",
+    ["servlet"],
+    buckets=SIZE_BUCKETS,
+)
+
 
 class SslComponents:
     def __init__(self, sydent):
@@ -88,6 +133,79 @@ class BodyExceededMaxSize(Exception):
     """The maximum allowed size of the HTTP body was exceeded."""
 
 
+class UnsupportedContentEncoding(Exception):
+    """The body is encoded with a content coding we don't support."""
+
+
+def encode_body(body, content_encoding):
+    """
+    Compresses a request or response body with the given content coding.
+
+    :param body: The body to compress.
+    :type body: bytes
+    :param content_encoding: The content coding to use, or None to leave the body
+        untouched.
+    :type content_encoding: str or None
+
+    :return: The encoded body.
+    :rtype: bytes
+
+    :raises UnsupportedContentEncoding: if the content coding isn't supported.
+    """
+    if content_encoding is None:
+        return body
+    if content_encoding == "gzip":
+        return gzip.compress(body)
+    if content_encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor().compress(body)
+    raise UnsupportedContentEncoding(content_encoding)
+
+
+def decode_body(body, content_encoding, max_size):
+    """
+    Decompresses a request or response body, refusing to produce more than a given
+    amount of data so that a small, highly compressed body can't exhaust our memory.
+
+    :param body: The encoded body.
+    :type body: bytes
+    :param content_encoding: The content coding the body is encoded with, or None if
+        it isn't encoded.
+    :type content_encoding: str or None
+    :param max_size: The maximum size (in bytes) of the decoded body.
+    :type max_size: int
+
+    :return: The decoded body.
+    :rtype: bytes
+
+    :raises UnsupportedContentEncoding: if the content coding isn't supported.
+    :raises BodyExceededMaxSize: if the decoded body would be larger than max_size.
+    :raises ValueError: if the body couldn't be decoded.
+    """
+    if content_encoding is None or content_encoding == "identity":
+        decoded = body
+    elif content_encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            decoded = decompressor.decompress(body, max_size + 1)
+        except zlib.error as e:
+            raise ValueError("Invalid gzip body: %s" % (e,))
+        if not decompressor.eof and len(decoded) <= max_size:
+            raise ValueError("Truncated gzip body")
+    elif content_encoding == "zstd" and zstandard is not None:
+        reader = zstandard.ZstdDecompressor().stream_reader(BytesIO(body))
+        try:
+            decoded = reader.read(max_size + 1)
+        except zstandard.ZstdError as e:
+            raise ValueError("Invalid zstd body: %s" % (e,))
+    else:
+        raise UnsupportedContentEncoding(content_encoding)
+
+    if len(decoded) > max_size:
+        raise BodyExceededMaxSize()
+
+    return decoded
+
+
 class _DiscardBodyWithMaxSizeProtocol(protocol.Protocol):
     """A protocol which immediately errors upon receiving data."""
 
@@ -179,6 +297,21 @@ def read_body_with_max_size(response, max_size):
 
 
 class SizeLimitingRequest(server.Request):
+    """
+    A request whose body is limited to MAX_REQUEST_SIZE, and which records the
+    metrics of its processing: count by response code, duration, and the sizes of
+    its body and of the response's, labelled with the name of the servlet which
+    rendered it.
+    """
+
+    # The name of the class of the resource which rendered the request
+    servlet = "unknown"
+    # The number of bytes of body received
+    receivedLength = 0
+
+    _renderStart = None
+    _metricsRecorded = False
+
     def handleContentChunk(self, data):
         if self.content.tell() + len(data) > MAX_REQUEST_SIZE:
             logger.info(
@@ -188,4 +321,40 @@ class SizeLimitingRequest(server.Request):
             self.transport.abortConnection()
             return
 
+        self.receivedLength += len(data)
         return super().handleContentChunk(data)
+
+    def render(self, resrc):
+        self.servlet = type(resrc).__name__
+        self._renderStart = time.perf_counter()
+        return super().render(resrc)
+
+    def finish(self):
+        super().finish()
+        self._recordMetrics(str(self.code))
+
+    def connectionLost(self, reason):
+        super().connectionLost(reason)
+        if not self.finished:
+            self._recordMetrics("disconnected")
+
+    def _recordMetrics(self, code):
+        """
+        :param code: The response code to label the request with.
+        :type code: str
+        """
+        if self._metricsRecorded:
+            return
+        self._metricsRecorded = True
+
+        method = self.method.decode("ascii", "replace")
+        if method not in METRICS_METHODS:
+            method = "other"
+
+        http_requests.labels(self.servlet, method, code).inc()
+        if self._renderStart is not None:
+            http_request_duration.labels(self.servlet, method).observe(
+                time.perf_counter() - self._renderStart
+            )
+        http_request_size.labels(self.servlet).observe(self.receivedLength)
+        http_response_size.labels(self.servlet).observe(self.sentLength)
@@ -19,15 +19,32 @@ import logging
 import json
 from io import BytesIO
 
+from prometheus_client import Counter
 from zope.interface import implementer
 
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
 from twisted.internet.ssl import optionsForClientTLS
-from twisted.web.client import Agent, FileBodyProducer
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool
 from twisted.web.iweb import IPolicyForHTTPS
 from twisted.web.http_headers import Headers
 
+from sydent.http.httpcommon import SUPPORTED_CONTENT_ENCODINGS, encode_body
+
 logger = logging.getLogger(__name__)
 
+replication_connection_requests = Counter(
+    "sydent_replication_connection_requests_total",
+    "Number of connections requested from the replication connection pool",
+)
+replication_connections_opened = Counter(
+    "sydent_replication_connections_opened_total",
+    "Number of new connections opened by the replication connection pool",
+)
+replication_tls_sessions_offered = Counter(
+    "sydent_replication_tls_sessions_offered_total",
+    "Number of replication TLS handshakes which offered a previous session for resumption",
+)
+
 
 class ReplicationHttpsClient:
     """
@@ -40,13 +57,34 @@ class ReplicationHttpsClient:
         self.sydent = sydent
         self.agent = None
 
+        # The content coding to compress request bodies with, keyed by URI. Peers
+        # advertise the codings they accept in the Accept-Encoding header of their
+        # responses, so we only start compressing once a peer has told us it can
+        # decode the result.
+        self.content_encodings = {}
+
+        # The content types each URI has advertised it accepts in the Accept-Post
+        # header of its responses, besides JSON.
+        self.accepted_content_types = {}
+
         if self.sydent.sslComponents.myPrivateCertificate:
             # We will already have logged a warn if this is absent, so don't do it again
             # cert = self.sydent.sslComponents.myPrivateCertificate
             # self.certOptions = twisted.internet.ssl.CertificateOptions(privateKey=cert.privateKey.original,
             #                                                      certificate=cert.original,
             #                                                      trustRoot=self.sydent.sslComponents.trustRoot)
-            self.agent = Agent(self.sydent.reactor, SydentPolicyForHTTPS(self.sydent))
+            self.pool = ReplicationConnectionPool(self.sydent.reactor)
+            self.pool.maxPersistentPerHost = self.sydent.cfg.getint(
+                "http", "replication.https.max_persistent_per_host"
+            )
+            self.pool.cachedConnectionTimeout = self.sydent.cfg.getint(
+                "http", "replication.https.cached_connection_timeout"
+            )
+            self.agent = Agent(
+                self.sydent.reactor,
+                SydentPolicyForHTTPS(self.sydent),
+                pool=self.pool,
+            )
 
     def postJson(self, uri, jsonObject):
         """
@@ -57,6 +95,23 @@ class ReplicationHttpsClient:
         :param jsonObject: The request's body.
         :type jsonObject: dict[any, any]
 
+        :return: The request's response.
+        :rtype: twisted.internet.defer.Deferred[twisted.web.iweb.IResponse]
+        """
+        return self.post(uri, json.dumps(jsonObject).encode("utf8"), "application/json")
+
+    def post(self, uri, body, content_type):
+        """
+        Sends a POST request over HTTPS, compressing its body if the URI has told us
+        it can decode it.
+
+        :param uri: The URI to send the request to.
+        :type uri: unicode
+        :param body: The request's body.
+        :type body: bytes
+        :param content_type: The content type of the request's body.
+        :type content_type: str
+
         :return: The request's response.
         :rtype: twisted.internet.defer.Deferred[twisted.web.iweb.IResponse]
         """
@@ -65,26 +120,162 @@ class ReplicationHttpsClient:
             logger.error("HTTPS post attempted but HTTPS is not configured")
             return
 
-        headers = Headers(
-            {"Content-Type": ["application/json"], "User-Agent": ["Sydent"]}
-        )
+        headers = Headers({"Content-Type": [content_type], "User-Agent": ["Sydent"]})
+
+        content_encoding = self.content_encodings.get(uri)
+        if content_encoding is not None:
+            headers.addRawHeader("Content-Encoding", content_encoding)
+            body = encode_body(body, content_encoding)
 
-        json_bytes = json.dumps(jsonObject).encode("utf8")
         reqDeferred = self.agent.request(
-            b"POST", uri.encode("utf8"), headers, FileBodyProducer(BytesIO(json_bytes))
+            b"POST", uri.encode("utf8"), headers, FileBodyProducer(BytesIO(body))
+        )
+        reqDeferred.addCallback(
+            self._negotiateContentEncoding, uri, content_type, content_encoding
         )
 
         return reqDeferred
 
+    def acceptsContentType(self, uri, content_type):
+        """
+        :param uri: A URI we've already sent requests to.
+        :type uri: unicode
+        :param content_type: A content type other than JSON.
+        :type content_type: str
+
+        :return: Whether the URI has told us it accepts request bodies of the given
+            content type.
+        :rtype: bool
+        """
+        return content_type in self.accepted_content_types.get(uri, ())
+
+    def _negotiateContentEncoding(self, response, uri, content_type, content_encoding):
+        """
+        Picks the content coding (and the content types) to use for future requests
+        to the given URI, based on the response to the latest one.
+
+        :param response: The response to the latest request.
+        :type response: twisted.web.iweb.IResponse
+        :param uri: The URI the request was sent to.
+        :type uri: unicode
+        :param content_type: The content type of the latest request.
+        :type content_type: str
+        :param content_encoding: The content coding used for the latest request, if
+            any.
+        :type content_encoding: str or None
+
+        :return: The response, unchanged.
+        :rtype: twisted.web.iweb.IResponse
+        """
+        if response.code == 415 and (
+            content_encoding is not None or content_type != "application/json"
+        ):
+            # The peer can't (or can no longer) decode our bodies. Go back to
+            # sending plain JSON.
+            logger.info(
+                "%s rejected %s request body (%s), falling back to plain JSON",
+                uri,
+                content_type,
+                content_encoding,
+            )
+            self.content_encodings.pop(uri, None)
+            self.accepted_content_types.pop(uri, None)
+            return response
+
+        accepted_types = set()
+        for value in response.headers.getRawHeaders("Accept-Post", []):
+            accepted_types.update(t.strip().lower() for t in value.split(","))
+        accepted_types.discard("application/json")
+        if accepted_types:
+            self.accepted_content_types[uri] = accepted_types
+        else:
+            self.accepted_content_types.pop(uri, None)
+
+        accepted = set()
+        for value in response.headers.getRawHeaders("Accept-Encoding", []):
+            accepted.update(c.strip().lower() for c in value.split(","))
+
+        for candidate in SUPPORTED_CONTENT_ENCODINGS:
+            if candidate in accepted:
+                if self.content_encodings.get(uri) != candidate:
+                    logger.info("Compressing requests to %s with %s", uri, candidate)
+                self.content_encodings[uri] = candidate
+                break
+        else:
+            self.content_encodings.pop(uri, None)
+
+        return response
+
+
+class ReplicationConnectionPool(HTTPConnectionPool):
+    """
+    A pool of persistent connections to replication peers, which keeps track of how
+    often a cached connection could be reused instead of opening a new one.
+    """
+
+    def getConnection(self, key, endpoint):
+        replication_connection_requests.inc()
+        return super(ReplicationConnectionPool, self).getConnection(key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        replication_connections_opened.inc()
+        return super(ReplicationConnectionPool, self)._newConnection(key, endpoint)
+
 
 @implementer(IPolicyForHTTPS)
 class SydentPolicyForHTTPS(object):
     def __init__(self, sydent):
         self.sydent = sydent
+        # One connection creator per peer, so that TLS sessions negotiated with a
+        # peer can be resumed on later connections to it.
+        self._creators = {}
 
     def creatorForNetloc(self, hostname, port):
-        return optionsForClientTLS(
-            hostname.decode("ascii"),
-            trustRoot=self.sydent.sslComponents.trustRoot,
-            clientCertificate=self.sydent.sslComponents.myPrivateCertificate,
-        )
+        creator = self._creators.get((hostname, port))
+        if creator is None:
+            creator = ResumingClientTLSOptions(
+                optionsForClientTLS(
+                    hostname.decode("ascii"),
+                    trustRoot=self.sydent.sslComponents.trustRoot,
+                    clientCertificate=self.sydent.sslComponents.myPrivateCertificate,
+                )
+            )
+            self._creators[(hostname, port)] = creator
+        return creator
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class ResumingClientTLSOptions(object):
+    """
+    Wraps a client connection creator so that each new connection offers the TLS
+    session of the previous connection to the same peer, which lets the peer skip
+    the full (mutually authenticated) handshake.
+
+    :param creator: The connection creator to wrap.
+    :type creator: twisted.internet.interfaces.IOpenSSLClientConnectionCreator
+    """
+
+    def __init__(self, creator):
+        self._creator = creator
+        self._last_connection = None
+        self._session = None
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = self._creator.clientConnectionForTLS(tlsProtocol)
+
+        # The session is only available once the handshake has completed, so pick
+        # it up from the previous connection rather than the one being created.
+        if self._last_connection is not None:
+            session = self._last_connection.get_session()
+            if session is not None:
+                self._session = session
+
+        if self._session is not None:
+            try:
+                connection.set_session(self._session)
+                replication_tls_sessions_offered.inc()
+            except Exception as e:
+                logger.debug("Unable to offer previous TLS session: %s", e)
+
+        self._last_connection = connection
+        return connection
@@ -171,6 +171,13 @@ class InternalApiHttpServer(object):
         authenticated_unbind = AuthenticatedUnbindThreePidServlet(self.sydent)
         internal.putChild(b"unbind", authenticated_unbind)
 
+        replication = Resource()
+        internal.putChild(b"replication", replication)
+        replication.putChild(b"status", self.sydent.servlets.replicationStatus)
+
+        internal.putChild(b"stalls", self.sydent.servlets.reactorStalls)
+        internal.putChild(b"slow_queries", self.sydent.servlets.slowQueries)
+
         factory = Site(root)
         factory.displayTracebacks = False
         self.sydent.reactor.listenTCP(port, factory, interface=interface)
@@ -194,6 +201,11 @@ class ReplicationHttpsServer:
         replicate.putChild(b"v1", replV1)
         replV1.putChild(b"push", self.sydent.servlets.replicationPush)
 
+        hashtree = Resource()
+        replV1.putChild(b"hashtree", hashtree)
+        hashtree.putChild(b"nodes", self.sydent.servlets.hashTreeNodes)
+        hashtree.putChild(b"bucket", self.sydent.servlets.hashTreeBucket)
+
         self.factory = Site(root)
         self.factory.displayTracebacks = False
 
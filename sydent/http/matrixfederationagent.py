@@ -50,8 +50,13 @@ WELL_KNOWN_MAX_CACHE_PERIOD = 48 * 3600
 # The maximum size (in bytes) to allow a well-known file to be.
 WELL_KNOWN_MAX_SIZE = 50 * 1024  # 50 KiB
 
+# The maximum number of servers to cache the .well-known result of
+WELL_KNOWN_CACHE_MAX_SIZE = 10000
+
 logger = logging.getLogger(__name__)
-well_known_cache = TTLCache("well-known")
+well_known_cache = TTLCache(
+    "well-known", max_size=WELL_KNOWN_CACHE_MAX_SIZE, export_metrics=True
+)
 
 
 @implementer(IAgent)
@@ -67,6 +72,10 @@ class MatrixFederationAgent(object):
         options, or none to disable TLS.
     :type tls_client_options_factory: ClientTLSOptionsFactory, None
 
+    :param pool: Connection pool to send requests through, or None to create one
+        for this agent.
+    :type pool: HTTPConnectionPool, None
+
     :param _well_known_tls_policy: TLS policy to use for fetching .well-known
         files. None to use a default (browser-like) implementation.
     :type _well_known_tls_policy: IPolicyForHTTPS, None
@@ -84,6 +93,7 @@ class MatrixFederationAgent(object):
         self,
         reactor,
         tls_client_options_factory,
+        pool=None,
         _well_known_tls_policy=None,
         _srv_resolver=None,
         _well_known_cache=well_known_cache,
@@ -95,10 +105,12 @@ class MatrixFederationAgent(object):
             _srv_resolver = SrvResolver()
         self._srv_resolver = _srv_resolver
 
-        self._pool = HTTPConnectionPool(reactor)
-        self._pool.retryAutomatically = False
-        self._pool.maxPersistentPerHost = 5
-        self._pool.cachedConnectionTimeout = 2 * 60
+        if pool is None:
+            pool = HTTPConnectionPool(reactor)
+            pool.retryAutomatically = False
+            pool.maxPersistentPerHost = 5
+            pool.cachedConnectionTimeout = 2 * 60
+        self._pool = pool
 
         agent_args = {}
         if _well_known_tls_policy is not None:
@@ -19,6 +19,7 @@ import json
 import copy
 import functools
 
+from prometheus_client import Counter, Histogram
 from twisted.internet import defer
 from twisted.web import server
 
@@ -26,6 +27,19 @@ from sydent.util import json_decoder
 
 logger = logging.getLogger(__name__)
 
+servlet_errors = Counter(
+    "sydent_http_servlet_errors_total",
+    "Number of requests servlets responded to with an error, by servlet and error "
+    "code",
+    ["servlet", "errcode"],
+)
+lookup_batch_size = Histogram(
+    "sydent_lookup_batch_size",
+    "Number of 3PIDs looked up per request, by servlet",
+    ["servlet"],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+)
+
 
 class MatrixRestError(Exception):
     """
@@ -126,6 +140,36 @@ def get_args(request, args, required=True):
     return request_args
 
 
+def get_limit(request, default):
+    """
+    Helper function to get the "limit" query parameter of a request, i.e. the
+    maximum number of items to respond with.
+
+    :param request: The request received by the servlet.
+    :type request: twisted.web.server.Request
+    :param default: The limit to use if the request doesn't set one.
+    :type default: int
+
+    :raises: MatrixRestError with 400 M_INVALID_PARAM if the limit isn't a
+        non-negative integer.
+
+    :return: The limit.
+    :rtype: int
+    """
+    if b"limit" not in request.args:
+        return default
+
+    try:
+        limit = int(request.args[b"limit"][0])
+    except ValueError:
+        limit = -1
+    if limit < 0:
+        raise MatrixRestError(
+            400, "M_INVALID_PARAM", "limit must be a non-negative integer"
+        )
+    return limit
+
+
 def jsonwrap(f):
     @functools.wraps(f)
     def inner(self, request, *args, **kwargs):
@@ -145,12 +189,16 @@ def jsonwrap(f):
         """
         try:
             request.setHeader("Content-Type", "application/json")
-            return dict_to_json_bytes(f(self, request, *args, **kwargs))
+            result = f(self, request, *args, **kwargs)
+            _countError(self, request, result)
+            return dict_to_json_bytes(result)
         except MatrixRestError as e:
             request.setResponseCode(e.httpStatus)
+            servlet_errors.labels(type(self).__name__, e.errcode).inc()
             return dict_to_json_bytes({"errcode": e.errcode, "error": e.error})
         except Exception:
             logger.exception("Exception processing request")
+            servlet_errors.labels(type(self).__name__, "M_UNKNOWN").inc()
             request.setHeader("Content-Type", "application/json")
             request.setResponseCode(500)
             return dict_to_json_bytes(
@@ -164,32 +212,38 @@ def jsonwrap(f):
 
 
 def deferjsonwrap(f):
-    def reqDone(resp, request):
+    def reqDone(resp, servlet, request):
         """
         Converts the given response content into JSON and encodes it to bytes, then
         writes it as the response to the given request with the right headers.
 
         :param resp: The response content to convert to JSON and encode.
         :type resp: dict[str, any]
+        :param servlet: The servlet which handled the request.
+        :type servlet: twisted.web.resource.Resource
         :param request: The request to respond to.
         :type request: twisted.web.server.Request
         """
+        _countError(servlet, request, resp)
         request.setHeader("Content-Type", "application/json")
         request.write(dict_to_json_bytes(resp))
         request.finish()
 
-    def reqErr(failure, request):
+    def reqErr(failure, servlet, request):
         """
         Logs the given failure. If the failure is a MatrixRestError, writes a response
         using the info it contains, otherwise responds with 500 Internal Server Error.
 
         :param failure: The failure to process.
         :type failure: twisted.python.failure.Failure
+        :param servlet: The servlet which handled the request.
+        :type servlet: twisted.web.resource.Resource
         :param request: The request to respond to.
         :type request: twisted.web.server.Request
         """
         request.setHeader("Content-Type", "application/json")
         if failure.check(MatrixRestError) is not None:
+            servlet_errors.labels(type(servlet).__name__, failure.value.errcode).inc()
             request.setResponseCode(failure.value.httpStatus)
             request.write(
                 dict_to_json_bytes(
@@ -200,6 +254,7 @@ def deferjsonwrap(f):
             logger.error(
                 "Request processing failed: %r, %s", failure, failure.getTraceback()
             )
+            servlet_errors.labels(type(servlet).__name__, "M_UNKNOWN").inc()
             request.setResponseCode(500)
             request.write(
                 dict_to_json_bytes(
@@ -220,16 +275,32 @@ def deferjsonwrap(f):
             and will come later.
         :rtype: int
         """
-        request = args[1]
+        servlet, request = args[0], args[1]
 
         d = defer.maybeDeferred(f, *args, **kwargs)
-        d.addCallback(reqDone, request)
-        d.addErrback(reqErr, request)
+        d.addCallback(reqDone, servlet, request)
+        d.addErrback(reqErr, servlet, request)
         return server.NOT_DONE_YET
 
     return inner
 
 
+def _countError(servlet, request, resp):
+    """
+    Counts the response of a servlet if it's an error its handler returned rather
+    than raised.
+
+    :param servlet: The servlet which handled the request.
+    :type servlet: twisted.web.resource.Resource
+    :param request: The request the servlet responded to.
+    :type request: twisted.web.server.Request
+    :param resp: The content of the response.
+    :type resp: dict[str, any]
+    """
+    if request.code >= 400 and isinstance(resp, dict) and "errcode" in resp:
+        servlet_errors.labels(type(servlet).__name__, resp["errcode"]).inc()
+
+
 def send_cors(request):
     request.setHeader("Access-Control-Allow-Origin", "*")
     request.setHeader("Access-Control-Allow-Methods", "GET, POST, PUT, DELETE, OPTIONS")
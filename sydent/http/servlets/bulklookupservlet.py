@@ -20,7 +20,13 @@ from sydent.db.threepid_associations import GlobalAssociationStore
 
 import logging
 
-from sydent.http.servlets import get_args, jsonwrap, send_cors, MatrixRestError
+from sydent.http.servlets import (
+    get_args,
+    jsonwrap,
+    lookup_batch_size,
+    send_cors,
+    MatrixRestError,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -51,6 +57,7 @@ class BulkLookupServlet(Resource):
             raise MatrixRestError(400, "M_INVALID_PARAM", "threepids must be a list")
 
         logger.info("Bulk lookup of %d threepids", len(threepids))
+        lookup_batch_size.labels("BulkLookupServlet").observe(len(threepids))
 
         globalAssocStore = GlobalAssociationStore(self.sydent)
         results = globalAssocStore.getMxids(threepids)
@@ -119,14 +119,10 @@ class EmailValidateCodeServlet(Resource):
             msg = "Verification failed: you may need to request another verification email"
 
         brand = self.sydent.brand_from_request(request)
-        templateFile = self.sydent.get_branded_template(
-            brand,
-            "verify_response_template.html",
-            ("http", "verify_response_template"),
-        )
+        template = self.sydent.templates.get(brand, "verify_response_template.html")
 
         request.setHeader("Content-Type", "text/html")
-        res = open(templateFile).read() % {"message": msg}
+        res = template.render({"message": msg})
         return res.encode("UTF-8")
 
     @jsonwrap
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import logging
+
+from twisted.web.resource import Resource
+
+from sydent.db.threepid_associations import GlobalAssociationStore
+from sydent.http.servlets import get_args, jsonwrap, MatrixRestError
+from sydent.http.servlets.replication import get_peer_from_request
+from sydent.replication.hashtree import (
+    BUCKET_SIZE,
+    DEPTH,
+    FANOUT,
+    compute_nodes,
+    is_valid_node,
+)
+from sydent.util import json_decoder
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of nodes of the hash tree a peer can request at once
+MAX_NODES_PER_REQUEST = 256
+
+
+class HashTreeNodesServlet(Resource):
+    """
+    Returns the digests and counts of nodes of the hash tree over the associations
+    created on a given server, so that a peer can compare them with its own and
+    find out where they disagree.
+    """
+
+    isLeaf = True
+
+    def __init__(self, sydent):
+        self.sydent = sydent
+
+    @jsonwrap
+    def render_POST(self, request):
+        get_peer_from_request(self.sydent, request)
+
+        args = get_args(request, ("origin_server", "nodes"))
+
+        origin_server = args["origin_server"]
+        nodes = args["nodes"]
+
+        if not isinstance(nodes, list) or len(nodes) > MAX_NODES_PER_REQUEST:
+            raise MatrixRestError(
+                400,
+                "M_INVALID_PARAM",
+                "nodes must be a list of at most %d nodes" % MAX_NODES_PER_REQUEST,
+            )
+
+        parsed_nodes = []
+        for node in nodes:
+            if (
+                not isinstance(node, list)
+                or len(node) != 2
+                or not all(isinstance(i, int) for i in node)
+                or not is_valid_node(*node)
+            ):
+                raise MatrixRestError(400, "M_INVALID_PARAM", "Invalid node %r" % node)
+            parsed_nodes.append(tuple(node))
+
+        results = compute_nodes(
+            GlobalAssociationStore(self.sydent), origin_server, parsed_nodes
+        )
+
+        return {
+            "bucket_size": BUCKET_SIZE,
+            "fanout": FANOUT,
+            "depth": DEPTH,
+            "nodes": [
+                [level, index, digest, count]
+                for (level, index), (digest, count) in results.items()
+            ],
+        }
+
+
+class HashTreeBucketServlet(Resource):
+    """
+    Returns the signed associations in a bucket of the hash tree, so that a peer
+    which found that bucket to differ from its own can repair it.
+    """
+
+    isLeaf = True
+
+    def __init__(self, sydent):
+        self.sydent = sydent
+
+    @jsonwrap
+    def render_POST(self, request):
+        get_peer_from_request(self.sydent, request)
+
+        args = get_args(request, ("origin_server", "bucket"))
+
+        origin_server = args["origin_server"]
+        bucket = args["bucket"]
+
+        if not isinstance(bucket, int) or not is_valid_node(0, bucket):
+            raise MatrixRestError(400, "M_INVALID_PARAM", "Invalid bucket")
+
+        raw_assocs = GlobalAssociationStore(
+            self.sydent
+        ).getSignedAssociationsInOriginIdRange(
+            origin_server, bucket * BUCKET_SIZE, (bucket + 1) * BUCKET_SIZE - 1
+        )
+
+        return {
+            "sgAssocs": {
+                origin_id: json_decoder.decode(raw)
+                for origin_id, raw in raw_assocs.items()
+            },
+        }
@@ -19,7 +19,7 @@ from twisted.web.resource import Resource
 
 import logging
 
-from sydent.http.servlets import get_args, jsonwrap, send_cors
+from sydent.http.servlets import get_args, jsonwrap, lookup_batch_size, send_cors
 from sydent.db.threepid_associations import GlobalAssociationStore
 from sydent.http.auth import authV2
 from sydent.http.servlets.hashdetailsservlet import HashDetailsServlet
@@ -98,6 +98,7 @@ class LookupV2Servlet(Resource):
         logger.info(
             "Lookup of %d threepid(s) with algorithm %s", len(addresses), algorithm
         )
+        lookup_batch_size.labels("LookupV2Servlet").observe(len(addresses))
         if algorithm == "none":
             # Lookup without hashing
             medium_address_tuples = []
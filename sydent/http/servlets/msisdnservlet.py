@@ -18,7 +18,6 @@ from __future__ import absolute_import
 
 import logging
 from twisted.web.resource import Resource
-import phonenumbers
 
 from sydent.validators import (
     DestinationRejectedException,
@@ -30,6 +29,7 @@ from sydent.validators import (
 
 from sydent.http.servlets import get_args, jsonwrap, send_cors
 from sydent.http.auth import authV2
+from sydent.util.msisdn import parse_phone_number
 from sydent.util.stringutils import is_valid_client_secret
 
 
@@ -67,7 +67,7 @@ class MsisdnRequestCodeServlet(Resource):
             }
 
         try:
-            phone_number_object = phonenumbers.parse(raw_phone_number, country)
+            phone_number = parse_phone_number(raw_phone_number, country)
         except Exception as e:
             logger.warn("Invalid phone number given: %r", e)
             request.setResponseCode(400)
@@ -76,20 +76,16 @@ class MsisdnRequestCodeServlet(Resource):
                 "error": "Invalid phone number",
             }
 
-        msisdn = phonenumbers.format_number(
-            phone_number_object, phonenumbers.PhoneNumberFormat.E164
-        )[1:]
+        msisdn = phone_number.msisdn
 
         # International formatted number. The same as an E164 but with spaces
         # in appropriate places to make it nicer for the humans.
-        intl_fmt = phonenumbers.format_number(
-            phone_number_object, phonenumbers.PhoneNumberFormat.INTERNATIONAL
-        )
+        intl_fmt = phone_number.international
 
         brand = self.sydent.brand_from_request(request)
         try:
             sid = self.sydent.validators.msisdn.requestToken(
-                phone_number_object, clientSecret, sendAttempt, brand
+                phone_number, clientSecret, sendAttempt, brand
             )
             resp = {
                 "success": True,
@@ -142,14 +138,10 @@ class MsisdnValidateCodeServlet(Resource):
                 msg = "Verification failed: you may need to request another verification text"
 
         brand = self.sydent.brand_from_request(request)
-        templateFile = self.sydent.get_branded_template(
-            brand,
-            "verify_response_template.html",
-            ("http", "verify_response_template"),
-        )
+        template = self.sydent.templates.get(brand, "verify_response_template.html")
 
         request.setHeader("Content-Type", "text/html")
-        return open(templateFile).read() % {"message": msg}
+        return template.render({"message": msg})
 
     @jsonwrap
     def render_POST(self, request):
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.web.resource import Resource
+
+from sydent.http.servlets import get_limit, jsonwrap
+
+# Number of call sites to report by default
+DEFAULT_LIMIT = 20
+
+
+class ReactorStallsServlet(Resource):
+    """A servlet which reports the call sites which blocked the reactor for the
+    longest since we started. The number of call sites to report can be set with the
+    "limit" query parameter.
+
+    It is assumed that authentication happens out of band
+    """
+
+    isLeaf = True
+
+    def __init__(self, sydent):
+        Resource.__init__(self)
+        self.sydent = sydent
+
+    @jsonwrap
+    def render_GET(self, request):
+        limit = get_limit(request, DEFAULT_LIMIT)
+
+        detector = self.sydent.stallDetector
+        return {
+            "enabled": detector.enabled,
+            "threshold_seconds": detector.threshold,
+            "call_sites": detector.getTopCallSites(limit),
+        }
@@ -23,7 +23,6 @@ import json
 from six.moves import urllib
 
 from sydent.http.servlets import get_args, jsonwrap, deferjsonwrap, send_cors
-from sydent.http.httpclient import FederationHttpClient
 from sydent.users.tokens import issueToken
 from sydent.util.stringutils import is_valid_matrix_server_name
 
@@ -35,7 +34,7 @@ class RegisterServlet(Resource):
 
     def __init__(self, syd):
         self.sydent = syd
-        self.client = FederationHttpClient(self.sydent)
+        self.client = self.sydent.federationHttpClient
 
     @deferjsonwrap
     @defer.inlineCallbacks
@@ -18,13 +18,19 @@ from __future__ import absolute_import
 import twisted.python.log
 from twisted.web.resource import Resource
 from sydent.http.servlets import jsonwrap, MatrixRestError
+from sydent.http.httpcommon import (
+    SUPPORTED_CONTENT_ENCODINGS,
+    BodyExceededMaxSize,
+    UnsupportedContentEncoding,
+    decode_body,
+)
+from sydent.replication.wire import SGASSOCS_CONTENT_TYPE, decode_sg_assocs
 from sydent.threepid import threePidAssocFromDict
 from sydent.util import json_decoder
 
 from sydent.util.hash import sha256_and_url_safe_base64
 
 from sydent.db.hashing_metadata import HashingMetadataStore
-from sydent.db.peers import PeerStore
 from sydent.db.threepid_associations import GlobalAssociationStore
 
 import logging
@@ -32,6 +38,38 @@ import json
 
 logger = logging.getLogger(__name__)
 
+# The maximum size (in bytes) a push body is allowed to decompress to.
+MAX_DECOMPRESSED_PUSH_SIZE = 8 * 1024 * 1024
+
+
+def get_peer_from_request(sydent, request):
+    """
+    Identifies the peer that sent a replication request from the Common Name of the
+    TLS client certificate it presented.
+
+    :param sydent: The current Sydent instance.
+    :type sydent: sydent.sydent.Sydent
+    :param request: The request received over the replication HTTPS server.
+    :type request: twisted.web.server.Request
+
+    :return: The peer that sent the request.
+    :rtype: sydent.replication.peer.RemotePeer
+
+    :raises MatrixRestError: if the certificate doesn't match a known peer.
+    """
+    peerCert = request.transport.getPeerCertificate()
+    peerCertCn = peerCert.get_subject().commonName
+
+    peer = sydent.peerRegistry.getPeerByName(peerCertCn)
+
+    if not peer:
+        logger.warn("Got connection from %s but no peer found by that name", peerCertCn)
+        raise MatrixRestError(
+            403, "M_UNKNOWN_PEER", "This peer is not known to this server"
+        )
+
+    return peer
+
 
 class ReplicationPushServlet(Resource):
     def __init__(self, sydent):
@@ -40,61 +78,76 @@ class ReplicationPushServlet(Resource):
 
     @jsonwrap
     def render_POST(self, request):
-        peerCert = request.transport.getPeerCertificate()
-        peerCertCn = peerCert.get_subject().commonName
+        # Let peers know they can compress the bodies of their next pushes.
+        request.setHeader("Accept-Encoding", ", ".join(SUPPORTED_CONTENT_ENCODINGS))
+        # ...and that they can use the binary framing instead of JSON.
+        request.setHeader("Accept-Post", "application/json, " + SGASSOCS_CONTENT_TYPE)
 
-        peerStore = PeerStore(self.sydent)
-
-        peer = peerStore.getPeerByName(peerCertCn)
-
-        if not peer:
-            logger.warn(
-                "Got connection from %s but no peer found by that name", peerCertCn
-            )
-            raise MatrixRestError(
-                403, "M_UNKNOWN_PEER", "This peer is not known to this server"
-            )
+        peer = get_peer_from_request(self.sydent, request)
 
         logger.info("Push connection made from peer %s", peer.servername)
 
-        if (
-            not request.requestHeaders.hasHeader("Content-Type")
-            or request.requestHeaders.getRawHeaders("Content-Type")[0]
-            != "application/json"
-        ):
+        content_type = None
+        if request.requestHeaders.hasHeader("Content-Type"):
+            content_type = request.requestHeaders.getRawHeaders("Content-Type")[0]
+
+        if content_type not in ("application/json", SGASSOCS_CONTENT_TYPE):
             logger.warn(
                 "Peer %s made push connection with non-JSON content (type: %s)",
                 peer.servername,
-                request.requestHeaders.getRawHeaders("Content-Type")[0],
+                content_type,
             )
             raise MatrixRestError(400, "M_NOT_JSON", "This endpoint expects JSON")
 
+        content_encoding = None
+        if request.requestHeaders.hasHeader("Content-Encoding"):
+            content_encoding = (
+                request.requestHeaders.getRawHeaders("Content-Encoding")[0]
+                .strip()
+                .lower()
+            )
+
         try:
-            # json.loads doesn't allow bytes in Python 3.5
-            inJson = json_decoder.decode(request.content.read().decode("UTF-8"))
-        except ValueError:
+            body = decode_body(
+                request.content.read(), content_encoding, MAX_DECOMPRESSED_PUSH_SIZE
+            )
+        except UnsupportedContentEncoding:
             logger.warn(
-                "Peer %s made push connection with malformed JSON", peer.servername
+                "Peer %s made push connection with unsupported content encoding %s",
+                peer.servername,
+                content_encoding,
             )
-            raise MatrixRestError(400, "M_BAD_JSON", "Malformed JSON")
-
-        if "sgAssocs" not in inJson:
+            raise MatrixRestError(
+                415, "M_UNKNOWN", "Unsupported content encoding %s" % content_encoding
+            )
+        except BodyExceededMaxSize:
             logger.warn(
-                "Peer %s made push connection with no 'sgAssocs' key in JSON",
+                "Peer %s made push connection which decompresses to more than %d bytes",
                 peer.servername,
+                MAX_DECOMPRESSED_PUSH_SIZE,
             )
-            raise MatrixRestError(400, "M_BAD_JSON", 'No "sgAssocs" key in JSON')
+            raise MatrixRestError(413, "M_TOO_LARGE", "Request body too large")
+        except ValueError:
+            logger.warn(
+                "Peer %s made push connection with malformed %s body",
+                peer.servername,
+                content_encoding,
+            )
+            raise MatrixRestError(400, "M_BAD_JSON", "Malformed request body")
+
+        if content_type == SGASSOCS_CONTENT_TYPE:
+            sg_assocs = self._read_framed_body(peer, body)
+        else:
+            sg_assocs = self._read_json_body(peer, body)
 
         failedIds = []
 
         globalAssocsStore = GlobalAssociationStore(self.sydent)
 
-        # Ensure items are pulled out of the dictionary in order of origin_id.
-        sg_assocs = inJson.get("sgAssocs", {})
-        sg_assocs = sorted(sg_assocs.items(), key=lambda k: int(k[0]))
-
-        for originId, sgAssoc in sg_assocs:
+        for originId, sgAssoc, rawSgAssoc in sg_assocs:
             try:
+                if sgAssoc is None:
+                    sgAssoc = json_decoder.decode(rawSgAssoc)
                 peer.verifySignedAssociation(sgAssoc)
                 logger.debug(
                     "Signed association from %s with origin ID %s verified",
@@ -123,9 +176,11 @@ class ReplicationPushServlet(Resource):
                     assocObj.lookup_hash = sha256_and_url_safe_base64(str_to_hash)
 
                     # Add this association
+                    if rawSgAssoc is None:
+                        rawSgAssoc = json.dumps(sgAssoc)
                     globalAssocsStore.addAssociation(
                         assocObj,
-                        json.dumps(sgAssoc),
+                        rawSgAssoc,
                         peer.servername,
                         originId,
                         commit=False,
@@ -152,6 +207,9 @@ class ReplicationPushServlet(Resource):
                 twisted.python.log.err()
 
         if len(failedIds) > 0:
+            self.sydent.replicationStats.verificationFailed(
+                peer.servername, len(failedIds)
+            )
             self.sydent.db.rollback()
             request.setResponseCode(400)
             return {
@@ -161,4 +219,70 @@ class ReplicationPushServlet(Resource):
             }
         else:
             self.sydent.db.commit()
+            self.sydent.replicationStats.associationsReceived(
+                peer.servername, len(sg_assocs)
+            )
             return {"success": True}
+
+    def _read_json_body(self, peer, body):
+        """
+        Reads the signed associations out of a JSON push body.
+
+        :param peer: The peer that sent the push.
+        :type peer: sydent.replication.peer.RemotePeer
+        :param body: The (decompressed) body of the push.
+        :type body: bytes
+
+        :return: The origin ID and signed association of each association, in order
+            of origin ID. The associations are already parsed, so the serialised
+            signed association of each is None.
+        :rtype: list[tuple[int, dict[str, any], None]]
+        """
+        try:
+            # json.loads doesn't allow bytes in Python 3.5
+            inJson = json_decoder.decode(body.decode("UTF-8"))
+        except ValueError:
+            logger.warn(
+                "Peer %s made push connection with malformed JSON", peer.servername
+            )
+            raise MatrixRestError(400, "M_BAD_JSON", "Malformed JSON")
+
+        if "sgAssocs" not in inJson:
+            logger.warn(
+                "Peer %s made push connection with no 'sgAssocs' key in JSON",
+                peer.servername,
+            )
+            raise MatrixRestError(400, "M_BAD_JSON", 'No "sgAssocs" key in JSON')
+
+        # Ensure items are pulled out of the dictionary in order of origin_id.
+        sg_assocs = inJson.get("sgAssocs", {})
+        sg_assocs = sorted(sg_assocs.items(), key=lambda k: int(k[0]))
+
+        return [(originId, sgAssoc, None) for originId, sgAssoc in sg_assocs]
+
+    def _read_framed_body(self, peer, body):
+        """
+        Reads the signed associations out of a push body using the binary framing.
+
+        :param peer: The peer that sent the push.
+        :type peer: sydent.replication.peer.RemotePeer
+        :param body: The (decompressed) body of the push.
+        :type body: bytes
+
+        :return: The origin ID and serialised signed association of each association,
+            in order of origin ID. The associations are left to be parsed one at a
+            time, so the parsed signed association of each is None.
+        :rtype: list[tuple[int, None, unicode]]
+        """
+        try:
+            return [
+                (originId, None, raw.decode("UTF-8"))
+                for originId, raw in decode_sg_assocs(body)
+            ]
+        except ValueError as e:
+            logger.warn(
+                "Peer %s made push connection with malformed framing: %s",
+                peer.servername,
+                e,
+            )
+            raise MatrixRestError(400, "M_BAD_JSON", "Malformed request body")
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.web.resource import Resource
+
+from sydent.db.peers import PeerStore
+from sydent.db.threepid_associations import LocalAssociationStore
+from sydent.http.servlets import jsonwrap
+from sydent.util import time_msec
+
+
+class ReplicationStatusServlet(Resource):
+    """A servlet which reports how far behind each replication peer is, and how
+    replication with it has been going since we started.
+
+    It is assumed that authentication happens out of band
+    """
+
+    isLeaf = True
+
+    def __init__(self, sydent):
+        Resource.__init__(self)
+        self.sydent = sydent
+
+    @jsonwrap
+    def render_GET(self, request):
+        max_id = LocalAssociationStore(self.sydent).getMaxId() or 0
+        now = time_msec()
+
+        peers = {}
+        for name, last_sent, last_success, active in PeerStore(
+            self.sydent
+        ).getPeerStatuses():
+            status = {
+                "active": active,
+                "last_sent_version": last_sent,
+                "backlog": max_id - (last_sent or 0),
+                "last_push_success_ts": last_success,
+                "seconds_since_last_push_success": (
+                    (now - last_success) / 1000.0 if last_success else None
+                ),
+            }
+            status.update(self.sydent.replicationStats.getPeerStatus(name))
+            peers[name] = status
+
+        return {"max_local_id": max_id, "peers": peers}
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.web.resource import Resource
+
+from sydent.http.servlets import get_limit, jsonwrap
+
+# Number of statements to report by default
+DEFAULT_LIMIT = 20
+
+
+class SlowQueriesServlet(Resource):
+    """A servlet which reports the SQL statements which took the longest overall
+    since we started, if the slow query log is enabled. The number of statements to
+    report can be set with the "limit" query parameter.
+
+    It is assumed that authentication happens out of band
+    """
+
+    isLeaf = True
+
+    def __init__(self, sydent):
+        Resource.__init__(self)
+        self.sydent = sydent
+
+    @jsonwrap
+    def render_GET(self, request):
+        limit = get_limit(request, DEFAULT_LIMIT)
+
+        slowQueryLog = self.sydent.db.slowQueryLog
+        if slowQueryLog is None:
+            return {"enabled": False, "threshold_seconds": None, "statements": []}
+
+        return {
+            "enabled": True,
+            "threshold_seconds": slowQueryLog.threshold,
+            "statements": slowQueryLog.getStatementStats(limit),
+        }
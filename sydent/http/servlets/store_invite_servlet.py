@@ -143,13 +143,9 @@ class StoreInviteServlet(Resource):
         substitutions["subject_header_value"] = subject_header.encode()
 
         brand = self.sydent.brand_from_request(request)
-        templateFile = self.sydent.get_branded_template(
-            brand,
-            "invite_template.eml",
-            ("email", "email.invite_template"),
-        )
+        template = self.sydent.templates.get(brand, "invite_template.eml")
 
-        sendEmail(self.sydent, templateFile, address, substitutions)
+        sendEmail(self.sydent, template, address, substitutions)
 
         pubKey = self.sydent.keyring.ed25519.verify_key
         pubKeyBase64 = encode_base64(pubKey.encode())
@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import logging
 import random
 import time
@@ -24,10 +25,24 @@ from twisted.internet import defer
 from twisted.internet.error import ConnectError
 from twisted.names import client, dns
 from twisted.names.error import DNSNameError, DomainError
+from twisted.python.failure import Failure
 
 logger = logging.getLogger(__name__)
 
-SERVER_CACHE = {}
+# The maximum number of names to cache the SRV records of
+SERVER_CACHE_MAX_SIZE = 10000
+
+# How long (in seconds) to cache the absence of SRV records for a name, if the DNS
+# server doesn't say, and the maximum time to cache it for if it does
+DEFAULT_NEGATIVE_CACHE_TTL = 60
+MAX_NEGATIVE_CACHE_TTL = 5 * 60
+
+# The proportion of the lifetime of cached SRV records left when a lookup for them
+# triggers a refresh in the background, so that names which are looked up often
+# don't have to wait for DNS when their records expire
+REFRESH_AHEAD_FRACTION = 0.2
+
+SERVER_CACHE = collections.OrderedDict()
 
 
 @attr.s
@@ -82,27 +97,56 @@ def pick_server_from_list(server_list):
     )
 
 
+@attr.s
+class _CacheEntry(object):
+    """The result of looking up the SRV records for a name."""
+
+    # The servers from the SRV records, empty if there are none
+    servers = attr.ib()
+    # When the entry expires - in *seconds* since the epoch
+    expires = attr.ib()
+    # From when a lookup for the entry should refresh it in the background
+    refresh_at = attr.ib()
+
+
 class SrvResolver(object):
     """Interface to the dns client to do SRV lookups, with result caching.
     The default resolver in twisted.names doesn't do any caching (it has a CacheResolver,
     but the cache never gets populated), so we add our own caching layer here.
 
+    Names without SRV records are cached too, for as long as the DNS server allows.
+    Concurrent lookups for the same name share a single DNS query, and names looked
+    up shortly before their records expire are refreshed in the background.
+
     :param dns_client: Twisted resolver impl
     :type dns_client: twisted.internet.interfaces.IResolver
 
-    :param cache: cache object
-    :type cache: Dict
+    :param cache: cache object, whose least recently used entries are evicted once
+        it holds more than max_cache_size names
+    :type cache: collections.OrderedDict
 
     :param get_time: Clock implementation. Should return seconds since the epoch.
     :type get_time: callable
+
+    :param max_cache_size: The maximum number of names to cache the records of.
+    :type max_cache_size: int
     """
 
-    def __init__(self, dns_client=client, cache=SERVER_CACHE, get_time=time.time):
+    def __init__(
+        self,
+        dns_client=client,
+        cache=SERVER_CACHE,
+        get_time=time.time,
+        max_cache_size=SERVER_CACHE_MAX_SIZE,
+    ):
         self._dns_client = dns_client
         self._cache = cache
         self._get_time = get_time
+        self._max_cache_size = max_cache_size
+
+        # The deferreds waiting for a lookup in progress, by name
+        self._in_flight = {}
 
-    @defer.inlineCallbacks
     def resolve_service(self, service_name):
         """Look up a SRV record
 
@@ -112,32 +156,91 @@ class SrvResolver(object):
         :returns a list of the SRV records, or an empty list if none found.
         :rtype: Deferred[list[Server]]
         """
-        now = int(self._get_time())
-
         if not isinstance(service_name, bytes):
-            raise TypeError("%r is not a byte string" % (service_name,))
+            return defer.fail(TypeError("%r is not a byte string" % (service_name,)))
+
+        now = int(self._get_time())
 
         cache_entry = self._cache.get(service_name, None)
-        if cache_entry:
-            if all(s.expires > now for s in cache_entry):
-                servers = list(cache_entry)
-                defer.returnValue(servers)
+        if cache_entry is not None and cache_entry.expires > now:
+            self._cache.move_to_end(service_name)
+            if now >= cache_entry.refresh_at:
+                self._lookup(service_name, None)
+            return defer.succeed(list(cache_entry.servers))
+
+        d = defer.Deferred()
+        self._lookup(service_name, d)
+        return d
+
+    def _lookup(self, service_name, waiter):
+        """
+        Queries DNS for the SRV records of a name, unless a query for it is already in
+        progress.
+
+        :param service_name: The record to look up.
+        :type service_name: bytes
+        :param waiter: The deferred to fire with the result, or None to only refresh
+            the cache.
+        :type waiter: twisted.internet.defer.Deferred or None
+        """
+        waiters = self._in_flight.get(service_name)
+        if waiters is not None:
+            if waiter is not None:
+                waiters.append(waiter)
+            return
+
+        self._in_flight[service_name] = [waiter] if waiter is not None else []
+
+        def _done(result):
+            waiters = self._in_flight.pop(service_name)
+
+            if isinstance(result, Failure) and not waiters:
+                logger.warn(
+                    "Failed to refresh SRV records for %r: %s",
+                    service_name,
+                    result.getErrorMessage(),
+                )
+
+            for d in waiters:
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(list(result))
+
+        self._query(service_name).addBoth(_done)
+
+    @defer.inlineCallbacks
+    def _query(self, service_name):
+        """Query DNS for the SRV records of a name, and cache the result.
+
+        :param service_name: The record to look up.
+        :type service_name: bytes
+
+        :returns a list of the SRV records, or an empty list if none found.
+        :rtype: Deferred[list[Server]]
+        """
+        now = int(self._get_time())
 
         try:
-            answers, _, _ = yield self._dns_client.lookupService(service_name)
-        except DNSNameError:
-            # TODO: cache this. We can get the SOA out of the exception, and use
-            # the negative-TTL value.
+            answers, authority, _ = yield self._dns_client.lookupService(service_name)
+        except DNSNameError as e:
+            message = e.args[0] if e.args else None
+            self._cache_result(
+                service_name,
+                [],
+                _negative_ttl(getattr(message, "authority", [])),
+                now,
+            )
             defer.returnValue([])
         except DomainError as e:
             # We failed to resolve the name (other than a NameError)
             # Try something in the cache, else rereaise
             cache_entry = self._cache.get(service_name, None)
-            if cache_entry:
+            if cache_entry is not None and cache_entry.servers:
                 logger.warn(
                     "Failed to resolve %r, falling back to cache. %r", service_name, e
                 )
-                defer.returnValue(list(cache_entry))
+                defer.returnValue(list(cache_entry.servers))
             else:
                 raise e
 
@@ -167,5 +270,49 @@ class SrvResolver(object):
                 )
             )
 
-        self._cache[service_name] = list(servers)
+        if servers:
+            ttl = min(s.expires for s in servers) - now
+        else:
+            ttl = _negative_ttl(authority)
+
+        self._cache_result(service_name, servers, ttl, now)
         defer.returnValue(servers)
+
+    def _cache_result(self, service_name, servers, ttl, now):
+        """Cache the result of looking up the SRV records for a name.
+
+        :param service_name: The name.
+        :type service_name: bytes
+        :param servers: The servers from its SRV records.
+        :type servers: list[Server]
+        :param ttl: How long (in seconds) to cache the result for.
+        :type ttl: int
+        :param now: The time of the lookup, in seconds since the epoch.
+        :type now: int
+        """
+        self._cache[service_name] = _CacheEntry(
+            servers=list(servers),
+            expires=now + ttl,
+            refresh_at=now + ttl * (1 - REFRESH_AHEAD_FRACTION),
+        )
+        self._cache.move_to_end(service_name)
+
+        while len(self._cache) > self._max_cache_size:
+            self._cache.popitem(last=False)
+
+
+def _negative_ttl(authority):
+    """Work out how long to cache the absence of records for, from the SOA record
+    in the authority section of the response, as per RFC 2308.
+
+    :param authority: The authority section of the DNS response.
+    :type authority: list[twisted.names.dns.RRHeader]
+
+    :returns the time to cache the absence of records for, in seconds.
+    :rtype: int
+    """
+    for record in authority:
+        if record.type == dns.SOA and record.payload:
+            return min(record.ttl, record.payload.minimum, MAX_NEGATIVE_CACHE_TTL)
+
+    return DEFAULT_NEGATIVE_CACHE_TTL
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import json
+import logging
+
+from prometheus_client import Counter
+from twisted.internet import defer
+import twisted.internet.task
+
+from sydent.db.hashing_metadata import HashingMetadataStore
+from sydent.db.threepid_associations import GlobalAssociationStore
+from sydent.http.httpcommon import read_body_with_max_size
+from sydent.http.servlets.hashtreeservlet import MAX_NODES_PER_REQUEST
+from sydent.replication.hashtree import (
+    BUCKET_SIZE,
+    DEPTH,
+    compute_nodes,
+    node_children,
+)
+from sydent.threepid import threePidAssocFromDict
+from sydent.util import json_decoder, time_msec
+from sydent.util.hash import sha256_and_url_safe_base64
+
+logger = logging.getLogger(__name__)
+
+# The maximum size (in bytes) of a response from a peer's hash tree endpoints
+MAX_HASHTREE_RESPONSE_SIZE = 8 * 1024 * 1024
+
+divergent_buckets = Counter(
+    "sydent_replication_antientropy_divergent_buckets_total",
+    "Number of hash tree buckets found to differ from a peer's",
+    ["peer"],
+)
+repaired_associations = Counter(
+    "sydent_replication_antientropy_repaired_associations_total",
+    "Number of associations added or removed to repair divergence from a peer",
+    ["peer", "action"],
+)
+
+
+class AntiEntropy:
+    """
+    Periodically compares the associations we hold from each peer with the ones that
+    peer holds itself, using the hash tree described in sydent.replication.hashtree,
+    and repairs any bucket that differs by fetching the peer's copy of it.
+
+    Each peer is the authority on the associations it created, so only those are
+    compared with it.
+    """
+
+    def __init__(self, sydent):
+        self.sydent = sydent
+        self.assocStore = GlobalAssociationStore(self.sydent)
+        self.hashing_store = HashingMetadataStore(self.sydent)
+        self.checking = set()
+
+    def setup(self):
+        interval = self.sydent.cfg.getint("general", "replication.antientropy_interval")
+        if interval <= 0:
+            return
+
+        cb = twisted.internet.task.LoopingCall(self.checkAllPeers)
+        cb.clock = self.sydent.reactor
+        cb.start(interval, now=False)
+
+    def checkAllPeers(self):
+        """Compares our associations with every peer's, one peer at a time.
+
+        :rtype: twisted.internet.defer.DeferredList
+        """
+        peers = self.sydent.peerRegistry.getAllPeers()
+        return defer.DeferredList([self.checkPeer(p) for p in peers])
+
+    @defer.inlineCallbacks
+    def checkPeer(self, peer):
+        """
+        Compares the associations created by the given peer that we hold with the ones
+        it holds itself, and repairs any difference.
+
+        :param peer: The peer to compare with.
+        :type peer: sydent.replication.peer.RemotePeer
+
+        :return: The number of buckets that differed.
+        :rtype: twisted.internet.defer.Deferred[int]
+        """
+        if peer.servername in self.checking:
+            return 0
+
+        self.checking.add(peer.servername)
+        try:
+            buckets = yield self._findDivergentBuckets(peer)
+            if buckets:
+                logger.info(
+                    "%d buckets of associations from %s differ, repairing",
+                    len(buckets),
+                    peer.servername,
+                )
+                divergent_buckets.labels(peer.servername).inc(len(buckets))
+            for bucket in buckets:
+                yield self._repairBucket(peer, bucket)
+            return len(buckets)
+        except Exception:
+            logger.exception("Error comparing associations with %s", peer.servername)
+            return 0
+        finally:
+            self.checking.discard(peer.servername)
+
+    @defer.inlineCallbacks
+    def _findDivergentBuckets(self, peer):
+        """
+        Descends the hash tree of the peer's associations, only into the nodes that
+        differ from ours.
+
+        :param peer: The peer to compare with.
+        :type peer: sydent.replication.peer.RemotePeer
+
+        :return: The buckets that differ.
+        :rtype: twisted.internet.defer.Deferred[list[int]]
+        """
+        frontier = [(DEPTH, 0)]
+        buckets = []
+
+        while frontier:
+            next_frontier = []
+            for i in range(0, len(frontier), MAX_NODES_PER_REQUEST):
+                nodes = frontier[i : i + MAX_NODES_PER_REQUEST]
+                remote = yield self._postToPeer(
+                    peer,
+                    "hashtree/nodes",
+                    {
+                        "origin_server": peer.servername,
+                        "nodes": [list(n) for n in nodes],
+                    },
+                )
+                remote_nodes = {
+                    (n[0], n[1]): (n[2], n[3]) for n in remote.get("nodes", [])
+                }
+                local_nodes = compute_nodes(self.assocStore, peer.servername, nodes)
+
+                for node in nodes:
+                    local = local_nodes[node]
+                    theirs = remote_nodes.get(node)
+                    if theirs is not None:
+                        theirs = tuple(theirs)
+                    if local == theirs:
+                        continue
+                    # Nothing on either side below this node.
+                    if local[1] == 0 and theirs is not None and theirs[1] == 0:
+                        continue
+
+                    level, index = node
+                    if level == 0:
+                        buckets.append(index)
+                    else:
+                        next_frontier.extend(node_children(level, index))
+
+            frontier = next_frontier
+
+        return buckets
+
+    @defer.inlineCallbacks
+    def _repairBucket(self, peer, bucket):
+        """
+        Replaces our copy of the associations in a bucket with the peer's.
+
+        :param peer: The peer to fetch the bucket from.
+        :type peer: sydent.replication.peer.RemotePeer
+        :param bucket: The bucket to repair.
+        :type bucket: int
+        """
+        remote = yield self._postToPeer(
+            peer,
+            "hashtree/bucket",
+            {"origin_server": peer.servername, "bucket": bucket},
+        )
+        theirs = {int(k): v for k, v in remote.get("sgAssocs", {}).items()}
+
+        ours = self.assocStore.getSignedAssociationsInOriginIdRange(
+            peer.servername, bucket * BUCKET_SIZE, (bucket + 1) * BUCKET_SIZE - 1
+        )
+        ours = {k: json_decoder.decode(v) for k, v in ours.items()}
+
+        to_remove = [k for k in ours if ours[k] != theirs.get(k)]
+        to_add = [k for k in theirs if theirs[k] != ours.get(k)]
+
+        # Check every signature before touching anything, so a bad response from the
+        # peer can't leave the bucket half-repaired.
+        for origin_id in to_add:
+            peer.verifySignedAssociation(theirs[origin_id])
+
+        self.assocStore.removeAssociationsFromServer(
+            peer.servername, to_remove, commit=False
+        )
+
+        pepper = self.hashing_store.get_lookup_pepper()
+        now = time_msec()
+        for origin_id in to_add:
+            assoc = threePidAssocFromDict(theirs[origin_id])
+            # Don't bring back associations we've already reaped because they
+            # expired, the peer will reap its copy too.
+            if assoc.mxid is None or assoc.not_after <= now:
+                continue
+            str_to_hash = " ".join([assoc.address, assoc.medium, pepper])
+            assoc.lookup_hash = sha256_and_url_safe_base64(str_to_hash)
+            self.assocStore.addAssociation(
+                assoc,
+                json.dumps(theirs[origin_id]),
+                peer.servername,
+                origin_id,
+                commit=False,
+            )
+
+        self.sydent.db.commit()
+
+        repaired_associations.labels(peer.servername, "remove").inc(len(to_remove))
+        repaired_associations.labels(peer.servername, "add").inc(len(to_add))
+        logger.info(
+            "Repaired bucket %d of associations from %s: removed %d, added %d",
+            bucket,
+            peer.servername,
+            len(to_remove),
+            len(to_add),
+        )
+
+    @defer.inlineCallbacks
+    def _postToPeer(self, peer, path, body):
+        """
+        Sends a request to one of the peer's hash tree endpoints.
+
+        :param peer: The peer to send the request to.
+        :type peer: sydent.replication.peer.RemotePeer
+        :param path: The path of the endpoint, relative to the replication API.
+        :type path: str
+        :param body: The body of the request.
+        :type body: dict[str, any]
+
+        :return: The body of the peer's response.
+        :rtype: twisted.internet.defer.Deferred[dict[str, any]]
+        """
+        uri = peer.base_replication_url + "_matrix/identity/replicate/v1/" + path
+        response = yield self.sydent.replicationHttpsClient.postJson(uri, body)
+        response_body = yield read_body_with_max_size(
+            response, MAX_HASHTREE_RESPONSE_SIZE
+        )
+        if response.code != 200:
+            raise Exception(
+                "Got %d response from %s: %r" % (response.code, uri, response_body)
+            )
+        return json_decoder.decode(response_body.decode("UTF-8"))
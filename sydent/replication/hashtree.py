@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A hash tree over the global associations table, used to cheaply find out whether
+(and where) two servers disagree about the associations created by a given server.
+
+The associations from each origin server are split into buckets of BUCKET_SIZE
+consecutive origin IDs. Each bucket has a digest, which is the XOR of the digests of
+the associations in it, and a count, both maintained by GlobalAssociationStore as
+rows are added and removed.
+
+The buckets are the leaves of a tree with a fan-out of FANOUT and a fixed depth of
+DEPTH, so that two servers always agree on its shape: the node at a given level and
+index covers FANOUT ** level buckets, starting with bucket index * FANOUT ** level.
+The digest of a node is the XOR of the digests of the buckets it covers, so comparing
+the roots tells whether two servers agree, and descending into children that differ
+finds the buckets that need repairing in at most DEPTH round-trips.
+"""
+
+import hashlib
+
+# Number of consecutive origin IDs in each bucket
+BUCKET_SIZE = 1024
+
+# Number of children of each node of the tree
+FANOUT = 16
+
+# Level of the root of the tree, which covers FANOUT ** DEPTH buckets
+DEPTH = 8
+
+
+def association_digest(origin_id, medium, address, mxid, ts):
+    """
+    Computes the digest of an association from the global associations table, as a
+    signed 64-bit integer so it can be stored and XORed in SQLite.
+
+    :param origin_id: The ID of the association on its origin server.
+    :type origin_id: int
+    :param medium: The medium of the association's 3PID.
+    :type medium: unicode
+    :param address: The address of the association's 3PID.
+    :type address: unicode
+    :param mxid: The MXID of the association.
+    :type mxid: unicode
+    :param ts: The creation timestamp of the association.
+    :type ts: int
+
+    :return: The digest of the association.
+    :rtype: int
+    """
+    s = "%d\x00%s\x00%s\x00%s\x00%d" % (int(origin_id), medium, address, mxid, ts)
+    digest = hashlib.sha256(s.encode("utf8")).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+def bucket_for_origin_id(origin_id):
+    """
+    :param origin_id: The ID of an association on its origin server.
+    :type origin_id: int
+
+    :return: The index of the bucket the association belongs to.
+    :rtype: int
+    """
+    return int(origin_id) // BUCKET_SIZE
+
+
+def node_bucket_range(level, index):
+    """
+    :param level: The level of the node, 0 being the buckets themselves.
+    :type level: int
+    :param index: The index of the node within its level.
+    :type index: int
+
+    :return: The first and last (inclusive) buckets covered by the node.
+    :rtype: tuple[int, int]
+    """
+    width = FANOUT**level
+    return index * width, (index + 1) * width - 1
+
+
+def node_children(level, index):
+    """
+    :param level: The level of the node. Must be greater than 0.
+    :type level: int
+    :param index: The index of the node within its level.
+    :type index: int
+
+    :return: The (level, index) of each of the node's children.
+    :rtype: list[tuple[int, int]]
+    """
+    return [(level - 1, index * FANOUT + i) for i in range(FANOUT)]
+
+
+def is_valid_node(level, index):
+    """
+    :return: Whether the given level and index designate a node of the tree.
+    :rtype: bool
+    """
+    return 0 <= level <= DEPTH and 0 <= index < FANOUT ** (DEPTH - level)
+
+
+def encode_digest(digest):
+    """Encodes a node's digest for the wire, as a fixed-length hex string."""
+    return "%016x" % (digest & 0xFFFFFFFFFFFFFFFF,)
+
+
+def compute_nodes(assoc_store, origin_server, nodes):
+    """
+    Computes the digest and count of the given nodes of an origin server's tree.
+
+    :param assoc_store: The store to read the buckets from.
+    :type assoc_store: sydent.db.threepid_associations.GlobalAssociationStore
+    :param origin_server: The server whose associations the tree covers.
+    :type origin_server: unicode
+    :param nodes: The (level, index) of each node to compute.
+    :type nodes: list[tuple[int, int]]
+
+    :return: The encoded digest and the count of each node.
+    :rtype: dict[tuple[int, int], tuple[str, int]]
+    """
+    results = {}
+    for level, index in nodes:
+        first, last = node_bucket_range(level, index)
+        digest = 0
+        count = 0
+        for bucket_digest, bucket_count in assoc_store.getHashBuckets(
+            origin_server, first, last
+        ).values():
+            digest ^= bucket_digest
+            count += bucket_count
+        results[(level, index)] = (encode_digest(digest), count)
+    return results
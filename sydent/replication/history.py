@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import logging
+
+from prometheus_client import Counter
+from twisted.internet import defer, task
+
+from sydent.db.compaction_progress import CompactionProgressStore
+from sydent.db.threepid_associations import GlobalAssociationStore
+
+logger = logging.getLogger(__name__)
+
+# Number of rows of the global associations table to look at in each transaction
+HISTORY_COMPACTION_BATCH_SIZE = 1000
+
+# The name the compaction's progress is recorded under
+HISTORY_COMPACTION_NAME = "global_threepid_associations_history"
+
+history_compacted = Counter(
+    "sydent_global_associations_history_compacted_total",
+    "Number of superseded global associations deleted",
+)
+
+
+class HistoryCompactor:
+    """
+    Every bind of a 3PID adds a row to the global associations table, while lookups
+    only ever return the newest valid one. This periodically goes through the table
+    in small batches and deletes the rows that have been superseded, so that its
+    size tracks the number of live bindings rather than the whole history.
+
+    Progress is recorded after every batch so that a pass carries on where it left
+    off after a restart. Each pass goes through the whole table, since a new row can
+    supersede rows anywhere before it.
+    """
+
+    def __init__(self, sydent):
+        self.sydent = sydent
+        self.globalAssocStore = GlobalAssociationStore(self.sydent)
+        self.progressStore = CompactionProgressStore(self.sydent)
+        self.compacting = False
+
+    def setup(self):
+        interval = self.sydent.cfg.getint(
+            "general", "associations.history_compaction_interval"
+        )
+        if interval <= 0:
+            return
+
+        cb = task.LoopingCall(self.compact)
+        cb.clock = self.sydent.reactor
+        cb.start(interval, now=False)
+
+    @defer.inlineCallbacks
+    def compact(self):
+        """
+        Carries on the current pass through the global associations table until it
+        reaches the end of the table.
+
+        :return: The number of associations deleted.
+        :rtype: twisted.internet.defer.Deferred[int]
+        """
+        if self.compacting:
+            return 0
+
+        self.compacting = True
+        total = 0
+        try:
+            lastId = self.progressStore.getLastId(HISTORY_COMPACTION_NAME)
+            while True:
+                lastId, count = self.globalAssocStore.removeSupersededAssociations(
+                    lastId, HISTORY_COMPACTION_BATCH_SIZE
+                )
+                if lastId is None:
+                    # We've reached the end of the table, start over next time.
+                    self.progressStore.setLastId(HISTORY_COMPACTION_NAME, -1)
+                    break
+
+                self.progressStore.setLastId(HISTORY_COMPACTION_NAME, lastId)
+                total += count
+                history_compacted.inc(count)
+
+                # Let the reactor serve requests between batches.
+                yield task.deferLater(self.sydent.reactor, 0, lambda: None)
+
+            if total:
+                logger.info("Deleted %d superseded global associations", total)
+        except Exception:
+            logger.exception("Error compacting global associations")
+        finally:
+            self.compacting = False
+
+        return total
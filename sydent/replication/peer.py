@@ -22,6 +22,7 @@ from sydent.db.threepid_associations import GlobalAssociationStore
 from sydent.db.hashing_metadata import HashingMetadataStore
 from sydent.threepid import threePidAssocFromDict
 from sydent.config import ConfigError
+from sydent.replication.wire import SGASSOCS_CONTENT_TYPE, encode_sg_assocs
 from sydent.util import json_decoder
 from sydent.util.hash import sha256_and_url_safe_base64
 from unpaddedbase64 import decode_base64
@@ -148,6 +149,7 @@ class RemotePeer(Peer):
         if replication_url[-1:] != "/":
             replication_url += "/"
 
+        self.base_replication_url = replication_url
         replication_url += "_matrix/identity/replicate/v1/push"
         self.replication_url = replication_url
 
@@ -217,16 +219,23 @@ class RemotePeer(Peer):
         :return: A deferred which results in the response to the push request.
         :rtype: twisted.internet.defer.Deferred[twisted.web.iweb.IResponse]
         """
-        body = {"sgAssocs": sgAssocs}
-
-        reqDeferred = self.sydent.replicationHttpsClient.postJson(
-            self.replication_url, body
-        )
+        client = self.sydent.replicationHttpsClient
+
+        # Use the binary framing if the peer has told us it understands it, as it
+        # saves it from parsing and serialising every association again.
+        if client.acceptsContentType(self.replication_url, SGASSOCS_CONTENT_TYPE):
+            reqDeferred = client.post(
+                self.replication_url,
+                encode_sg_assocs(sgAssocs),
+                SGASSOCS_CONTENT_TYPE,
+            )
+        else:
+            body = {"sgAssocs": sgAssocs}
+            reqDeferred = client.postJson(self.replication_url, body)
 
-        # XXX: We'll also need to prune the deleted associations out of the
-        # local associations table once they've been replicated to all peers
-        # (ie. remove the record we kept in order to propagate the deletion to
-        # other peers).
+        # Deleted associations are pruned out of the local associations table
+        # once they've been replicated to all peers, see
+        # sydent.replication.tombstones.
 
         updateDeferred = defer.Deferred()
 
@@ -247,7 +256,10 @@ class RemotePeer(Peer):
         :type updateDeferred: twisted.internet.defer.Deferred
         """
         if result.code >= 200 and result.code < 300:
-            updateDeferred.callback(result)
+            # Read the body so the connection can be returned to the pool and
+            # reused for the next push.
+            d = readBody(result)
+            d.addBoth(lambda _: updateDeferred.callback(result))
         else:
             d = readBody(result)
             d.addCallback(self._failedPushBodyRead, updateDeferred=updateDeferred)
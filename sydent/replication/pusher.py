@@ -25,7 +25,6 @@ import twisted.internet.task
 from sydent.util import time_msec
 from sydent.replication.peer import LocalPeer
 from sydent.db.threepid_associations import LocalAssociationStore
-from sydent.db.peers import PeerStore
 
 logger = logging.getLogger(__name__)
 
@@ -37,7 +36,13 @@ class Pusher:
     def __init__(self, sydent):
         self.sydent = sydent
         self.pushing = False
-        self.peerStore = PeerStore(self.sydent)
+        self.peers_being_pushed_to = set()
+        self.push_window = self.sydent.cfg.getint("general", "replication.push_window")
+        if self.push_window < 1:
+            raise Exception(
+                "replication.push_window must be at least 1, got %d"
+                % (self.push_window,)
+            )
         self.local_assoc_store = LocalAssociationStore(self.sydent)
 
     def setup(self):
@@ -68,61 +73,280 @@ class Pusher:
         resolve when pushing to that peer has completed, successfully or otherwise
         :rtype deferred.DeferredList
         """
-        peers = self.peerStore.getAllPeers()
+        peers = self.sydent.peerRegistry.getAllPeers()
+
+        max_id = self.local_assoc_store.getMaxId() or 0
+        for p in peers:
+            self.sydent.replicationStats.setBacklog(
+                p.servername, max(0, max_id - (p.lastSentVersion or 0))
+            )
 
         # Push to all peers in parallel
         return defer.DeferredList([self._push_to_peer(p) for p in peers])
 
-    @defer.inlineCallbacks
     def _push_to_peer(self, p):
         """
-        For a given peer, retrieves the list of associations that were created since
-        the last successful push to this peer (limited to ASSOCIATIONS_PUSH_LIMIT) and
-        sends them.
+        For a given peer, sends the associations that were created since the last
+        successful push to this peer, in batches of at most ASSOCIATIONS_PUSH_LIMIT,
+        keeping up to replication.push_window batches in flight at once.
 
         :param p: The peer to send associations to.
         :type p: sydent.replication.peer.RemotePeer
+
+        :return: A deferred which resolves once there is nothing left to push to the
+            peer, or pushing to it failed.
+        :rtype: twisted.internet.defer.Deferred
         """
         logger.debug("Looking for updates to push to %s", p.servername)
 
-        # Check if a push operation is already active. If so, don't start another
-        if p.is_being_pushed_to:
+        # Check if a push operation is already active. If so, don't start another.
+        # The registry can replace a peer's object while a push to it is in flight,
+        # so this needs to be tracked here rather than on the peer.
+        if p.servername in self.peers_being_pushed_to:
             logger.debug("Waiting for %s:%d to finish pushing...", p.servername, p.port)
-            return
+            return defer.succeed(None)
 
+        self.peers_being_pushed_to.add(p.servername)
         p.is_being_pushed_to = True
 
+        def _finished(res):
+            # Whether pushing completed or an error occurred, signal that pushing has
+            # finished
+            self.peers_being_pushed_to.discard(p.servername)
+            p.is_being_pushed_to = False
+            return res
+
+        d = _PushWindow(self, p, self.push_window).start()
+        d.addBoth(_finished)
+        return d
+
+
+class _PushBatch(object):
+    """A batch of associations pushed to a peer as a single request."""
+
+    def __init__(self, count, last_id, threepids, sent_at):
+        # The number of associations in the batch
+        self.count = count
+        # The highest ID in the batch
+        self.last_id = last_id
+        # The (medium, address) of every association in the batch
+        self.threepids = threepids
+        # When the batch was sent, as given by the reactor's clock
+        self.sent_at = sent_at
+        self.acked = False
+
+
+class _PushWindow(object):
+    """
+    Pushes the pending associations to a peer, with up to window_size batches in
+    flight at once so that throughput to distant peers isn't bound by round-trip
+    time.
+
+    Batches can be acknowledged in any order, but the peer's last sent version is
+    only advanced over the prefix of batches that have all been acknowledged, so a
+    failed batch gets sent again on the next scheduled push along with everything
+    after it.
+
+    The peer applies each batch as it receives it. To keep the changes to a given
+    3PID in order, a batch is never sent while a batch containing one of the same
+    3PIDs is still in flight; it is cut short instead, and the rest waits for the
+    earlier batch to be acknowledged.
+    """
+
+    def __init__(self, pusher, peer, window_size):
+        self.pusher = pusher
+        self.peer = peer
+        self.window_size = window_size
+
+        # The highest ID we've read from the local associations table so far
+        self.last_read_id = peer.lastSentVersion
+        # The batches sent but not yet part of the acknowledged prefix, in order
+        self.batches = []
+        self.in_flight = 0
+
+        self.exhausted = False
+        self.failed = False
+
+        self.filling = False
+        self.refill = False
+
+        self.done = defer.Deferred()
+
+    def start(self):
+        self._fill()
+        return self.done
+
+    def _fill(self):
+        """Sends batches until the window is full or there's nothing left to send."""
+        # Pushes can complete synchronously, in which case _fill gets called again
+        # from within the loop below. Just make the outer call go round again.
+        if self.filling:
+            self.refill = True
+            return
+
+        self.filling = True
         try:
-            # Push associations
-            (
-                assocs,
-                latest_assoc_id,
-            ) = self.local_assoc_store.getSignedAssociationsAfterId(
-                p.lastSentVersion, ASSOCIATIONS_PUSH_LIMIT
-            )
+            self.refill = True
+            while self.refill:
+                self.refill = False
+                while (
+                    not self.exhausted
+                    and not self.failed
+                    and self.in_flight < self.window_size
+                ):
+                    try:
+                        if not self._send_next_batch():
+                            break
+                    except Exception:
+                        logger.exception(
+                            "Error pushing updates to %s:%d",
+                            self.peer.servername,
+                            self.peer.port,
+                        )
+                        self.failed = True
+        finally:
+            self.filling = False
 
-            # If there are no updates left to send, break the loop
-            if not assocs:
-                return
+        self._maybe_finish()
 
-            logger.info(
-                "Pushing %d updates to %s:%d", len(assocs), p.servername, p.port
-            )
-            result = yield p.pushUpdates(assocs)
+    def _send_next_batch(self):
+        """
+        Reads the next batch of associations and sends it to the peer.
 
-            yield self.peerStore.setLastSentVersionAndPokeSucceeded(
-                p.servername, latest_assoc_id, time_msec()
-            )
+        :return: Whether a batch was sent.
+        :rtype: bool
+        """
+        (
+            assocs,
+            latest_assoc_id,
+        ) = self.pusher.local_assoc_store.getSignedAssociationsAfterId(
+            self.last_read_id, ASSOCIATIONS_PUSH_LIMIT
+        )
+
+        # If there are no updates left to send, we're done
+        if not assocs:
+            self.exhausted = True
+            return False
+
+        in_flight_threepids = set()
+        for batch in self.batches:
+            if not batch.acked:
+                in_flight_threepids.update(batch.threepids)
+
+        batch_assocs = {}
+        threepids = set()
+        for assoc_id in sorted(assocs):
+            threepid = (assocs[assoc_id]["medium"], assocs[assoc_id]["address"])
+            if threepid in in_flight_threepids:
+                break
+            batch_assocs[assoc_id] = assocs[assoc_id]
+            threepids.add(threepid)
+            latest_assoc_id = assoc_id
 
-            logger.info(
-                "Pushed updates to %s:%d with result %d %s",
-                p.servername,
-                p.port,
-                result.code,
-                result.phrase,
+        if not batch_assocs:
+            logger.debug(
+                "Waiting for an earlier push to %s:%d to be acknowledged",
+                self.peer.servername,
+                self.peer.port,
             )
+            return False
+
+        batch = _PushBatch(
+            len(batch_assocs),
+            latest_assoc_id,
+            threepids,
+            self.pusher.sydent.reactor.seconds(),
+        )
+        self.batches.append(batch)
+        self.last_read_id = latest_assoc_id
+        self.in_flight += 1
+
+        logger.info(
+            "Pushing %d updates to %s:%d",
+            len(batch_assocs),
+            self.peer.servername,
+            self.peer.port,
+        )
+
+        d = self.peer.pushUpdates(batch_assocs)
+        d.addCallbacks(
+            self._push_succeeded,
+            self._push_failed,
+            callbackArgs=(batch,),
+            errbackArgs=(batch,),
+        )
+        return True
+
+    def _push_succeeded(self, result, batch):
+        self.in_flight -= 1
+        batch.acked = True
+
+        self.pusher.sydent.replicationStats.pushSucceeded(
+            self.peer.servername,
+            batch.count,
+            self.pusher.sydent.reactor.seconds() - batch.sent_at,
+            time_msec(),
+        )
+
+        logger.info(
+            "Pushed updates to %s:%d with result %d %s",
+            self.peer.servername,
+            self.peer.port,
+            result.code,
+            result.phrase,
+        )
+
+        try:
+            self._advance()
         except Exception:
-            logger.exception("Error pushing updates to %s:%d", p.servername, p.port)
-        finally:
-            # Whether pushing completed or an error occurred, signal that pushing has finished
-            p.is_being_pushed_to = False
+            logger.exception(
+                "Error recording push to %s:%d", self.peer.servername, self.peer.port
+            )
+            self.failed = True
+
+        self._fill()
+
+    def _push_failed(self, failure, batch):
+        self.in_flight -= 1
+        self.failed = True
+
+        self.pusher.sydent.replicationStats.pushFailed(self.peer.servername)
+
+        logger.error(
+            "Error pushing updates to %s:%d",
+            self.peer.servername,
+            self.peer.port,
+            exc_info=(failure.type, failure.value, failure.getTracebackObject()),
+        )
+
+        self._maybe_finish()
+
+    def _advance(self):
+        """
+        Advances the peer's last sent version over the batches at the start of the
+        window which have all been acknowledged.
+        """
+        last_acked_id = None
+        while self.batches and self.batches[0].acked:
+            last_acked_id = self.batches.pop(0).last_id
+
+        if last_acked_id is None:
+            return
+
+        self.pusher.sydent.peerRegistry.setLastSentVersionAndPokeSucceeded(
+            self.peer.servername, last_acked_id, time_msec()
+        )
+        self.peer.lastSentVersion = last_acked_id
+
+        # The table can have been emptied (e.g. by reaping expired associations)
+        # since the batch was sent.
+        max_id = self.pusher.local_assoc_store.getMaxId() or 0
+        self.pusher.sydent.replicationStats.setBacklog(
+            self.peer.servername, max(0, max_id - last_acked_id)
+        )
+
+    def _maybe_finish(self):
+        # Anything left unsent is either blocked on a batch in flight, or will be
+        # picked up by the next scheduled push.
+        if not self.filling and self.in_flight == 0 and not self.done.called:
+            self.done.callback(None)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import logging
+
+from sydent.db.peers import PeerStore
+
+logger = logging.getLogger(__name__)
+
+
+class PeerRegistry:
+    """
+    Keeps the active replication peers in memory, so that their verify keys are only
+    decoded and their replication URLs only built when something about them changes,
+    rather than on every scheduled push and every incoming request.
+
+    Peers are reloaded from the database when another connection (e.g. an admin
+    editing the peers tables, or the snapshot tools) has committed a change to it,
+    or when the peers' sections of the config change. Call invalidate() after
+    changing the peers tables through Sydent's own connection.
+    """
+
+    def __init__(self, sydent):
+        self.sydent = sydent
+        self.peerStore = PeerStore(self.sydent)
+
+        self._peers = None
+        self._data_version = None
+        self._config_fingerprint = None
+
+    def getAllPeers(self):
+        """
+        :return: All of the active remote peers this server knows about.
+        :rtype: list[sydent.replication.peer.RemotePeer]
+        """
+        self._maybeReload()
+        return list(self._peers.values())
+
+    def getPeerByName(self, name):
+        """
+        :param name: The server name of the peer.
+        :type name: unicode
+
+        :return: The active peer with this name, or None if there isn't one.
+        :rtype: sydent.replication.peer.RemotePeer or None
+        """
+        self._maybeReload()
+        return self._peers.get(name)
+
+    def setLastSentVersionAndPokeSucceeded(
+        self, peerName, lastSentVersion, lastPokeSucceeded
+    ):
+        """
+        Sets the ID of the last association sent to a given peer and the time of the
+        last successful request sent to that peer, both in the database and in memory.
+
+        :param peerName: The server name of the peer.
+        :type peerName: unicode
+        :param lastSentVersion: The ID of the last association sent to that peer.
+        :type lastSentVersion: int
+        :param lastPokeSucceeded: The timestamp in milliseconds of the last successful
+            request sent to that peer.
+        :type lastPokeSucceeded: int
+        """
+        self.peerStore.setLastSentVersionAndPokeSucceeded(
+            peerName, lastSentVersion, lastPokeSucceeded
+        )
+
+        if self._peers is not None and peerName in self._peers:
+            self._peers[peerName].lastSentVersion = lastSentVersion
+
+    def invalidate(self):
+        """Makes the next lookup reload the peers from the database."""
+        self._peers = None
+
+    def _maybeReload(self):
+        # data_version changes whenever another connection commits to the
+        # database, and is cheap to read.
+        cur = self.sydent.db.cursor()
+        data_version = cur.execute("PRAGMA data_version").fetchone()[0]
+        config_fingerprint = self._configFingerprint()
+
+        if (
+            self._peers is not None
+            and data_version == self._data_version
+            and config_fingerprint == self._config_fingerprint
+        ):
+            return
+
+        self._peers = {p.servername: p for p in self.peerStore.getAllPeers()}
+        self._data_version = data_version
+        self._config_fingerprint = config_fingerprint
+
+        logger.info("Loaded %d replication peers", len(self._peers))
+
+    def _configFingerprint(self):
+        """
+        :return: The config sections which change how we talk to peers.
+        :rtype: tuple
+        """
+        cfg = self.sydent.cfg
+        return tuple(
+            (section, tuple(sorted(cfg.items(section))))
+            for section in cfg.sections()
+            if section.startswith("peer.")
+        )
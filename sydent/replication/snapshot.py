@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tools to bootstrap a new replication peer from a snapshot of our associations,
+rather than having it catch up through incremental pushes.
+
+Bootstrapping a peer happens in three steps:
+
+1. On the origin server, export a snapshot of its local associations:
+
+       python -m sydent.replication.snapshot export /path/to/snapshot.gz
+
+2. On the new peer, import the snapshot into its global associations:
+
+       python -m sydent.replication.snapshot import /path/to/snapshot.gz
+
+3. On the origin server, record that the new peer has every association up to the
+   snapshot's high-water mark, so that incremental pushes resume from there:
+
+       python -m sydent.replication.snapshot mark-sent new.peer.name /path/to/snapshot.gz
+
+The new peer should be added to the origin server's ``peers`` table as inactive
+until the last step has been run, otherwise the origin server will start pushing
+its whole history to it.
+"""
+from __future__ import absolute_import
+
+import argparse
+import gzip
+import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from sydent.db.hashing_metadata import HashingMetadataStore
+from sydent.db.peers import PeerStore
+from sydent.db.sqlitedb import SqliteDatabase
+from sydent.db.threepid_associations import (
+    GlobalAssociationStore,
+    LocalAssociationStore,
+)
+from sydent.sign.ed25519 import SydentEd25519
+from sydent.threepid import threePidAssocFromDict
+from sydent.util import json_decoder, time_msec
+from sydent.util.hash import sha256_and_url_safe_base64
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = "org.matrix.sydent.snapshot"
+SNAPSHOT_VERSION = 1
+
+# Default number of associations to write in each chunk of a snapshot
+DEFAULT_CHUNK_SIZE = 1000
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def export_snapshot(sydent, path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Writes every local association up to the current high-water mark to a gzipped
+    snapshot file, signed with our signing key.
+
+    The file is made of JSON lines: a header giving the origin server and the
+    high-water mark, followed by chunks of signed associations keyed by their ID,
+    in the same format as the body of a replication push.
+
+    Associations created or replaced while the export is running get an ID above the
+    high-water mark, so they are left to incremental pushes. Rows superseded during
+    the export may be missing from the snapshot, but their replacements are then
+    above the high-water mark, so the snapshot followed by incremental pushes always
+    converges to our current state.
+
+    :param sydent: The Sydent instance to export the associations of.
+    :type sydent: sydent.sydent.Sydent
+    :param path: The path of the file to write the snapshot to.
+    :type path: str
+    :param chunk_size: The number of associations to write per chunk.
+    :type chunk_size: int
+
+    :return: The high-water mark of the snapshot, ie. the highest ID it can include,
+        or None if there was no association to export.
+    :rtype: int or None
+    """
+    cur = sydent.db.cursor()
+    res = cur.execute("SELECT max(id) FROM local_threepid_associations")
+    high_water_mark = res.fetchone()[0]
+
+    local_assoc_store = LocalAssociationStore(sydent)
+
+    with gzip.open(path, "wt", encoding="utf8") as f:
+        header = {
+            "format": SNAPSHOT_FORMAT,
+            "version": SNAPSHOT_VERSION,
+            "origin_server": sydent.server_name,
+            "high_water_mark": high_water_mark,
+        }
+        f.write(json.dumps(header) + "\n")
+
+        last_id = -1
+        count = 0
+        while high_water_mark is not None and last_id < high_water_mark:
+            sg_assocs, max_id = local_assoc_store.getSignedAssociationsAfterId(
+                last_id, chunk_size
+            )
+            if max_id is None:
+                break
+
+            sg_assocs = {k: v for k, v in sg_assocs.items() if k <= high_water_mark}
+            if sg_assocs:
+                f.write(json.dumps({"sgAssocs": sg_assocs}) + "\n")
+                count += len(sg_assocs)
+
+            last_id = max_id
+
+    logger.info(
+        "Exported %d associations up to ID %s to %s", count, high_water_mark, path
+    )
+
+    return high_water_mark
+
+
+def read_snapshot_header(path):
+    """
+    Reads the header of a snapshot file.
+
+    :param path: The path of the snapshot file.
+    :type path: str
+
+    :return: The snapshot's header.
+    :rtype: dict[str, any]
+
+    :raises SnapshotError: if the file isn't a snapshot we understand.
+    """
+    with gzip.open(path, "rt", encoding="utf8") as f:
+        return _parse_header(f.readline())
+
+
+def import_snapshot(sydent, path, workers=4):
+    """
+    Loads the associations in a snapshot file into the global associations table.
+
+    The signatures on the associations are checked against the origin server's
+    key, which must be known to us as a peer. Each chunk of the snapshot is verified
+    in parallel and stored in a single transaction, which is rolled back if storing
+    any of its associations fails; the import stops at the first chunk containing an
+    association that doesn't verify.
+
+    :param sydent: The Sydent instance to import the associations into.
+    :type sydent: sydent.sydent.Sydent
+    :param path: The path of the snapshot file.
+    :type path: str
+    :param workers: The number of threads to verify signatures with.
+    :type workers: int
+
+    :return: The number of associations imported.
+    :rtype: int
+
+    :raises SnapshotError: if the snapshot can't be imported.
+    """
+    global_assoc_store = GlobalAssociationStore(sydent)
+    pepper = HashingMetadataStore(sydent).get_lookup_pepper()
+
+    count = 0
+    with gzip.open(path, "rt", encoding="utf8") as f, ThreadPoolExecutor(
+        max_workers=workers
+    ) as executor:
+        header = _parse_header(f.readline())
+        origin_server = header["origin_server"]
+
+        peer = PeerStore(sydent).getPeerByName(origin_server)
+        if peer is None:
+            raise SnapshotError(
+                "Snapshot was exported by %s, which is not a known peer"
+                % (origin_server,)
+            )
+
+        def verify(item):
+            try:
+                peer.verifySignedAssociation(item[1])
+                return None
+            except Exception as e:
+                logger.warning(
+                    "Failed to verify association %s from %s: %s",
+                    item[0],
+                    origin_server,
+                    e,
+                )
+                return item[0]
+
+        for line in f:
+            chunk = json_decoder.decode(line)
+            sg_assocs = sorted(chunk["sgAssocs"].items(), key=lambda k: int(k[0]))
+
+            failed_ids = [i for i in executor.map(verify, sg_assocs) if i is not None]
+            if failed_ids:
+                raise SnapshotError(
+                    "Verification failed for associations %s" % (failed_ids,)
+                )
+
+            try:
+                for origin_id, sg_assoc in sg_assocs:
+                    assoc = threePidAssocFromDict(sg_assoc)
+
+                    if assoc.mxid is None:
+                        global_assoc_store.removeAssociation(
+                            assoc.medium, assoc.address, commit=False
+                        )
+                        continue
+
+                    str_to_hash = " ".join([assoc.address, assoc.medium, pepper])
+                    assoc.lookup_hash = sha256_and_url_safe_base64(str_to_hash)
+
+                    global_assoc_store.addAssociation(
+                        assoc,
+                        json.dumps(sg_assoc),
+                        origin_server,
+                        int(origin_id),
+                        commit=False,
+                    )
+            except Exception:
+                # Don't leave the chunk half-imported.
+                sydent.db.rollback()
+                raise
+
+            sydent.db.commit()
+            count += len(sg_assocs)
+
+    logger.info("Imported %d associations from %s", count, origin_server)
+
+    return count
+
+
+def mark_snapshot_sent(sydent, peer_name, path):
+    """
+    Records that a peer has imported a snapshot, so that incremental pushes to it
+    carry on from the snapshot's high-water mark. Never moves a peer backwards.
+
+    :param sydent: The Sydent instance the snapshot was exported from.
+    :type sydent: sydent.sydent.Sydent
+    :param peer_name: The server name of the peer which imported the snapshot.
+    :type peer_name: unicode
+    :param path: The path of the snapshot file.
+    :type path: str
+
+    :return: The peer's new last sent version.
+    :rtype: int or None
+
+    :raises SnapshotError: if the snapshot wasn't exported by this server.
+    """
+    header = read_snapshot_header(path)
+    if header["origin_server"] != sydent.server_name:
+        raise SnapshotError(
+            "Snapshot was exported by %s, not by this server (%s)"
+            % (header["origin_server"], sydent.server_name)
+        )
+
+    cur = sydent.db.cursor()
+    res = cur.execute("SELECT lastSentVersion FROM peers WHERE name = ?", (peer_name,))
+    row = res.fetchone()
+    if row is None:
+        raise SnapshotError("Unknown peer %s" % (peer_name,))
+
+    last_sent = row[0]
+    high_water_mark = header["high_water_mark"]
+    if high_water_mark is not None and (
+        last_sent is None or last_sent < high_water_mark
+    ):
+        PeerStore(sydent).setLastSentVersionAndPokeSucceeded(
+            peer_name, high_water_mark, time_msec()
+        )
+        last_sent = high_water_mark
+
+    return last_sent
+
+
+def _parse_header(line):
+    try:
+        header = json_decoder.decode(line)
+    except ValueError:
+        raise SnapshotError("Not a snapshot file")
+
+    if not isinstance(header, dict) or header.get("format") != SNAPSHOT_FORMAT:
+        raise SnapshotError("Not a snapshot file")
+    if header.get("version") != SNAPSHOT_VERSION:
+        raise SnapshotError(
+            "Unsupported snapshot version %r" % (header.get("version"),)
+        )
+
+    return header
+
+
+class _SnapshotTool(object):
+    """The parts of a Sydent instance the snapshot tools need, without starting any
+    of the servers or background tasks.
+    """
+
+    def __init__(self, cfg, config_file):
+        self.cfg = cfg
+        self.config_file = config_file
+        self.db = SqliteDatabase(self).db
+        self.server_name = cfg.get("general", "server.name")
+
+        self.keyring = _Keyring()
+        self.keyring.ed25519 = SydentEd25519(self).signing_key
+        self.keyring.ed25519.alg = "ed25519"
+
+    def save_config(self):
+        with open(self.config_file, "w") as fp:
+            self.cfg.write(fp)
+
+
+class _Keyring:
+    pass
+
+
+def main(argv):
+    from sydent.sydent import get_config_file_path, parse_config_file
+
+    parser = argparse.ArgumentParser(
+        description="Export or import a snapshot of associations to bootstrap a "
+        "replication peer."
+    )
+    sub = parser.add_subparsers(dest="command")
+    sub.required = True
+
+    export_parser = sub.add_parser("export", help="Export our local associations")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+
+    import_parser = sub.add_parser("import", help="Import a peer's snapshot")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--workers", type=int, default=4)
+
+    mark_parser = sub.add_parser(
+        "mark-sent", help="Record that a peer has imported our snapshot"
+    )
+    mark_parser.add_argument("peer")
+    mark_parser.add_argument("path")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    config_file = get_config_file_path()
+    tool = _SnapshotTool(parse_config_file(config_file), config_file)
+
+    try:
+        if args.command == "export":
+            export_snapshot(tool, args.path, args.chunk_size)
+        elif args.command == "import":
+            import_snapshot(tool, args.path, args.workers)
+        else:
+            last_sent = mark_snapshot_sent(tool, args.peer, args.path)
+            logger.info("Last sent version for %s is now %s", args.peer, last_sent)
+    except SnapshotError as e:
+        logger.error("%s", e)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import collections
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Period (in seconds) over which the association rates in the status are computed
+RATE_WINDOW = 60
+
+peer_backlog = Gauge(
+    "sydent_replication_peer_backlog",
+    "Number of local association IDs not yet sent to a peer",
+    ["peer"],
+)
+peer_last_push_success = Gauge(
+    "sydent_replication_peer_last_push_success_timestamp_seconds",
+    "Time of the last push a peer acknowledged",
+    ["peer"],
+)
+push_batch_duration = Histogram(
+    "sydent_replication_push_batch_duration_seconds",
+    "Time between sending a batch of associations to a peer and its acknowledgement",
+    ["peer"],
+)
+associations_sent = Counter(
+    "sydent_replication_associations_sent_total",
+    "Number of associations pushed to a peer and acknowledged",
+    ["peer"],
+)
+associations_received = Counter(
+    "sydent_replication_associations_received_total",
+    "Number of associations received from a peer and stored",
+    ["peer"],
+)
+push_failures = Counter(
+    "sydent_replication_push_failures_total",
+    "Number of pushes to a peer which failed",
+    ["peer"],
+)
+verification_failures = Counter(
+    "sydent_replication_verification_failures_total",
+    "Number of associations received from a peer whose signature didn't verify",
+    ["peer"],
+)
+
+
+class _PeerStats(object):
+    def __init__(self):
+        self.sent_total = 0
+        self.received_total = 0
+        self.push_failures = 0
+        self.verification_failures = 0
+        self.last_batch_duration = None
+        # (time, count) of the recent pushes, to compute rates from
+        self.recent_sent = collections.deque()
+        self.recent_received = collections.deque()
+
+
+class ReplicationStats:
+    """
+    Keeps track of how replication with each peer is going, both as Prometheus
+    metrics and in memory for the replication status endpoint of the internal API.
+    """
+
+    def __init__(self, sydent):
+        self.sydent = sydent
+        self._peers = collections.defaultdict(_PeerStats)
+
+    def pushSucceeded(self, peerName, count, duration, lastPokeSucceeded):
+        """
+        Records that a peer acknowledged a batch of associations.
+
+        :param peerName: The server name of the peer.
+        :type peerName: unicode
+        :param count: The number of associations in the batch.
+        :type count: int
+        :param duration: The time in seconds the peer took to acknowledge the batch.
+        :type duration: float
+        :param lastPokeSucceeded: The timestamp in milliseconds of the
+            acknowledgement.
+        :type lastPokeSucceeded: int
+        """
+        stats = self._peers[peerName]
+        stats.sent_total += count
+        stats.last_batch_duration = duration
+        self._addRecent(stats.recent_sent, count)
+
+        associations_sent.labels(peerName).inc(count)
+        push_batch_duration.labels(peerName).observe(duration)
+        peer_last_push_success.labels(peerName).set(lastPokeSucceeded / 1000.0)
+
+    def pushFailed(self, peerName):
+        """
+        Records that pushing a batch of associations to a peer failed.
+
+        :param peerName: The server name of the peer.
+        :type peerName: unicode
+        """
+        self._peers[peerName].push_failures += 1
+        push_failures.labels(peerName).inc()
+
+    def associationsReceived(self, peerName, count):
+        """
+        Records that associations pushed by a peer were stored.
+
+        :param peerName: The server name of the peer.
+        :type peerName: unicode
+        :param count: The number of associations.
+        :type count: int
+        """
+        stats = self._peers[peerName]
+        stats.received_total += count
+        self._addRecent(stats.recent_received, count)
+
+        associations_received.labels(peerName).inc(count)
+
+    def verificationFailed(self, peerName, count):
+        """
+        Records that associations pushed by a peer failed to verify.
+
+        :param peerName: The server name of the peer.
+        :type peerName: unicode
+        :param count: The number of associations.
+        :type count: int
+        """
+        self._peers[peerName].verification_failures += count
+        verification_failures.labels(peerName).inc(count)
+
+    def setBacklog(self, peerName, backlog):
+        """
+        :param peerName: The server name of the peer.
+        :type peerName: unicode
+        :param backlog: The number of local association IDs not yet sent to the peer.
+        :type backlog: int
+        """
+        peer_backlog.labels(peerName).set(backlog)
+
+    def getPeerStatus(self, peerName):
+        """
+        :param peerName: The server name of the peer.
+        :type peerName: unicode
+
+        :return: The in-memory statistics about replication with the peer since we
+            started.
+        :rtype: dict[str, any]
+        """
+        stats = self._peers[peerName]
+        return {
+            "sent_total": stats.sent_total,
+            "received_total": stats.received_total,
+            "sent_per_second": self._rate(stats.recent_sent),
+            "received_per_second": self._rate(stats.recent_received),
+            "last_batch_latency_seconds": stats.last_batch_duration,
+            "push_failures": stats.push_failures,
+            "verification_failures": stats.verification_failures,
+        }
+
+    def _addRecent(self, recent, count):
+        recent.append((self.sydent.reactor.seconds(), count))
+        self._expireRecent(recent)
+
+    def _expireRecent(self, recent):
+        cutoff = self.sydent.reactor.seconds() - RATE_WINDOW
+        while recent and recent[0][0] < cutoff:
+            recent.popleft()
+
+    def _rate(self, recent):
+        self._expireRecent(recent)
+        return sum(count for _, count in recent) / float(RATE_WINDOW)
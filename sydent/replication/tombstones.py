@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import logging
+
+from prometheus_client import Counter, Gauge
+from twisted.internet import defer, task
+
+from sydent.db.threepid_associations import LocalAssociationStore
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of tombstones to delete in a single transaction
+TOMBSTONE_COMPACTION_BATCH_SIZE = 500
+
+tombstones = Gauge(
+    "sydent_local_association_tombstones",
+    "Number of local associations recording the deletion of a binding",
+)
+tombstones_compacted = Counter(
+    "sydent_local_association_tombstones_compacted_total",
+    "Number of tombstones deleted once every peer had received them",
+)
+tombstones_compacted_bytes = Counter(
+    "sydent_local_association_tombstones_compacted_bytes_total",
+    "Approximate amount of data (in bytes) held by the tombstones deleted",
+)
+
+
+class TombstoneCompactor:
+    """
+    Deleting a binding leaves a row with a NULL mxid in the local associations table,
+    so that the deletion gets replicated to our peers. Once every active peer has
+    been sent a tombstone it isn't needed any more, so this periodically deletes the
+    tombstones below the lowest last sent version of our active peers.
+    """
+
+    def __init__(self, sydent):
+        self.sydent = sydent
+        self.local_assoc_store = LocalAssociationStore(self.sydent)
+        self.compacting = False
+
+    def setup(self):
+        interval = self.sydent.cfg.getint(
+            "general", "replication.tombstone_compaction_interval"
+        )
+        if interval <= 0:
+            return
+
+        cb = task.LoopingCall(self.compact)
+        cb.clock = self.sydent.reactor
+        cb.start(interval, now=False)
+
+    def getWatermark(self):
+        """
+        :return: The highest ID of a tombstone every active peer has been sent, or
+            None if there is a peer we haven't sent anything to yet.
+        :rtype: int or None
+        """
+        peers = self.sydent.peerRegistry.getAllPeers()
+        if not peers:
+            # Tombstones are only kept for the benefit of our peers.
+            return self.local_assoc_store.getMaxId()
+
+        versions = [p.lastSentVersion for p in peers]
+        if None in versions:
+            return None
+        return min(versions)
+
+    @defer.inlineCallbacks
+    def compact(self):
+        """
+        Deletes the tombstones every active peer has been sent, in small batches so
+        as not to hold up the reactor.
+
+        :return: The number of tombstones deleted.
+        :rtype: twisted.internet.defer.Deferred[int]
+        """
+        if self.compacting:
+            return 0
+
+        self.compacting = True
+        total = 0
+        try:
+            watermark = self.getWatermark()
+            while watermark is not None:
+                count, size = self.local_assoc_store.deleteTombstonesUpToId(
+                    watermark, TOMBSTONE_COMPACTION_BATCH_SIZE
+                )
+                total += count
+                tombstones_compacted.inc(count)
+                tombstones_compacted_bytes.inc(size)
+
+                if count < TOMBSTONE_COMPACTION_BATCH_SIZE:
+                    break
+
+                # Let the reactor serve requests between batches.
+                yield task.deferLater(self.sydent.reactor, 0, lambda: None)
+
+            tombstones.set(self.local_assoc_store.countTombstones())
+
+            if total:
+                logger.info("Compacted %d tombstones up to ID %d", total, watermark)
+        except Exception:
+            logger.exception("Error compacting tombstones")
+        finally:
+            self.compacting = False
+
+        return total
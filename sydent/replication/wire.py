@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A binary framing for replication pushes, which peers can use instead of JSON once
+they've both advertised support for it.
+
+A body is a sequence of records ordered by origin ID, each made of the origin ID as
+an unsigned 64-bit big-endian integer, the length of the signed association as an
+unsigned 32-bit big-endian integer, and the signed association itself as canonical
+JSON. The receiver can then store each signed association exactly as it was sent,
+rather than parsing the whole body and serialising every association again.
+"""
+
+import struct
+
+from canonicaljson import encode_canonical_json
+
+# The Content-Type of a push body using this framing
+SGASSOCS_CONTENT_TYPE = "application/x.org.matrix.sydent.sgassocs"
+
+_RECORD_HEADER = struct.Struct(">QI")
+
+
+def encode_sg_assocs(sg_assocs):
+    """
+    Frames signed associations for a replication push.
+
+    :param sg_assocs: The signed associations to push, keyed by origin ID.
+    :type sg_assocs: dict[int, dict[str, any]]
+
+    :return: The body of the push.
+    :rtype: bytes
+    """
+    records = []
+    for origin_id in sorted(sg_assocs, key=int):
+        raw = encode_canonical_json(sg_assocs[origin_id])
+        records.append(_RECORD_HEADER.pack(int(origin_id), len(raw)))
+        records.append(raw)
+    return b"".join(records)
+
+
+def decode_sg_assocs(body):
+    """
+    Reads the records out of the body of a replication push.
+
+    :param body: The body of the push.
+    :type body: bytes
+
+    :return: The origin ID and raw signed association of each record, in order.
+    :rtype: list[tuple[int, bytes]]
+
+    :raises ValueError: if the body is truncated, or its records aren't in order.
+    """
+    records = []
+    offset = 0
+    last_origin_id = None
+    while offset < len(body):
+        if len(body) - offset < _RECORD_HEADER.size:
+            raise ValueError("Truncated record header at offset %d" % (offset,))
+        origin_id, length = _RECORD_HEADER.unpack_from(body, offset)
+        offset += _RECORD_HEADER.size
+
+        if len(body) - offset < length:
+            raise ValueError("Truncated record for origin ID %d" % (origin_id,))
+        if last_origin_id is not None and origin_id <= last_origin_id:
+            raise ValueError("Record for origin ID %d is out of order" % (origin_id,))
+
+        records.append((origin_id, body[offset : offset + length]))
+        offset += length
+        last_origin_id = origin_id
+
+    return records
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+class SmsProvider(object):
+    """
+    A gateway text messages are sent through. Which one is used is set by the
+    provider option of the sms section of the config.
+    """
+
+    # The name of the provider in the config
+    name = None
+
+    def sendTextSMS(self, body, dest, source=None):
+        """
+        Sends a text message with the given body to the given MSISDN.
+
+        :param body: The message to send.
+        :type body: str
+        :param dest: The destination MSISDN to send the text message to.
+        :type dest: unicode
+        :param source: The originator to send the message from, if any (a dict with
+            a "type" key and a "text" key).
+        :type source: dict[str, str] or None
+
+        :return: A deferred which resolves once the gateway has accepted the message.
+        :rtype: twisted.internet.defer.Deferred[None]
+
+        :raise SmsSendException: (through the deferred) The gateway didn't accept
+            the message.
+        """
+        raise NotImplementedError()
+
+
+class SmsSendException(Exception):
+    """
+    The gateway didn't accept a text message.
+
+    :param msg: The reason why.
+    :type msg: str
+    :param permanent: Whether sending the same message again won't make a
+        difference, e.g. because the destination is invalid.
+    :type permanent: bool
+    """
+
+    def __init__(self, msg, permanent=False):
+        super(SmsSendException, self).__init__(msg)
+        self.permanent = permanent
@@ -19,9 +19,12 @@ import logging
 from base64 import b64encode
 
 from twisted.internet import defer
-from sydent.http.httpclient import SimpleHttpClient
+from twisted.web.client import HTTPConnectionPool
 from twisted.web.http_headers import Headers
 
+from sydent.http.httpclient import SimpleHttpClient
+from sydent.sms import SmsProvider, SmsSendException
+
 logger = logging.getLogger(__name__)
 
 
@@ -54,22 +57,25 @@ def tonFromType(t):
     raise Exception("Unknown number type (%s) for originator" % t)
 
 
-class OpenMarketSMS:
+class OpenMarketSMS(SmsProvider):
+    name = "openmarket"
+
     def __init__(self, sydent):
         self.sydent = sydent
-        self.http_cli = SimpleHttpClient(sydent)
+
+        # Keep connections to the API open between messages, rather than doing a
+        # TCP and TLS handshake for each one.
+        pool = HTTPConnectionPool(self.sydent.reactor)
+        pool.maxPersistentPerHost = self.sydent.cfg.getint(
+            "sms", "openmarket.max_persistent_connections"
+        )
+        pool.cachedConnectionTimeout = self.sydent.cfg.getint(
+            "sms", "openmarket.cached_connection_timeout"
+        )
+        self.http_cli = SimpleHttpClient(sydent, pool=pool)
 
     @defer.inlineCallbacks
     def sendTextSMS(self, body, dest, source=None):
-        """
-        Sends a text message with the given body to the given MSISDN.
-
-        :param body: The message to send.
-        :type body: str
-        :param dest: The destination MSISDN to send the text message to.
-        :type dest: unicode
-        :type source: dict[str, str] or None
-        """
         body = {
             "mobileTerminate": {
                 "message": {"content": body, "type": "text"},
@@ -100,13 +106,20 @@ class OpenMarketSMS:
         resp = yield self.http_cli.post_json_get_nothing(
             API_BASE_URL, body, {"headers": headers}
         )
-        headers = dict(resp.headers.getAllRawHeaders())
+        if resp.code >= 300:
+            # Client errors other than rate limiting mean the message itself is
+            # refused, e.g. because the destination is invalid.
+            raise SmsSendException(
+                "Got response %d from sending SMS" % (resp.code,),
+                permanent=400 <= resp.code < 500 and resp.code != 429,
+            )
 
-        if "Location" not in headers:
+        location = resp.headers.getRawHeaders(b"Location")
+        if not location:
             raise Exception("Got response from sending SMS with no location header")
         # Nominally we should parse the URL, but we can just split on '/' since
         # we only care about the last part.
-        parts = headers["Location"][0].split("/")
+        parts = location[0].split(b"/")
         if len(parts) < 2:
             raise Exception(
                 "Got response from sending SMS with malformed location header"
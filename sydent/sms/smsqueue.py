@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import logging
+
+from prometheus_client import Counter, Gauge, Histogram
+from twisted.internet import defer
+
+from sydent.db.sms_queue import SmsQueueStore
+from sydent.sms import SmsSendException
+from sydent.sms.openmarket import OpenMarketSMS
+from sydent.sms.stub import StubSMS
+from sydent.util.durablequeue import DurableQueue
+from sydent.util.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# The providers which can be set in the config, by name
+PROVIDERS = {provider.name: provider for provider in (OpenMarketSMS, StubSMS)}
+
+# Maximum number of due messages to read from the queue at a time, on top of the
+# ones already being sent
+MESSAGES_READ_LIMIT = 500
+
+queue_depth = Gauge(
+    "sydent_sms_queue_depth",
+    "Number of text messages waiting to be sent",
+)
+oldest_pending_age = Gauge(
+    "sydent_sms_queue_oldest_pending_age_seconds",
+    "Time since the oldest text message waiting to be sent was queued",
+)
+messages_in_flight = Gauge(
+    "sydent_sms_in_flight",
+    "Number of text messages currently being sent to the gateway",
+)
+messages_sent = Counter(
+    "sydent_sms_sent_total",
+    "Number of text messages accepted by the gateway",
+    ["country"],
+)
+message_failures = Counter(
+    "sydent_sms_send_failures_total",
+    "Number of failed attempts to send a text message",
+    ["country"],
+)
+messages_dropped = Counter(
+    "sydent_sms_dropped_total",
+    "Number of text messages given up on, because they were refused or failed too "
+    "often",
+    ["country"],
+)
+send_duration = Histogram(
+    "sydent_sms_send_duration_seconds",
+    "Time taken by the gateway to accept a text message",
+)
+
+
+class SmsQueue(DurableQueue):
+    """
+    Sends the text messages queued in the database in the background, through the
+    configured provider, so that they survive a restart and gateway errors.
+
+    At most queue.max_concurrency messages are sent at once, and the number of
+    messages sent per second to each country is limited by its ratelimit.<country
+    calling code> option, or ratelimit.default. A message that couldn't be sent is
+    retried after an exponential backoff, capped and jittered, unless the gateway
+    refused it permanently.
+    """
+
+    description = "SMS"
+    queueDepth = queue_depth
+    oldestPendingAge = oldest_pending_age
+
+    def __init__(self, sydent):
+        super().__init__(sydent, SmsQueueStore(sydent))
+
+        providerName = self.sydent.cfg.get("sms", "provider")
+        if providerName not in PROVIDERS:
+            raise Exception(
+                "Invalid SMS provider: %s, expecting one of %s"
+                % (providerName, ", ".join(sorted(PROVIDERS)))
+            )
+        self.provider = PROVIDERS[providerName](self.sydent)
+
+        self.max_concurrency = self.sydent.cfg.getint("sms", "queue.max_concurrency")
+        self.max_attempts = self.sydent.cfg.getint("sms", "queue.max_attempts")
+        self.max_retry_interval = self.sydent.cfg.getint(
+            "sms", "queue.max_retry_interval"
+        )
+
+        # cache the rate limits from config file
+        self.countryRates = {}
+        for opt in self.sydent.cfg.options("sms"):
+            if opt.startswith("ratelimit."):
+                country = opt.split(".")[1]
+                self.countryRates[country] = self.sydent.cfg.getfloat("sms", opt)
+
+    def enqueue(self, destination, country, body, originator=None):
+        """
+        Queues a text message, and starts sending it straight away if the limits
+        allow it.
+
+        :param destination: The MSISDN to send the message to.
+        :type destination: unicode
+        :param country: The country calling code of the MSISDN.
+        :type country: unicode
+        :param body: The content of the message.
+        :type body: unicode
+        :param originator: The originator to send the message from, if any (a dict
+            with a "type" key and a "text" key).
+        :type originator: dict[str, str] or None
+        """
+        self.store.addMessage(destination, country, body, originator, self._now())
+        self._process()
+
+    def _startDue(self):
+        if len(self._in_flight) >= self.max_concurrency:
+            return
+
+        due = self.store.getDueMessages(
+            self._now(), MESSAGES_READ_LIMIT + len(self._in_flight)
+        )
+
+        # How long (in seconds) until a rate-limited message can be sent
+        wait = None
+        for row in due:
+            if len(self._in_flight) >= self.max_concurrency:
+                break
+
+            messageId, country = row[0], row[2]
+            if messageId in self._in_flight:
+                continue
+
+            limiter = self._rateLimiter(country)
+            if not limiter.tryTake():
+                country_wait = limiter.timeUntilAvailable()
+                wait = country_wait if wait is None else min(wait, country_wait)
+                continue
+
+            self._send(*row)
+
+        if wait is not None:
+            self._schedule(wait)
+
+    def _rateLimiter(self, country):
+        """
+        :param country: A country calling code.
+        :type country: unicode
+
+        :return: The limiter of the rate of messages sent to the country.
+        :rtype: sydent.util.ratelimit.TokenBucket
+        """
+        limiter = self._rate_limiters.get(country)
+        if limiter is None:
+            rate = self.countryRates.get(country, self.countryRates["default"])
+            limiter = TokenBucket(rate, self.sydent.reactor.seconds)
+            self._rate_limiters[country] = limiter
+        return limiter
+
+    @defer.inlineCallbacks
+    def _send(self, messageId, destination, country, body, originator, attempts):
+        """
+        Sends a text message through the provider, and either removes it from the
+        queue or schedules another attempt depending on the outcome.
+
+        :param messageId: The ID of the message.
+        :type messageId: int
+        :param destination: The MSISDN to send the message to.
+        :type destination: unicode
+        :param country: The country calling code of the MSISDN.
+        :type country: unicode
+        :param body: The content of the message.
+        :type body: unicode
+        :param originator: The originator to send the message from, if any.
+        :type originator: dict[str, str] or None
+        :param attempts: The number of previous attempts to send this message.
+        :type attempts: int
+        """
+        self._in_flight.add(messageId)
+        messages_in_flight.inc()
+
+        start = self.sydent.reactor.seconds()
+        error = None
+        try:
+            yield self.provider.sendTextSMS(body, destination, originator)
+        except Exception as e:
+            error = e
+
+        try:
+            if error is None:
+                logger.info("Sent text message to %s", destination)
+                messages_sent.labels(country).inc()
+                send_duration.observe(self.sydent.reactor.seconds() - start)
+                self.store.deleteMessage(messageId)
+            else:
+                self._messageFailed(messageId, destination, country, attempts, error)
+        except Exception:
+            logger.exception("Error recording the outcome of texting %s", destination)
+        finally:
+            self._in_flight.discard(messageId)
+            messages_in_flight.dec()
+
+            self._schedule()
+
+    def _messageFailed(self, messageId, destination, country, attempts, error):
+        message_failures.labels(country).inc()
+
+        permanent = isinstance(error, SmsSendException) and error.permanent
+        if permanent or attempts + 1 >= self.max_attempts:
+            logger.warning(
+                "Error texting %s: %s - giving up after %d attempts",
+                destination,
+                error,
+                attempts + 1,
+            )
+            messages_dropped.labels(country).inc()
+            self.store.deleteMessage(messageId)
+            return
+
+        delay = self._retryInterval(attempts)
+        logger.warning(
+            "Error texting %s: %s - retrying in %.1fs", destination, error, delay
+        )
+        self.store.rescheduleMessage(
+            messageId, attempts + 1, self._now() + int(delay * 1000)
+        )
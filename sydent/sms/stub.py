@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import collections
+import logging
+
+from twisted.internet import defer, task
+
+from sydent.sms import SmsProvider
+
+logger = logging.getLogger(__name__)
+
+# How many of the last messages to remember
+MAX_RECORDED_MESSAGES = 1000
+
+
+class StubSMS(SmsProvider):
+    """
+    A provider which doesn't send anything, but accepts every message after
+    stub.latency seconds. Meant for development and load testing, never for
+    production.
+    """
+
+    name = "stub"
+
+    def __init__(self, sydent):
+        self.sydent = sydent
+        self.latency = self.sydent.cfg.getfloat("sms", "stub.latency")
+
+        # The (body, dest, source) of the last messages "sent"
+        self.sent = collections.deque(maxlen=MAX_RECORDED_MESSAGES)
+
+        logger.warning("Text messages will not be sent: using the stub SMS provider")
+
+    @defer.inlineCallbacks
+    def sendTextSMS(self, body, dest, source=None):
+        if self.latency > 0:
+            yield task.deferLater(self.sydent.reactor, self.latency, lambda: None)
+
+        logger.debug("Pretending to text %s", dest)
+        self.sent.append((body, dest, source))
@@ -17,13 +17,13 @@
 # limitations under the License.
 from __future__ import absolute_import
 
-import gc
 
 from six.moves import configparser
 import copy
 import logging
 import logging.handlers
 import os
+import signal
 from typing import Set
 
 import twisted.internet.reactor
@@ -39,6 +39,7 @@ from sydent.http.httpserver import (
     InternalApiHttpServer,
 )
 from sydent.http.httpsclient import ReplicationHttpsClient
+from sydent.http.httpclient import FederationHttpClient
 from sydent.http.servlets.blindlysignstuffservlet import BlindlySignStuffServlet
 from sydent.http.servlets.pubkeyservlets import (
     EphemeralPubkeyIsValidServlet,
@@ -52,6 +53,12 @@ from sydent.hs_federation.verifier import Verifier
 from sydent.util.hash import sha256_and_url_safe_base64
 from sydent.util.tokenutils import generateAlphanumericTokenOfLength
 from sydent.util.ip_range import generate_ip_set, DEFAULT_IP_RANGE_BLACKLIST
+from sydent.util.emailutils import SmtpTransport
+from sydent.util.emailqueue import EmailQueue
+from sydent.util.gcutils import GarbageCollector
+from sydent.util.stalldetector import ReactorStallDetector
+from sydent.sms.smsqueue import SmsQueue
+from sydent.util.templates import TemplateRegistry
 
 from sydent.sign.ed25519 import SydentEd25519
 
@@ -71,6 +78,13 @@ from sydent.http.servlets.pubkeyservlets import Ed25519Servlet
 from sydent.http.servlets.threepidbindservlet import ThreePidBindServlet
 from sydent.http.servlets.threepidunbindservlet import ThreePidUnbindServlet
 from sydent.http.servlets.replication import ReplicationPushServlet
+from sydent.http.servlets.reactorstallsservlet import ReactorStallsServlet
+from sydent.http.servlets.replicationstatusservlet import ReplicationStatusServlet
+from sydent.http.servlets.slowqueriesservlet import SlowQueriesServlet
+from sydent.http.servlets.hashtreeservlet import (
+    HashTreeBucketServlet,
+    HashTreeNodesServlet,
+)
 from sydent.http.servlets.getvalidated3pidservlet import GetValidated3pidServlet
 from sydent.http.servlets.store_invite_servlet import StoreInviteServlet
 from sydent.http.servlets.v1_servlet import V1Servlet
@@ -83,8 +97,15 @@ from sydent.db.valsession import ThreePidValSessionStore
 from sydent.db.hashing_metadata import HashingMetadataStore
 
 from sydent.threepid.bind import ThreepidBinder
+from sydent.threepid.expiry import ExpiredAssociationReaper
+from sydent.threepid.onbind import OnBindNotifier
 
 from sydent.replication.pusher import Pusher
+from sydent.replication.registry import PeerRegistry
+from sydent.replication.stats import ReplicationStats
+from sydent.replication.antientropy import AntiEntropy
+from sydent.replication.tombstones import TombstoneCompactor
+from sydent.replication.history import HistoryCompactor
 
 logger = logging.getLogger(__name__)
 
@@ -133,9 +154,50 @@ CONFIG_DEFAULTS = {
         # This whitelist overrides `ip.blacklist` and defaults to an empty
         # list.
         "ip.whitelist": "",
+        # How often (in seconds) to compare the associations we hold from each
+        # replication peer with the ones it holds itself, and repair any
+        # difference. 0 disables the comparison.
+        "replication.antientropy_interval": "0",
+        # How many batches of associations to have in flight to each replication
+        # peer at once. Raising it helps keep up with peers on high-latency links.
+        "replication.push_window": "4",
+        # How often (in seconds) to delete the records of deleted bindings that
+        # every replication peer has received. 0 disables the compaction.
+        "replication.tombstone_compaction_interval": "3600",
+        # How often (in seconds) to delete the global associations which have been
+        # superseded by a newer binding of the same 3PID. 0 disables the compaction.
+        "associations.history_compaction_interval": "3600",
+        # The maximum number of bind notifications to send to homeservers at once,
+        # and to any single homeserver at once.
+        "onbind.max_concurrency": "20",
+        "onbind.max_concurrency_per_destination": "2",
+        # The maximum time (in seconds) to wait before retrying to send a bind
+        # notification to a homeserver.
+        "onbind.max_retry_interval": "3600",
+        # Garbage collections are run from the reactor's loop. These are the
+        # allocation thresholds which make each generation due a collection, and
+        # the minimum time (in seconds) between two collections of a generation.
+        "gc.thresholds": "700,10,10",
+        "gc.min_intervals": "1,10,30",
+        # Whether to move the objects created during startup out of the garbage
+        # collector's reach once it's over, as they're expected to live until
+        # shutdown.
+        "gc.freeze_after_startup": "true",
+        # Whether to watch for code blocking the reactor: a call is scheduled every
+        # stall_detector.interval seconds, and if it hasn't run for longer than
+        # stall_detector.threshold seconds, the stack of the reactor's thread is
+        # logged and the stall is reported on the internal API.
+        "stall_detector.enabled": "true",
+        "stall_detector.interval": "0.1",
+        "stall_detector.threshold": "0.5",
     },
     "db": {
         "db.file": os.environ.get("SYDENT_DB_PATH", "sydent.db"),
+        # Whether to time every SQL statement, log the ones which take longer than
+        # slow_query_log.threshold seconds along with their query plan, and report
+        # the time taken by each kind of statement on the internal API.
+        "slow_query_log.enabled": "false",
+        "slow_query_log.threshold": "0.1",
     },
     "http": {
         "clientapi.http.bind_address": "::",
@@ -146,8 +208,23 @@ CONFIG_DEFAULTS = {
         "replication.https.cacert": "",  # This should only be used for testing
         "replication.https.bind_address": "::",
         "replication.https.port": "4434",
+        # The maximum number of idle connections to keep open to each replication
+        # peer, and how long (in seconds) an idle connection is kept before closing.
+        "replication.https.max_persistent_per_host": "2",
+        "replication.https.cached_connection_timeout": "240",
         "obey_x_forwarded_for": "False",
         "federation.verifycerts": "True",
+        # The maximum number of idle connections to keep open to each homeserver,
+        # how long (in seconds) an idle connection is kept before closing, and the
+        # maximum number of requests to send to a homeserver at once.
+        "federation.max_persistent_per_host": "5",
+        "federation.cached_connection_timeout": "120",
+        "federation.max_concurrent_per_host": "10",
+        # The maximum number of homeservers to keep the keys of in memory, and
+        # whether to also save them to the database so they don't need to be
+        # fetched again after a restart.
+        "federation.key_cache.max_size": "10000",
+        "federation.key_cache.persist": "true",
         # verify_response_template is deprecated, but still used if defined Define
         # templates.path and brand.default under general instead.
         #
@@ -169,6 +246,24 @@ CONFIG_DEFAULTS = {
         "email.smtppassword": "",
         "email.hostname": "",
         "email.tlsmode": "0",
+        # The maximum number of connections to open to the SMTP server (and of
+        # emails sent at once), the timeout (in seconds) of operations on a
+        # connection, and how long (in seconds) to keep an idle connection open.
+        "email.smtp.max_connections": "4",
+        "email.smtp.timeout": "30",
+        "email.smtp.idle_timeout": "60",
+        # Emails are queued in the database and sent in the background, up to
+        # email.queue.batch_size of them over each connection at a time. At most
+        # email.queue.rate emails are sent per second overall, and
+        # email.queue.domain_rate per second to the addresses of any one domain
+        # (0 for no limit). An email which couldn't be sent is retried with an
+        # exponential backoff, of at most email.queue.max_retry_interval seconds,
+        # up to email.queue.max_attempts times.
+        "email.queue.batch_size": "10",
+        "email.queue.rate": "10",
+        "email.queue.domain_rate": "2",
+        "email.queue.max_retry_interval": "600",
+        "email.queue.max_attempts": "10",
         # The web client location which will be used if it is not provided by
         # the homeserver.
         #
@@ -199,8 +294,28 @@ CONFIG_DEFAULTS = {
     },
     "sms": {
         "bodyTemplate": "Your code is {token}",
+        # The gateway to send text messages through: 'openmarket', or 'stub' to
+        # not send anything (for development and load testing only)
+        "provider": "openmarket",
         "username": "",
         "password": "",
+        # The maximum number of connections to the OpenMarket API to keep open, and
+        # how long (in seconds) to keep an idle one open.
+        "openmarket.max_persistent_connections": "10",
+        "openmarket.cached_connection_timeout": "120",
+        # How long (in seconds) the stub provider takes to accept a message
+        "stub.latency": "0",
+        # Text messages are queued in the database and sent in the background, up
+        # to queue.max_concurrency of them at once. A message which couldn't be sent
+        # is retried with an exponential backoff, of at most
+        # queue.max_retry_interval seconds, up to queue.max_attempts times.
+        "queue.max_concurrency": "10",
+        "queue.max_retry_interval": "300",
+        "queue.max_attempts": "5",
+        # The maximum number of text messages to send per second to numbers of a
+        # given country, e.g. ratelimit.44 for the UK, or to countries without
+        # their own limit (0 for no limit).
+        "ratelimit.default": "5",
     },
     "crypto": {
         "ed25519.signingkey": "",
@@ -256,20 +371,8 @@ class Sydent:
                 addr=self.cfg.get("general", "prometheus_addr"),
             )
 
-        if self.cfg.has_option("general", "templates.path"):
-            # Get the possible brands by looking at directories under the
-            # templates.path directory.
-            root_template_path = self.cfg.get("general", "templates.path")
-            if os.path.exists(root_template_path):
-                self.valid_brands = {
-                    p
-                    for p in os.listdir(root_template_path)
-                    if os.path.isdir(os.path.join(root_template_path, p))
-                }
-            else:
-                # This is a legacy code-path and assumes that verify_response_template,
-                # email.template, and email.invite_template are defined.
-                self.valid_brands = set()
+        # Discovers the brands (setting self.valid_brands) and loads their templates
+        self.templates = TemplateRegistry(self)
 
         self.enable_v1_associations = parse_cfg_bool(
             self.cfg.get("general", "enable_v1_associations")
@@ -320,6 +423,10 @@ class Sydent:
                 sha256_and_url_safe_base64, lookup_pepper
             )
 
+        self.smtpTransport = SmtpTransport(self)
+        self.emailQueue = EmailQueue(self)
+        self.smsQueue = SmsQueue(self)
+
         self.validators = Validators()
         self.validators.email = EmailValidator(self)
         self.validators.msisdn = MsisdnValidator(self)
@@ -328,8 +435,13 @@ class Sydent:
         self.keyring.ed25519 = SydentEd25519(self).signing_key
         self.keyring.ed25519.alg = "ed25519"
 
+        self.federationHttpClient = FederationHttpClient(self)
+
         self.sig_verifier = Verifier(self)
 
+        self.peerRegistry = PeerRegistry(self)
+        self.replicationStats = ReplicationStats(self)
+
         self.servlets = Servlets()
         self.servlets.v1 = V1Servlet(self)
         self.servlets.v2 = V2Servlet(self)
@@ -360,6 +472,11 @@ class Sydent:
         self.servlets.threepidBindV2 = ThreePidBindServlet(self, require_auth=True)
         self.servlets.threepidUnbind = ThreePidUnbindServlet(self)
         self.servlets.replicationPush = ReplicationPushServlet(self)
+        self.servlets.hashTreeNodes = HashTreeNodesServlet(self)
+        self.servlets.hashTreeBucket = HashTreeBucketServlet(self)
+        self.servlets.replicationStatus = ReplicationStatusServlet(self)
+        self.servlets.reactorStalls = ReactorStallsServlet(self)
+        self.servlets.slowQueries = SlowQueriesServlet(self)
         self.servlets.getValidated3pid = GetValidated3pidServlet(self)
         self.servlets.getValidated3pidV2 = GetValidated3pidServlet(
             self, require_auth=True
@@ -376,6 +493,7 @@ class Sydent:
         self.servlets.logoutServlet = LogoutServlet(self)
 
         self.threepidBinder = ThreepidBinder(self)
+        self.onBindNotifier = OnBindNotifier(self)
 
         self.sslComponents = SslComponents(self)
 
@@ -384,6 +502,9 @@ class Sydent:
         self.replicationHttpsClient = ReplicationHttpsClient(self)
 
         self.pusher = Pusher(self)
+        self.antiEntropy = AntiEntropy(self)
+        self.tombstoneCompactor = TombstoneCompactor(self)
+        self.historyCompactor = HistoryCompactor(self)
 
         # A dedicated validation session store just to clean up old sessions every N minutes
         self.cleanupValSession = ThreePidValSessionStore(self)
@@ -391,12 +512,18 @@ class Sydent:
         cb.clock = self.reactor
         cb.start(10 * 60.0)
 
+        # Similarly, delete associations which have expired every N minutes
+        self.expiredAssociationReaper = ExpiredAssociationReaper(self)
+        cb = task.LoopingCall(self.expiredAssociationReaper.reap)
+        cb.clock = self.reactor
+        cb.start(10 * 60.0)
+
         # workaround for https://github.com/getsentry/sentry-python/issues/803: we
         # disable automatic GC and run it periodically instead.
-        gc.disable()
-        cb = task.LoopingCall(run_gc)
-        cb.clock = self.reactor
-        cb.start(1.0)
+        self.garbageCollector = GarbageCollector(self)
+        self.garbageCollector.setup()
+
+        self.stallDetector = ReactorStallDetector(self)
 
     def save_config(self):
         fp = open(self.config_file, "w")
@@ -407,6 +534,14 @@ class Sydent:
         self.clientApiHttpServer.setup()
         self.replicationHttpsServer.setup()
         self.pusher.setup()
+        self.antiEntropy.setup()
+        self.tombstoneCompactor.setup()
+        self.historyCompactor.setup()
+        self.onBindNotifier.setup()
+        self.emailQueue.setup()
+        self.smsQueue.setup()
+        if self.stallDetector.enabled:
+            self.stallDetector.setup()
 
         internalport = self.cfg.get("http", "internalapi.http.port")
         if internalport:
@@ -421,6 +556,9 @@ class Sydent:
             with open(self.pidfile, "w") as pidfile:
                 pidfile.write(str(os.getpid()) + "\n")
 
+        if parse_cfg_bool(self.cfg.get("general", "gc.freeze_after_startup")):
+            self.garbageCollector.freeze()
+
         self.reactor.run()
 
     def ip_from_request(self, request):
@@ -444,42 +582,16 @@ class Sydent:
             return request.args[b"brand"][0].decode("utf-8")
         return None
 
-    def get_branded_template(self, brand, template_name, deprecated_template_name):
+    def reload_templates(self):
         """
-        Calculate a (maybe) branded template filename to use.
-
-        If the deprecated email.template setting is defined, always use it.
-        Otherwise, attempt to use the hinted brand from the request if the brand
-        is valid. Otherwise, fallback to the default brand.
-
-        :param brand: The hint of which brand to use.
-        :type brand: str or None
-        :param template_name: The name of the template file to load.
-        :type template_name: str
-        :param deprecated_template_name: The deprecated setting to use, if provided.
-        :type deprecated_template_name: Tuple[str]
-
-        :return: The template filename to use.
-        :rtype: str
+        Reloads the email and HTML templates from disk, e.g. after they've been
+        updated. If that fails, the templates loaded previously are kept.
         """
-
-        # If the deprecated setting is defined, return it.
+        logger.info("Reloading templates")
         try:
-            return self.cfg.get(*deprecated_template_name)
-        except configparser.NoOptionError:
-            pass
-
-        # If a brand hint is provided, attempt to use it if it is valid.
-        if brand:
-            if brand not in self.valid_brands:
-                brand = None
-
-        # If the brand hint is not valid, or not provided, fallback to the default brand.
-        if not brand:
-            brand = self.cfg.get("general", "brand.default")
-
-        root_template_path = self.cfg.get("general", "templates.path")
-        return os.path.join(root_template_path, brand, template_name)
+            self.templates.reload()
+        except Exception:
+            logger.exception("Error reloading templates")
 
 
 class Validators:
@@ -585,16 +697,14 @@ def set_from_comma_sep_string(rawstr: str) -> Set[str]:
     return {x.strip() for x in rawstr.split(",")}
 
 
-def run_gc():
-    threshold = gc.get_threshold()
-    counts = gc.get_count()
-    for i in reversed(range(len(threshold))):
-        if threshold[i] < counts[i]:
-            gc.collect(i)
-
-
 if __name__ == "__main__":
     cfg = parse_config_file(get_config_file_path())
     setup_logging(cfg)
     syd = Sydent(cfg)
+
+    def sighup(signum, stack):
+        syd.reactor.callFromThread(syd.reload_templates)
+
+    signal.signal(signal.SIGHUP, sighup)
+
     syd.run()
@@ -18,7 +18,6 @@ from __future__ import absolute_import
 
 import collections
 import logging
-import math
 import signedjson.sign
 from sydent.db.invite_tokens import JoinTokenStore
 
@@ -28,14 +27,9 @@ from sydent.util import time_msec
 from sydent.util.hash import sha256_and_url_safe_base64
 from sydent.db.hashing_metadata import HashingMetadataStore
 from sydent.threepid.signer import Signer
-from sydent.http.httpclient import FederationHttpClient
 
 from sydent.threepid import ThreepidAssociation
 
-from sydent.util.stringutils import is_valid_matrix_server_name
-
-from twisted.internet import defer
-
 logger = logging.getLogger(__name__)
 
 
@@ -111,7 +105,7 @@ class ThreepidBinder:
         signer = Signer(self.sydent)
         sgassoc = signer.signedThreePidAssociation(assoc)
 
-        self._notify(sgassoc, 0)
+        self.sydent.onBindNotifier.notify(sgassoc)
 
         return sgassoc
 
@@ -128,93 +122,6 @@ class ThreepidBinder:
         localAssocStore.removeAssociation(threepid, mxid)
         self.sydent.pusher.doLocalPush()
 
-    @defer.inlineCallbacks
-    def _notify(self, assoc, attempt):
-        """
-        Sends data about a new association (and, if necessary, the associated invites)
-        to the associated MXID's homeserver.
-
-        :param assoc: The association to send down to the homeserver.
-        :type assoc: dict[str, any]
-        :param attempt: The number of previous attempts to send this association.
-        :type attempt: int
-        """
-        mxid = assoc["mxid"]
-        mxid_parts = mxid.split(":", 1)
-
-        if len(mxid_parts) != 2:
-            logger.error(
-                "Can't notify on bind for unparseable mxid %s. Not retrying.",
-                assoc["mxid"],
-            )
-            return
-
-        matrix_server = mxid_parts[1]
-
-        if not is_valid_matrix_server_name(matrix_server):
-            logger.error(
-                "MXID server part '%s' not a valid Matrix server name. Not retrying.",
-                matrix_server,
-            )
-            return
-
-        post_url = "matrix://%s/_matrix/federation/v1/3pid/onbind" % (matrix_server,)
-
-        logger.info("Making bind callback to: %s", post_url)
-
-        # Make a POST to the chosen Synapse server
-        http_client = FederationHttpClient(self.sydent)
-        try:
-            response = yield http_client.post_json_get_nothing(post_url, assoc, {})
-        except Exception as e:
-            self._notifyErrback(assoc, attempt, e)
-            return
-
-        # If the request failed, try again with exponential backoff
-        if response.code != 200:
-            self._notifyErrback(
-                assoc, attempt, "Non-OK error code received (%d)" % response.code
-            )
-        else:
-            logger.info("Successfully notified on bind for %s" % (mxid,))
-
-            # Skip the deletion step if instructed so by the config.
-            if not self.sydent.delete_tokens_on_bind:
-                return
-
-            # Only remove sent tokens when they've been successfully sent.
-            try:
-                joinTokenStore = JoinTokenStore(self.sydent)
-                joinTokenStore.deleteTokens(assoc["medium"], assoc["address"])
-                logger.info(
-                    "Successfully deleted invite for %s from the store",
-                    assoc["address"],
-                )
-            except Exception:
-                logger.exception(
-                    "Couldn't remove invite for %s from the store",
-                    assoc["address"],
-                )
-
-    def _notifyErrback(self, assoc, attempt, error):
-        """
-        Handles errors when trying to send an association down to a homeserver by
-        logging the error and scheduling a new attempt.
-
-        :param assoc: The association to send down to the homeserver.
-        :type assoc: dict[str, any]
-        :param attempt: The number of previous attempts to send this association.
-        :type attempt: int
-        :param error: The error that was raised when trying to send the association.
-        :type error: Exception
-        """
-        logger.warning(
-            "Error notifying on bind for %s: %s - rescheduling", assoc["mxid"], error
-        )
-        self.sydent.reactor.callLater(
-            math.pow(2, attempt), self._notify, assoc, attempt + 1
-        )
-
     # The below is lovingly ripped off of synapse/http/endpoint.py
 
     _Server = collections.namedtuple("_Server", "priority weight host port")
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import logging
+
+from prometheus_client import Counter
+from twisted.internet import defer, task
+
+from sydent.db.threepid_associations import (
+    GlobalAssociationStore,
+    LocalAssociationStore,
+)
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of expired associations to delete in a single transaction
+EXPIRED_ASSOCIATIONS_BATCH_SIZE = 500
+
+expired_associations_reaped = Counter(
+    "sydent_expired_associations_reaped_total",
+    "Number of associations deleted because their notAfter had passed",
+    ["table"],
+)
+
+
+class ExpiredAssociationReaper:
+    """
+    Deletes the associations whose notAfter has passed from both the local and the
+    global associations tables. Every lookup filters them out anyway, so this only
+    keeps them from taking up space in the tables and their indexes.
+    """
+
+    def __init__(self, sydent):
+        self.sydent = sydent
+        self.stores = [
+            ("local", LocalAssociationStore(self.sydent)),
+            ("global", GlobalAssociationStore(self.sydent)),
+        ]
+        self.reaping = False
+
+    @defer.inlineCallbacks
+    def reap(self):
+        """
+        Deletes the expired associations in small batches, so as not to hold up the
+        reactor.
+
+        :return: The number of associations deleted.
+        :rtype: twisted.internet.defer.Deferred[int]
+        """
+        if self.reaping:
+            return 0
+
+        self.reaping = True
+        total = 0
+        try:
+            for table, store in self.stores:
+                while True:
+                    count = store.deleteExpiredAssociations(
+                        EXPIRED_ASSOCIATIONS_BATCH_SIZE
+                    )
+                    total += count
+                    expired_associations_reaped.labels(table).inc(count)
+
+                    if count < EXPIRED_ASSOCIATIONS_BATCH_SIZE:
+                        break
+
+                    # Let the reactor serve requests between batches.
+                    yield task.deferLater(self.sydent.reactor, 0, lambda: None)
+
+            if total:
+                logger.info("Deleted %d expired associations", total)
+        except Exception:
+            logger.exception("Error deleting expired associations")
+        finally:
+            self.reaping = False
+
+        return total
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import collections
+import logging
+import random
+
+from prometheus_client import Counter, Gauge
+from twisted.internet import defer, task
+
+from sydent.db.invite_tokens import JoinTokenStore
+from sydent.db.onbind_notifications import OnBindNotificationStore
+from sydent.util.stringutils import is_valid_matrix_server_name
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of due notifications to read from the queue at a time
+NOTIFICATIONS_BATCH_SIZE = 100
+
+# How often (in seconds) to look for notifications that have become due
+POLL_INTERVAL = 5.0
+
+queue_depth = Gauge(
+    "sydent_onbind_queue_depth",
+    "Number of bind notifications waiting to be delivered to homeservers",
+)
+oldest_pending_age = Gauge(
+    "sydent_onbind_oldest_pending_age_seconds",
+    "Time since the oldest bind notification waiting to be delivered was queued",
+)
+notifications_in_flight = Gauge(
+    "sydent_onbind_notifications_in_flight",
+    "Number of bind notifications currently being sent to homeservers",
+)
+notifications_sent = Counter(
+    "sydent_onbind_notifications_sent_total",
+    "Number of bind notifications delivered to homeservers",
+)
+notification_failures = Counter(
+    "sydent_onbind_notification_failures_total",
+    "Number of failed attempts to deliver a bind notification to a homeserver",
+)
+
+
+class OnBindNotifier:
+    """
+    Delivers notifications of new associations (and of the invites they complete) to
+    the homeserver of the associated MXID.
+
+    Notifications are queued in the database, so the ones that couldn't be delivered
+    yet survive a restart. They are sent by a bounded pool of concurrent requests,
+    with at most a few in flight to any one homeserver. When delivering one fails,
+    it is retried after an exponential backoff, capped and jittered, and the other
+    notifications to the same homeserver are held back until then too, rather than
+    each failing on its own.
+    """
+
+    def __init__(self, sydent):
+        self.sydent = sydent
+        self.store = OnBindNotificationStore(self.sydent)
+
+        self.max_concurrency = self.sydent.cfg.getint(
+            "general", "onbind.max_concurrency"
+        )
+        self.max_concurrency_per_destination = self.sydent.cfg.getint(
+            "general", "onbind.max_concurrency_per_destination"
+        )
+        self.max_retry_interval = self.sydent.cfg.getint(
+            "general", "onbind.max_retry_interval"
+        )
+
+        # The destination of each notification being sent, by ID
+        self._in_flight = {}
+        self._in_flight_per_destination = collections.Counter()
+
+        self._process_scheduled = None
+
+    def setup(self):
+        cb = task.LoopingCall(self._process)
+        cb.clock = self.sydent.reactor
+        cb.start(POLL_INTERVAL)
+
+    def notify(self, assoc):
+        """
+        Queues a notification of a new association to the homeserver of its MXID.
+
+        :param assoc: The signed association to send to the homeserver.
+        :type assoc: dict[str, any]
+        """
+        mxid = assoc["mxid"]
+        mxid_parts = mxid.split(":", 1)
+
+        if len(mxid_parts) != 2:
+            logger.error(
+                "Can't notify on bind for unparseable mxid %s. Not retrying.",
+                assoc["mxid"],
+            )
+            return
+
+        matrix_server = mxid_parts[1]
+
+        if not is_valid_matrix_server_name(matrix_server):
+            logger.error(
+                "MXID server part '%s' not a valid Matrix server name. Not retrying.",
+                matrix_server,
+            )
+            return
+
+        self.store.addNotification(matrix_server, assoc, self._now())
+        self._schedule()
+
+    def _schedule(self):
+        """Processes the queue on the next reactor iteration, unless that's already
+        planned.
+        """
+        if self._process_scheduled is None:
+            self._process_scheduled = self.sydent.reactor.callLater(0, self._process)
+
+    def _process(self):
+        """Starts sending as many due notifications as the concurrency limits allow."""
+        if self._process_scheduled is not None:
+            if self._process_scheduled.active():
+                self._process_scheduled.cancel()
+            self._process_scheduled = None
+
+        try:
+            self._startDueNotifications()
+        except Exception:
+            logger.exception("Error processing the bind notification queue")
+
+        try:
+            count, oldest = self.store.getQueueStats()
+            queue_depth.set(count)
+            oldest_pending_age.set(
+                (self._now() - oldest) / 1000.0 if oldest is not None else 0
+            )
+        except Exception:
+            logger.exception("Error reading the size of the bind notification queue")
+
+    def _startDueNotifications(self):
+        while len(self._in_flight) < self.max_concurrency:
+            saturated = [
+                destination
+                for destination, count in self._in_flight_per_destination.items()
+                if count >= self.max_concurrency_per_destination
+            ]
+            due = self.store.getDueNotifications(
+                self._now(), saturated, NOTIFICATIONS_BATCH_SIZE
+            )
+
+            started = 0
+            for notificationId, destination, assoc, attempts in due:
+                if len(self._in_flight) >= self.max_concurrency:
+                    break
+                if notificationId in self._in_flight:
+                    continue
+                if (
+                    self._in_flight_per_destination[destination]
+                    >= self.max_concurrency_per_destination
+                ):
+                    continue
+
+                self._in_flight[notificationId] = destination
+                self._in_flight_per_destination[destination] += 1
+                notifications_in_flight.inc()
+                started += 1
+
+                self._send(notificationId, destination, assoc, attempts)
+
+            # Stop once a whole batch has been read without anything to send from
+            # it, otherwise go round and read the notifications after it.
+            if started == 0 or len(due) < NOTIFICATIONS_BATCH_SIZE:
+                return
+
+    @defer.inlineCallbacks
+    def _send(self, notificationId, destination, assoc, attempts):
+        """
+        Sends a notification to its homeserver, and either removes it from the queue or
+        schedules another attempt depending on the outcome.
+
+        :param notificationId: The ID of the notification.
+        :type notificationId: int
+        :param destination: The server name of the homeserver.
+        :type destination: unicode
+        :param assoc: The signed association to send.
+        :type assoc: dict[str, any]
+        :param attempts: The number of previous attempts to send this notification.
+        :type attempts: int
+        """
+        post_url = "matrix://%s/_matrix/federation/v1/3pid/onbind" % (destination,)
+
+        logger.info("Making bind callback to: %s", post_url)
+
+        error = None
+        try:
+            # Make a POST to the chosen Synapse server
+            response = yield self.sydent.federationHttpClient.post_json_get_nothing(
+                post_url, assoc, {}
+            )
+            if response.code != 200:
+                error = "Non-OK error code received (%d)" % response.code
+        except Exception as e:
+            error = e
+
+        try:
+            if error is None:
+                self._notificationSent(notificationId, assoc)
+            else:
+                self._notificationFailed(
+                    notificationId, destination, assoc, attempts, error
+                )
+        except Exception:
+            logger.exception(
+                "Error recording the outcome of the bind callback to %s", destination
+            )
+        finally:
+            del self._in_flight[notificationId]
+            self._in_flight_per_destination[destination] -= 1
+            if not self._in_flight_per_destination[destination]:
+                del self._in_flight_per_destination[destination]
+            notifications_in_flight.dec()
+
+            self._schedule()
+
+    def _notificationSent(self, notificationId, assoc):
+        logger.info("Successfully notified on bind for %s" % (assoc["mxid"],))
+        notifications_sent.inc()
+
+        self.store.deleteNotification(notificationId)
+
+        # Skip the deletion step if instructed so by the config.
+        if not self.sydent.delete_tokens_on_bind:
+            return
+
+        # Only remove sent tokens when they've been successfully sent.
+        try:
+            joinTokenStore = JoinTokenStore(self.sydent)
+            joinTokenStore.deleteTokens(assoc["medium"], assoc["address"])
+            logger.info(
+                "Successfully deleted invite for %s from the store",
+                assoc["address"],
+            )
+        except Exception:
+            logger.exception(
+                "Couldn't remove invite for %s from the store",
+                assoc["address"],
+            )
+
+    def _notificationFailed(self, notificationId, destination, assoc, attempts, error):
+        notification_failures.inc()
+
+        delay = self._retryInterval(attempts)
+        logger.warning(
+            "Error notifying on bind for %s: %s - retrying in %.1fs",
+            assoc["mxid"],
+            error,
+            delay,
+        )
+
+        nextAttemptTs = self._now() + int(delay * 1000)
+        self.store.rescheduleNotification(notificationId, attempts + 1, nextAttemptTs)
+        self.store.deferDestination(destination, nextAttemptTs)
+
+    def _now(self):
+        """
+        :return: The current time in milliseconds, as given by the reactor's clock.
+        :rtype: int
+        """
+        return int(self.sydent.reactor.seconds() * 1000)
+
+    def _retryInterval(self, attempts):
+        """
+        :param attempts: The number of previous attempts to send a notification.
+        :type attempts: int
+
+        :return: How long to wait (in seconds) before the next attempt.
+        :rtype: float
+        """
+        # Don't bother computing huge powers of 2 that will be capped anyway.
+        delay = min(self.max_retry_interval, 2 ** min(attempts, 32))
+        # Spread out the retries of notifications that failed at the same time.
+        return delay * random.uniform(0.5, 1.0)
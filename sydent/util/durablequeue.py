@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import logging
+import random
+
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+# How often (in seconds) to look for items that have become due
+POLL_INTERVAL = 5.0
+
+# How long (in seconds) to wait before retrying an item the first time
+MIN_RETRY_INTERVAL = 5
+
+
+class DurableQueue:
+    """
+    Base class of the queues sending items stored in the database in the background,
+    so that request handlers don't wait on the remote service and the items survive
+    a restart.
+
+    The queue is processed every POLL_INTERVAL seconds, whenever an item is queued
+    or done with, and when a rate-limited item can be sent. Subclasses implement
+    _startDue to start sending as many due items as their concurrency and rate
+    limits allow, and set max_retry_interval.
+
+    :param sydent: The Sydent instance.
+    :type sydent: sydent.sydent.Sydent
+    :param store: The store of the queue, with a getQueueStats method.
+    :type store: sydent.db.email_queue.EmailQueueStore or
+        sydent.db.sms_queue.SmsQueueStore
+    """
+
+    # What's queued, for log messages
+    description = None
+    # The gauges of the number of items in the queue, and of the age of the oldest
+    queueDepth = None
+    oldestPendingAge = None
+
+    # The maximum time (in seconds) to wait before retrying an item
+    max_retry_interval = None
+
+    def __init__(self, sydent, store):
+        self.sydent = sydent
+        self.store = store
+
+        # The limiters of the rate of items sent to each destination. Only the
+        # destinations items were sent to recently have one.
+        self._rate_limiters = {}
+
+        # The IDs of the items being sent
+        self._in_flight = set()
+
+        self._process_scheduled = None
+
+    def setup(self):
+        cb = task.LoopingCall(self._process)
+        cb.clock = self.sydent.reactor
+        cb.start(POLL_INTERVAL)
+
+    def _schedule(self, delay=0):
+        """Processes the queue after the given delay (in seconds), unless that's
+        already planned to happen sooner.
+        """
+        when = self.sydent.reactor.seconds() + delay
+        if self._process_scheduled is not None:
+            if self._process_scheduled.getTime() <= when:
+                return
+            self._process_scheduled.cancel()
+        self._process_scheduled = self.sydent.reactor.callLater(delay, self._process)
+
+    def _process(self):
+        """Starts sending as many due items as the concurrency and rate limits
+        allow.
+        """
+        if self._process_scheduled is not None:
+            if self._process_scheduled.active():
+                self._process_scheduled.cancel()
+            self._process_scheduled = None
+
+        try:
+            self._startDue()
+        except Exception:
+            logger.exception("Error processing the %s queue", self.description)
+
+        # Forget about the destinations which haven't been sent to for a while.
+        for destination, limiter in list(self._rate_limiters.items()):
+            if limiter.isFull():
+                del self._rate_limiters[destination]
+
+        try:
+            count, oldest = self.store.getQueueStats()
+            self.queueDepth.set(count)
+            self.oldestPendingAge.set(
+                (self._now() - oldest) / 1000.0 if oldest is not None else 0
+            )
+        except Exception:
+            logger.exception("Error reading the size of the %s queue", self.description)
+
+    def _startDue(self):
+        """Starts sending as many due items as the concurrency and rate limits
+        allow, and schedules processing the queue again for when a rate-limited one
+        can be sent.
+        """
+        raise NotImplementedError()
+
+    def _now(self):
+        """
+        :return: The current time in milliseconds, as given by the reactor's clock.
+        :rtype: int
+        """
+        return int(self.sydent.reactor.seconds() * 1000)
+
+    def _retryInterval(self, attempts):
+        """
+        :param attempts: The number of previous attempts to send an item.
+        :type attempts: int
+
+        :return: How long to wait (in seconds) before the next attempt.
+        :rtype: float
+        """
+        # Don't bother computing huge powers of 2 that will be capped anyway.
+        delay = min(
+            self.max_retry_interval, MIN_RETRY_INTERVAL * 2 ** min(attempts, 32)
+        )
+        # Spread out the retries of items that failed at the same time.
+        return delay * random.uniform(0.5, 1.0)
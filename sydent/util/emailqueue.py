@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import logging
+from smtplib import SMTPDataError, SMTPRecipientsRefused
+
+from prometheus_client import Counter, Gauge
+from twisted.internet import defer
+
+from sydent.db.email_queue import EmailQueueStore
+from sydent.util.durablequeue import DurableQueue
+from sydent.util.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of due emails to read from the queue at a time, on top of the ones
+# already being sent
+EMAILS_READ_LIMIT = 500
+
+queue_depth = Gauge(
+    "sydent_email_queue_depth",
+    "Number of emails waiting to be sent",
+)
+oldest_pending_age = Gauge(
+    "sydent_email_queue_oldest_pending_age_seconds",
+    "Time since the oldest email waiting to be sent was queued",
+)
+emails_dropped = Counter(
+    "sydent_email_queue_dropped_total",
+    "Number of emails given up on, because they were refused or failed too often",
+)
+
+
+class EmailQueue(DurableQueue):
+    """
+    Sends the emails queued in the database in the background, so that request
+    handlers don't wait on the SMTP server and the emails survive a restart.
+
+    Due emails are sent in batches, each over a single connection, with at most one
+    batch in flight per connection the SMTP transport may open. The number of emails
+    sent per second is limited overall and per recipient domain, so that a burst of
+    requests doesn't get us throttled or flagged by the relay or the recipients'
+    servers. An email that couldn't be sent is retried after an exponential backoff,
+    capped and jittered, unless the server refused it permanently.
+    """
+
+    description = "email"
+    queueDepth = queue_depth
+    oldestPendingAge = oldest_pending_age
+
+    def __init__(self, sydent):
+        super().__init__(sydent, EmailQueueStore(sydent))
+
+        self.batch_size = self.sydent.cfg.getint("email", "email.queue.batch_size")
+        self.max_attempts = self.sydent.cfg.getint("email", "email.queue.max_attempts")
+        self.max_retry_interval = self.sydent.cfg.getint(
+            "email", "email.queue.max_retry_interval"
+        )
+        self.domain_rate = self.sydent.cfg.getfloat("email", "email.queue.domain_rate")
+
+        # The limiter of the rate of emails sent overall, on top of the ones of the
+        # rate of emails sent to each domain
+        self._overall_rate_limiter = TokenBucket(
+            self.sydent.cfg.getfloat("email", "email.queue.rate"),
+            self.sydent.reactor.seconds,
+        )
+
+        self._batches_in_flight = 0
+
+    def enqueue(self, mailFrom, mailTo, message):
+        """
+        Queues an email, to be sent straight away if the rate limits allow it.
+
+        :param mailFrom: The address to send the email from.
+        :type mailFrom: unicode
+        :param mailTo: The address to send the email to.
+        :type mailTo: unicode
+        :param message: The email, with its headers.
+        :type message: bytes
+        """
+        domain = mailTo.rsplit("@", 1)[-1].lower()
+        self.store.addEmail(mailFrom, mailTo, domain, message, self._now())
+        # Process the queue once for all the emails queued by the current requests,
+        # rather than once for each of them.
+        self._schedule()
+
+    def _startDue(self):
+        max_batches = self.sydent.smtpTransport.max_connections
+        if self._batches_in_flight >= max_batches:
+            return
+
+        due = self.store.getDueEmails(
+            self._now(), EMAILS_READ_LIMIT + len(self._in_flight)
+        )
+
+        batch = []
+        # How long (in seconds) until a rate-limited email can be sent
+        wait = None
+        for row in due:
+            emailId, domain, _ = row
+            if emailId in self._in_flight:
+                continue
+
+            domain_limiter = self._rate_limiters.get(domain)
+            if domain_limiter is None:
+                domain_limiter = TokenBucket(
+                    self.domain_rate, self.sydent.reactor.seconds
+                )
+                self._rate_limiters[domain] = domain_limiter
+
+            domain_wait = domain_limiter.timeUntilAvailable()
+            if domain_wait > 0:
+                wait = domain_wait if wait is None else min(wait, domain_wait)
+                continue
+
+            if not self._overall_rate_limiter.tryTake():
+                wait = self._overall_rate_limiter.timeUntilAvailable()
+                break
+            domain_limiter.tryTake()
+
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                self._sendBatch(self._loadBatch(batch))
+                batch = []
+                if self._batches_in_flight >= max_batches:
+                    return
+
+        if batch:
+            self._sendBatch(self._loadBatch(batch))
+
+        if wait is not None:
+            self._schedule(wait)
+
+    def _loadBatch(self, batch):
+        """
+        Reads the emails of a batch to send, which are only read once picked so that
+        the ones held back by the rate limits aren't read over and over again.
+
+        :param batch: The ID, recipient domain and number of previous attempts of
+            each email, as returned by getDueEmails.
+        :type batch: list[tuple[int, unicode, int]]
+
+        :return: The ID, number of previous attempts, sender, recipient and content
+            of each email.
+        :rtype: list[tuple[int, int, unicode, unicode, bytes]]
+        """
+        emails = self.store.getEmails([emailId for emailId, _, _ in batch])
+        return [
+            (emailId, attempts) + emails[emailId]
+            for emailId, _, attempts in batch
+            if emailId in emails
+        ]
+
+    @defer.inlineCallbacks
+    def _sendBatch(self, batch):
+        """
+        Sends a batch of emails over a single connection, and either removes each of
+        them from the queue or schedules another attempt depending on the outcome.
+
+        :param batch: The ID, number of previous attempts, sender, recipient and
+            content of each email to send.
+        :type batch: list[tuple[int, int, unicode, unicode, bytes]]
+        """
+        for row in batch:
+            self._in_flight.add(row[0])
+        self._batches_in_flight += 1
+
+        logger.info("Sending %d queued emails", len(batch))
+
+        try:
+            results = yield self.sydent.smtpTransport.sendBatch(
+                [
+                    (mailFrom, mailTo, message)
+                    for _, _, mailFrom, mailTo, message in batch
+                ]
+            )
+        except Exception as e:
+            results = [e] * len(batch)
+
+        try:
+            for row, error in zip(batch, results):
+                emailId, attempts, _, mailTo, _ = row
+                if error is None:
+                    logger.info("Sent mail to %s", mailTo)
+                    self.store.deleteEmail(emailId)
+                else:
+                    self._emailFailed(emailId, mailTo, attempts, error)
+        except Exception:
+            logger.exception("Error recording the outcome of sending queued emails")
+        finally:
+            for row in batch:
+                self._in_flight.discard(row[0])
+            self._batches_in_flight -= 1
+
+            self._schedule()
+
+    def _emailFailed(self, emailId, mailTo, attempts, error):
+        if self._isPermanentFailure(error) or attempts + 1 >= self.max_attempts:
+            logger.warning(
+                "Error sending mail to %s: %s - giving up after %d attempts",
+                mailTo,
+                error,
+                attempts + 1,
+            )
+            emails_dropped.inc()
+            self.store.deleteEmail(emailId)
+            return
+
+        delay = self._retryInterval(attempts)
+        logger.warning(
+            "Error sending mail to %s: %s - retrying in %.1fs", mailTo, error, delay
+        )
+        self.store.rescheduleEmail(
+            emailId, attempts + 1, self._now() + int(delay * 1000)
+        )
+
+    def _isPermanentFailure(self, error):
+        """
+        :param error: The error sending an email failed with.
+        :type error: Exception
+
+        :return: Whether the SMTP server refused the email in a way that trying
+            again won't change. Failures to connect or log in, and refusals of the
+            sender, are a problem on our side rather than with the email, so they're
+            retried.
+        :rtype: bool
+        """
+        if isinstance(error, SMTPRecipientsRefused):
+            return all(500 <= code < 600 for code, _ in error.recipients.values())
+        if isinstance(error, SMTPDataError):
+            return 500 <= error.smtp_code < 600
+        return False
@@ -21,8 +21,19 @@ import random
 import smtplib
 import email.utils
 import string
-import twisted.python.log
+import threading
+import time
+from smtplib import (
+    SMTPDataError,
+    SMTPRecipientsRefused,
+    SMTPSenderRefused,
+    SMTPServerDisconnected,
+)
+
 import six
+from prometheus_client import Counter, Histogram
+from twisted.internet import task, threads
+from twisted.python.threadpool import ThreadPool
 from six.moves import urllib
 from six.moves import range
 
@@ -38,21 +49,42 @@ from sydent.util.tokenutils import generateAlphanumericTokenOfLength
 
 logger = logging.getLogger(__name__)
 
+emails_sent = Counter(
+    "sydent_emails_sent_total",
+    "Number of emails handed over to the SMTP server",
+)
+email_send_failures = Counter(
+    "sydent_email_send_failures_total",
+    "Number of emails which couldn't be handed over to the SMTP server",
+)
+email_send_duration = Histogram(
+    "sydent_email_send_duration_seconds",
+    "Time taken to hand an email over to the SMTP server, including connecting to it",
+)
+smtp_connections_opened = Counter(
+    "sydent_smtp_connections_opened_total",
+    "Number of connections opened to the SMTP server",
+)
+
 
-def sendEmail(sydent, templateFile, mailTo, substitutions):
+def sendEmail(sydent, template, mailTo, substitutions):
     """
     Sends an email with the given parameters.
 
     :param sydent: The Sydent instance to use when building the configuration to send the
         email with.
     :type sydent: sydent.sydent.Sydent
-    :param templateFile: The filename of the template to use when building the body of the
-        email.
-    :type templateFile: str
+    :param template: The template to use when building the body of the email.
+    :type template: sydent.util.templates.Template
     :param mailTo: The email address to send the email to.
     :type mailTo: unicode
     :param substitutions: The substitutions to use with the template.
     :type substitutions: dict[str, str]
+
+    The email is queued, and sent in the background by sydent.emailQueue.
+
+    :raise EmailAddressException: The email address is invalid.
+    :raise EmailSendException: The email couldn't be queued.
     """
     mailFrom = sydent.cfg.get("email", "email.from")
 
@@ -71,17 +103,25 @@ def sendEmail(sydent, templateFile, mailTo, substitutions):
         }
     )
 
+    # Only compute the variants of the substitutions which the template uses.
     allSubstitutions = {}
-    for k, v in substitutions.items():
-        allSubstitutions[k] = v
-        allSubstitutions[k + "_forhtml"] = escape(v)
-        allSubstitutions[k + "_forurl"] = urllib.parse.quote(v)
+    for placeholder in template.placeholders:
+        if placeholder in substitutions:
+            allSubstitutions[placeholder] = substitutions[placeholder]
+        elif placeholder.endswith("_forhtml"):
+            k = placeholder[: -len("_forhtml")]
+            if k in substitutions:
+                allSubstitutions[placeholder] = escape(substitutions[k])
+        elif placeholder.endswith("_forurl"):
+            k = placeholder[: -len("_forurl")]
+            if k in substitutions:
+                allSubstitutions[placeholder] = urllib.parse.quote(substitutions[k])
 
     # We add randomize the multipart boundary to stop user input from
     # conflicting with it.
     allSubstitutions["multipart_boundary"] = generateAlphanumericTokenOfLength(32)
 
-    mailString = open(templateFile).read() % allSubstitutions
+    mailString = template.render(allSubstitutions)
     parsedFrom = email.utils.parseaddr(mailFrom)[1]
     parsedTo = email.utils.parseaddr(mailTo)[1]
     if parsedFrom == "" or parsedTo == "":
@@ -92,40 +132,265 @@ def sendEmail(sydent, templateFile, mailTo, substitutions):
         logger.info("Parsed to address changed the address: %s -> %s", mailTo, parsedTo)
         raise EmailAddressException()
 
-    mailServer = sydent.cfg.get("email", "email.smtphost")
-    mailPort = sydent.cfg.get("email", "email.smtpport")
-    mailUsername = sydent.cfg.get("email", "email.smtpusername")
-    mailPassword = sydent.cfg.get("email", "email.smtppassword")
-    mailTLSMode = sydent.cfg.get("email", "email.tlsmode")
-    logger.info(
-        "Sending mail to %s with mail server: %s"
-        % (
-            mailTo,
-            mailServer,
-        )
-    )
+    logger.info("Queueing mail to %s", mailTo)
+
+    # We're using the parsing above to do basic validation, but instead of
+    # failing it may munge the address it returns. So we should *not* use
+    # that parsed address, as it may not match any validation done
+    # elsewhere.
     try:
+        sydent.emailQueue.enqueue(mailFrom, mailTo, mailString.encode("utf-8"))
+    except Exception as origException:
+        logger.exception("Error queueing mail to %s", mailTo)
+        ese = EmailSendException()
+        ese.cause = origException
+        raise ese
+
+
+class SmtpTransport(object):
+    """
+    Sends emails through the configured SMTP server without blocking the reactor.
+
+    smtplib is blocking, so emails are sent from a dedicated pool of threads, each
+    using its own connection to the server. Connections (and the login done on them)
+    are kept open between emails and reused, until they've been idle for
+    email.smtp.idle_timeout seconds. Idle connections are checked for expiry
+    that often, and all closed on shutdown.
+
+    :param sydent: The Sydent instance.
+    :type sydent: sydent.sydent.Sydent
+    :param clock: The function to get the current time (in seconds) from, to tell
+        how long connections have been idle. Defaults to the reactor's clock.
+    :type clock: callable[[], float] or None
+    """
+
+    def __init__(self, sydent, clock=None):
+        self.sydent = sydent
+        self.clock = clock or sydent.reactor.seconds
+
+        self.max_connections = sydent.cfg.getint("email", "email.smtp.max_connections")
+        self.timeout = sydent.cfg.getfloat("email", "email.smtp.timeout")
+        self.idle_timeout = sydent.cfg.getfloat("email", "email.smtp.idle_timeout")
+
+        # Started when the first email is sent
+        self.threadpool = ThreadPool(
+            minthreads=0, maxthreads=self.max_connections, name="smtp"
+        )
+        self._started = False
+
+        # The idle connections, and the time they were last used, least recently
+        # used first. Shared between the threads of the pool.
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def send(self, mailFrom, mailTo, message):
+        """
+        Sends an email.
+
+        :param mailFrom: The address to send the email from.
+        :type mailFrom: unicode
+        :param mailTo: The address to send the email to.
+        :type mailTo: unicode
+        :param message: The email, with its headers.
+        :type message: bytes
+
+        :return: A deferred which resolves once the email has been handed over to
+            the SMTP server.
+        :rtype: twisted.internet.defer.Deferred[None]
+        """
+
+        def _checkResult(results):
+            if results[0] is not None:
+                raise results[0]
+
+        d = self.sendBatch([(mailFrom, mailTo, message)])
+        d.addCallback(_checkResult)
+        return d
+
+    def sendBatch(self, messages):
+        """
+        Sends several emails, one after the other over the same connection.
+
+        :param messages: The sender, recipient and content (with its headers) of each
+            email.
+        :type messages: list[tuple[unicode, unicode, bytes]]
+
+        :return: A deferred which resolves once every email has been handed over to
+            the SMTP server or failed to, to the error each one failed with (None if
+            it was sent), in the same order.
+        :rtype: twisted.internet.defer.Deferred[list[Exception or None]]
+        """
+        if not self._started:
+            self._start()
+
+        return threads.deferToThreadPool(
+            self.sydent.reactor,
+            self.threadpool,
+            self._sendBatch,
+            messages,
+        )
+
+    def _start(self):
+        self._started = True
+        self.threadpool.start()
+
+        cb = task.LoopingCall(self._sweepIdle)
+        cb.clock = self.sydent.reactor
+        # Don't check in a busy loop if connections aren't meant to be kept open.
+        cb.start(max(self.idle_timeout, 1.0), now=False)
+
+        self.sydent.reactor.addSystemEventTrigger("before", "shutdown", cb.stop)
+        self.sydent.reactor.addSystemEventTrigger(
+            "before", "shutdown", self._closeAllIdle
+        )
+        self.sydent.reactor.addSystemEventTrigger(
+            "during", "shutdown", self.threadpool.stop
+        )
+
+    def _sweepIdle(self):
+        """Closes the connections which have been idle for too long, in the pool so
+        as not to block the reactor on the server.
+        """
+        return threads.deferToThreadPool(
+            self.sydent.reactor,
+            self.threadpool,
+            self._closeIdle,
+            self.idle_timeout,
+        )
+
+    def _closeAllIdle(self):
+        """
+        :return: A deferred which resolves once every idle connection has been
+            closed, so that shutdown waits for it.
+        :rtype: twisted.internet.defer.Deferred[None]
+        """
+        return threads.deferToThreadPool(
+            self.sydent.reactor,
+            self.threadpool,
+            self._closeIdle,
+            0,
+        )
+
+    def _closeIdle(self, idle_timeout):
+        """
+        Closes the connections which have been idle for at least the given time.
+
+        :param idle_timeout: The time (in seconds).
+        :type idle_timeout: float
+        """
+        now = self.clock()
+        expired = []
+
+        with self._lock:
+            while self._idle and now - self._idle[0][1] >= idle_timeout:
+                expired.append(self._idle.pop(0)[0])
+
+        for conn in expired:
+            self._close(conn)
+
+    def _sendBatch(self, messages):
+        # Runs in a thread of the pool.
+        results = []
+
+        try:
+            smtp, reused = self._getConnection()
+        except Exception as e:
+            email_send_failures.inc(len(messages))
+            return [e] * len(messages)
+
+        for mailFrom, mailTo, message in messages:
+            start = time.time()
+            try:
+                try:
+                    smtp.sendmail(mailFrom, mailTo, message)
+                except SMTPServerDisconnected:
+                    if not reused:
+                        raise
+                    # The server closed the connection since we last used it, try
+                    # again with a new one.
+                    self._close(smtp)
+                    smtp = self._connect()
+                    smtp.sendmail(mailFrom, mailTo, message)
+            except (SMTPRecipientsRefused, SMTPSenderRefused, SMTPDataError) as e:
+                # The server refused this email, but the connection can still be
+                # used for the next ones.
+                email_send_failures.inc()
+                results.append(e)
+                continue
+            except Exception as e:
+                # The connection is unusable, fail this email and the ones after it.
+                remaining = len(messages) - len(results)
+                email_send_failures.inc(remaining)
+                self._close(smtp)
+                results.extend([e] * remaining)
+                return results
+
+            reused = True
+            emails_sent.inc()
+            email_send_duration.observe(time.time() - start)
+            results.append(None)
+
+        with self._lock:
+            self._idle.append((smtp, self.clock()))
+
+        return results
+
+    def _getConnection(self):
+        """
+        :return: A connection to the SMTP server, and whether it was reused.
+        :rtype: tuple[smtplib.SMTP, bool]
+        """
+        self._closeIdle(self.idle_timeout)
+
+        smtp = None
+        with self._lock:
+            if self._idle:
+                smtp = self._idle.pop()[0]
+
+        if smtp is not None:
+            return smtp, True
+
+        return self._connect(), False
+
+    def _connect(self):
+        """
+        Opens a new connection to the SMTP server, and logs in if configured to.
+
+        :return: The connection.
+        :rtype: smtplib.SMTP
+        """
+        mailServer = self.sydent.cfg.get("email", "email.smtphost")
+        mailPort = self.sydent.cfg.get("email", "email.smtpport")
+        mailUsername = self.sydent.cfg.get("email", "email.smtpusername")
+        mailPassword = self.sydent.cfg.get("email", "email.smtppassword")
+        mailTLSMode = self.sydent.cfg.get("email", "email.tlsmode")
+
+        myHostname = self.sydent.cfg.get("email", "email.hostname")
+        if myHostname == "":
+            myHostname = socket.getfqdn()
+
+        logger.info("Connecting to mail server %s", mailServer)
+        smtp_connections_opened.inc()
+
         if mailTLSMode == "SSL" or mailTLSMode == "TLS":
-            smtp = smtplib.SMTP_SSL(mailServer, mailPort, myHostname)
+            smtp = smtplib.SMTP_SSL(
+                mailServer, mailPort, myHostname, timeout=self.timeout
+            )
         elif mailTLSMode == "STARTTLS":
-            smtp = smtplib.SMTP(mailServer, mailPort, myHostname)
+            smtp = smtplib.SMTP(mailServer, mailPort, myHostname, timeout=self.timeout)
             smtp.starttls()
         else:
-            smtp = smtplib.SMTP(mailServer, mailPort, myHostname)
+            smtp = smtplib.SMTP(mailServer, mailPort, myHostname, timeout=self.timeout)
         if mailUsername != "":
             smtp.login(mailUsername, mailPassword)
 
-        # We're using the parsing above to do basic validation, but instead of
-        # failing it may munge the address it returns. So we should *not* use
-        # that parsed address, as it may not match any validation done
-        # elsewhere.
-        smtp.sendmail(mailFrom, mailTo, mailString.encode("utf-8"))
-        smtp.quit()
-    except Exception as origException:
-        twisted.python.log.err()
-        ese = EmailSendException()
-        ese.cause = origException
-        raise ese
+        return smtp
+
+    def _close(self, smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
 
 
 class EmailAddressException(Exception):
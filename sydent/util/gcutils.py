@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import gc
+import logging
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+gc_time = Histogram(
+    "sydent_gc_time_seconds",
+    "Time taken by garbage collections, by generation",
+    ["gen"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+gc_unreachable = Counter(
+    "sydent_gc_unreachable_total",
+    "Number of unreachable objects found by garbage collections, by generation",
+    ["gen"],
+)
+gc_frozen_objects = Gauge(
+    "sydent_gc_frozen_objects",
+    "Number of objects moved out of the reach of garbage collections after startup",
+)
+
+
+class GarbageCollector:
+    """
+    Runs the garbage collections from the reactor's loop rather than letting Python
+    trigger them at any allocation (see
+    https://github.com/getsentry/sentry-python/issues/803).
+
+    Every second, the oldest generation whose allocation count is over its
+    threshold (gc.thresholds) is collected, unless it was already collected less
+    than gc.min_intervals seconds ago. Together with gc.freeze() after startup,
+    which takes the long-lived objects out of the heap collections scan, this keeps
+    the costly collections of the oldest generation rare and short, even when
+    building large responses allocates a lot.
+    """
+
+    def __init__(self, sydent):
+        self.sydent = sydent
+
+        self.thresholds = self._parseList("gc.thresholds", int)
+        self.min_intervals = self._parseList("gc.min_intervals", float)
+        if len(self.thresholds) != 3 or len(self.min_intervals) != 3:
+            raise Exception(
+                "gc.thresholds and gc.min_intervals must have one value per "
+                "generation, separated by commas"
+            )
+
+        # When each generation was last collected, as given by the reactor's clock
+        self._last_collected = [float("-inf")] * 3
+
+    def setup(self):
+        gc.disable()
+        gc.set_threshold(*self.thresholds)
+
+        cb = task.LoopingCall(self.collect)
+        cb.clock = self.sydent.reactor
+        cb.start(1.0)
+
+    def collect(self):
+        """Collects the oldest generation which is due a collection, if any."""
+        now = self.sydent.reactor.seconds()
+        counts = gc.get_count()
+        for gen in reversed(range(3)):
+            if counts[gen] <= self.thresholds[gen]:
+                continue
+            if now - self._last_collected[gen] < self.min_intervals[gen]:
+                continue
+
+            start = time.perf_counter()
+            unreachable = gc.collect(gen)
+            duration = time.perf_counter() - start
+
+            gc_time.labels(str(gen)).observe(duration)
+            gc_unreachable.labels(str(gen)).inc(unreachable)
+
+            if duration > 0.1:
+                logger.info(
+                    "Collecting generation %d took %.0fms (%d unreachable objects)",
+                    gen,
+                    duration * 1000,
+                    unreachable,
+                )
+
+            # Collecting a generation collects the younger ones too.
+            for younger in range(gen + 1):
+                self._last_collected[younger] = now
+            return
+
+    def freeze(self):
+        """
+        Moves every object currently tracked to a permanent generation which
+        collections ignore. Meant to be called once startup is over, when most of
+        the objects around (servlets, stores, keys, caches...) live until shutdown.
+
+        Does nothing before Python 3.7, which doesn't have gc.freeze().
+        """
+        if not hasattr(gc, "freeze"):
+            logger.info("Not freezing objects: gc.freeze() needs Python 3.7 or later")
+            return
+
+        gc.collect()
+        gc.freeze()
+
+        frozen = gc.get_freeze_count()
+        gc_frozen_objects.set(frozen)
+        logger.info("Froze %d objects out of the garbage collector's reach", frozen)
+
+    def _parseList(self, option, parse):
+        rawVal = self.sydent.cfg.get("general", option)
+        return [parse(i.strip()) for i in rawVal.split(",")]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import functools
+from typing import NamedTuple
+
+# The maximum number of parsed phone numbers to remember
+PARSE_CACHE_SIZE = 10000
+
+
+class PhoneNumber(NamedTuple):
+    # The number in E.164 format, without the leading '+'
+    msisdn: str
+    # The number in international format, i.e. with spaces in appropriate places to
+    # make it nicer for the humans
+    international: str
+    # The country calling code of the number
+    country_code: int
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_phone_number(raw_phone_number: str, country: str) -> PhoneNumber:
+    """
+    Parses and formats a phone number, remembering the result for the next time the
+    same number is given.
+
+    phonenumbers is only imported when the first phone number is parsed, so that
+    its metadata isn't loaded by servers which never handle any.
+
+    :param raw_phone_number: The phone number as given by the user.
+    :param country: The ISO 3166-1 alpha-2 code of the country to interpret the
+        number as being from, if it isn't in international format.
+
+    :return: The parsed phone number.
+
+    :raise phonenumbers.NumberParseException: The phone number couldn't be parsed.
+    """
+    import phonenumbers
+
+    phone_number_object = phonenumbers.parse(raw_phone_number, country)
+    return PhoneNumber(
+        msisdn=phonenumbers.format_number(
+            phone_number_object, phonenumbers.PhoneNumberFormat.E164
+        )[1:],
+        international=phonenumbers.format_number(
+            phone_number_object, phonenumbers.PhoneNumberFormat.INTERNATIONAL
+        ),
+        country_code=phone_number_object.country_code,
+    )
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+class TokenBucket(object):
+    """
+    Limits the rate of an action, while allowing short bursts of it.
+
+    :param rate: How many times per second the action is allowed on average, or 0
+        for no limit. Up to a second's worth can be done in a burst.
+    :type rate: float
+    :param clock: The function to get the current time (in seconds) from.
+    :type clock: callable[[], float]
+    """
+
+    def __init__(self, rate, clock):
+        self.rate = rate
+        self._clock = clock
+        self._capacity = max(1.0, float(rate))
+        self._tokens = self._capacity
+        self._updated = clock()
+
+    def tryTake(self):
+        """
+        Takes a token, if one is available.
+
+        :return: Whether the action is allowed now.
+        :rtype: bool
+        """
+        if not self.rate:
+            return True
+
+        self._refill()
+        if self._tokens < 1:
+            return False
+
+        self._tokens -= 1
+        return True
+
+    def timeUntilAvailable(self):
+        """
+        :return: The time (in seconds) until a token is available.
+        :rtype: float
+        """
+        if not self.rate:
+            return 0.0
+
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+    def isFull(self):
+        """
+        :return: Whether the bucket has refilled completely, i.e. whether it can be
+            dropped without allowing more than the rate.
+        :rtype: bool
+        """
+        if not self.rate:
+            return True
+
+        self._refill()
+        return self._tokens >= self._capacity
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(
+            self._capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
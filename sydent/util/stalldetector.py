@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from prometheus_client import Counter, Histogram
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+# The directory of the sydent package, to tell our own frames apart from the ones of
+# libraries in stacks
+_SYDENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+
+# Maximum number of call sites to remember stalls for
+MAX_CALL_SITES = 1000
+
+reactor_lag = Histogram(
+    "sydent_reactor_lag_seconds",
+    "How late the reactor ran a call scheduled at a regular interval",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+reactor_stalls = Counter(
+    "sydent_reactor_stalls_total",
+    "Number of times the reactor was blocked for longer than the stall threshold",
+)
+
+
+class ReactorStallDetector(object):
+    """
+    Detects when something blocks the reactor's thread, and finds out what.
+
+    A call scheduled every stall_detector.interval seconds records how late the
+    reactor ran it, and when it last ran. A watchdog thread checks on the latter, and
+    if the reactor hasn't run it for longer than stall_detector.threshold seconds,
+    logs the stack of the reactor's thread. Stalls are counted per call site, i.e.
+    the innermost frame of Sydent's own code in that stack, along with how long they
+    ended up lasting, so that the worst offenders can be found through the internal
+    API.
+    """
+
+    def __init__(self, sydent):
+        self.sydent = sydent
+
+        self.enabled = self.sydent.cfg.getboolean("general", "stall_detector.enabled")
+        self.interval = self.sydent.cfg.getfloat("general", "stall_detector.interval")
+        self.threshold = self.sydent.cfg.getfloat("general", "stall_detector.threshold")
+
+        # Protects the attributes below, which the watchdog thread updates too
+        self._lock = threading.Lock()
+        # When the regular call last ran, as given by time.monotonic()
+        self._last_tick = None
+        # The call site of the stall in progress, if one was detected
+        self._stalled_site = None
+        # The stalls per call site: a dict with the number of stalls, their total and
+        # maximum durations, and the innermost frame of the last one's stack
+        self._call_sites = {}
+
+        self._reactor_thread = None
+        self._stopped = threading.Event()
+
+    def setup(self):
+        """Starts watching the reactor. Must be called from the reactor's thread."""
+        self._reactor_thread = threading.get_ident()
+        self._last_tick = time.monotonic()
+
+        cb = task.LoopingCall(self._tick)
+        cb.clock = self.sydent.reactor
+        cb.start(self.interval, now=False)
+
+        watchdog = threading.Thread(
+            target=self._watch, name="reactor-stall-detector", daemon=True
+        )
+        watchdog.start()
+        self.sydent.reactor.addSystemEventTrigger(
+            "before", "shutdown", self._stopped.set
+        )
+
+    def _tick(self):
+        now = time.monotonic()
+        with self._lock:
+            lag = max(0.0, now - self._last_tick - self.interval)
+            self._last_tick = now
+
+            site = self._stalled_site
+            self._stalled_site = None
+            if site is not None:
+                stats = self._call_sites.get(site)
+                if stats is not None:
+                    stats["total_seconds"] += lag
+                    stats["max_seconds"] = max(stats["max_seconds"], lag)
+
+        reactor_lag.observe(lag)
+        if site is not None:
+            logger.warning("Reactor was blocked for %.3fs in %s", lag, site)
+
+    def _watch(self):
+        while not self._stopped.wait(min(self.interval, self.threshold / 2)):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Error checking for reactor stalls")
+
+    def check(self):
+        """
+        Checks whether the reactor is stalled, and if it is and this is the first
+        check to notice, records where in the code it's blocked.
+        """
+        with self._lock:
+            if self._last_tick is None or self._stalled_site is not None:
+                return
+            stalled_for = time.monotonic() - self._last_tick - self.interval
+            if stalled_for < self.threshold:
+                return
+
+            frame = sys._current_frames().get(self._reactor_thread)
+            if frame is None:
+                return
+            stack = traceback.extract_stack(frame)
+            del frame
+
+            site, blocked_in = _call_site(stack)
+            self._stalled_site = site
+
+            stats = self._call_sites.get(site)
+            if stats is None:
+                if len(self._call_sites) >= MAX_CALL_SITES:
+                    # Make room by forgetting about the site which stalled the least.
+                    del self._call_sites[
+                        min(
+                            self._call_sites, key=lambda s: self._call_sites[s]["count"]
+                        )
+                    ]
+                stats = self._call_sites[site] = {
+                    "count": 0,
+                    "total_seconds": 0.0,
+                    "max_seconds": 0.0,
+                }
+            stats["count"] += 1
+            stats["blocked_in"] = blocked_in
+
+        reactor_stalls.inc()
+        logger.warning(
+            "Reactor has been blocked for %.3fs, in:\n%s",
+            stalled_for,
+            "".join(traceback.format_list(stack)).rstrip(),
+        )
+
+    def getTopCallSites(self, limit):
+        """
+        :param limit: The maximum number of call sites to return.
+        :type limit: int
+
+        :return: The call sites which blocked the reactor for the longest overall,
+            longest first, with their stall statistics.
+        :rtype: list[dict[str, any]]
+        """
+        with self._lock:
+            sites = [dict(stats, site=site) for site, stats in self._call_sites.items()]
+
+        sites.sort(key=lambda s: (s["total_seconds"], s["count"]), reverse=True)
+        return sites[:limit]
+
+
+def _call_site(stack):
+    """
+    :param stack: The stack of a thread, outermost frame first.
+    :type stack: traceback.StackSummary
+
+    :return: A description of the innermost frame of Sydent's code in the stack
+        (or of the innermost frame, if there's none), and of the innermost frame.
+    :rtype: tuple[unicode, unicode]
+    """
+    innermost = _describe(stack[-1])
+    for frame in reversed(stack):
+        if frame.filename.startswith(_SYDENT_DIR):
+            return _describe(frame), innermost
+    return innermost, innermost
+
+
+def _describe(frame):
+    filename = frame.filename
+    if filename.startswith(_SYDENT_DIR):
+        filename = os.path.join("sydent", filename[len(_SYDENT_DIR) :])
+    return "%s:%d in %s" % (filename, frame.lineno, frame.name)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+
+import logging
+import os
+import re
+
+from six.moves import configparser
+
+logger = logging.getLogger(__name__)
+
+# The templates each brand directory should contain, and the deprecated setting
+# which, if defined, overrides the branded template for every brand.
+TEMPLATES = {
+    "invite_template.eml": ("email", "email.invite_template"),
+    "verification_template.eml": ("email", "email.template"),
+    "verify_response_template.html": ("http", "verify_response_template"),
+}
+
+# Matches the placeholders of a %-format template, and escaped % signs
+_PLACEHOLDER_RE = re.compile(r"%%|%\(([^)]*)\)")
+
+
+class Template(object):
+    """
+    A template loaded in memory.
+
+    :param path: The file the template was loaded from.
+    :type path: str
+    :param source: The content of the template, with %(name)s placeholders.
+    :type source: unicode
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+        # The names of the placeholders used in the template
+        self.placeholders = frozenset(
+            m.group(1) for m in _PLACEHOLDER_RE.finditer(source) if m.group(1)
+        )
+
+    def render(self, substitutions):
+        """
+        :param substitutions: The values of the template's placeholders.
+        :type substitutions: dict[str, unicode]
+
+        :return: The rendered template.
+        :rtype: unicode
+
+        :raise KeyError: A placeholder of the template has no value.
+        """
+        return self.source % substitutions
+
+
+class TemplateRegistry(object):
+    """
+    Holds the email and HTML templates of every brand in memory, so they aren't read
+    from disk for each request. The templates are loaded when Sydent starts, and can
+    be reloaded (e.g. on SIGHUP) without restarting it.
+    """
+
+    def __init__(self, sydent):
+        self.sydent = sydent
+
+        # The templates by brand and template name
+        self._templates = {}
+        # The templates set by a deprecated setting, by template name
+        self._overrides = {}
+        self._default_brand = None
+
+        self.reload()
+
+    def reload(self):
+        """
+        (Re)discovers the brands under templates.path and loads their templates. If
+        loading fails, the templates loaded previously are kept.
+        """
+        cfg = self.sydent.cfg
+        templates = {}
+        overrides = {}
+        brands = set()
+
+        # Get the possible brands by looking at directories under the
+        # templates.path directory.
+        root_template_path = cfg.get("general", "templates.path")
+        if os.path.exists(root_template_path):
+            brands = {
+                p
+                for p in os.listdir(root_template_path)
+                if os.path.isdir(os.path.join(root_template_path, p))
+            }
+        # Otherwise this is a legacy setup, which assumes that the deprecated
+        # verify_response_template, email.template, and email.invite_template
+        # are defined.
+
+        for template_name, deprecated_template_name in TEMPLATES.items():
+            try:
+                path = cfg.get(*deprecated_template_name)
+            except configparser.NoOptionError:
+                pass
+            else:
+                overrides[template_name] = self._load(path)
+                continue
+
+            for brand in brands:
+                path = os.path.join(root_template_path, brand, template_name)
+                if os.path.exists(path):
+                    templates[(brand, template_name)] = self._load(path)
+
+        self._templates = templates
+        self._overrides = overrides
+        self._default_brand = cfg.get("general", "brand.default")
+        self.sydent.valid_brands = brands
+
+        logger.info(
+            "Loaded %d templates for brands %s",
+            len(templates) + len(overrides),
+            ", ".join(sorted(brands)),
+        )
+
+    def get(self, brand, template_name):
+        """
+        Gets a (maybe) branded template.
+
+        If the deprecated setting for the template is defined, always use it.
+        Otherwise, attempt to use the hinted brand from the request if the brand
+        is valid. Otherwise, fallback to the default brand.
+
+        :param brand: The hint of which brand to use.
+        :type brand: str or None
+        :param template_name: The name of the template file, one of TEMPLATES.
+        :type template_name: str
+
+        :return: The template.
+        :rtype: Template
+
+        :raise KeyError: There is no such template for the default brand.
+        """
+        override = self._overrides.get(template_name)
+        if override is not None:
+            return override
+
+        template = None
+        if brand:
+            template = self._templates.get((brand, template_name))
+
+        # If the brand hint is not valid, or not provided, fallback to the default brand.
+        if template is None:
+            template = self._templates[(self._default_brand, template_name)]
+
+        return template
+
+    def _load(self, path):
+        with open(path) as f:
+            return Template(path, f.read())
@@ -13,11 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import heapq
 import logging
 import time
+import weakref
 
 import attr
-from sortedcontainers import SortedList
+from prometheus_client import REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 
 logger = logging.getLogger(__name__)
 
@@ -25,16 +29,61 @@ SENTINEL = object()
 
 
 class TTLCache(object):
-    """A key/value cache implementation where each entry has its own TTL"""
+    """A key/value cache implementation where each entry has its own TTL
+
+    Entries are grouped by expiry time into buckets expiry_granularity seconds wide,
+    and a whole bucket is dropped once its time has passed, so that expiring entries
+    costs O(1) each and checking for expired entries O(1) per operation. An entry
+    which has expired is never returned, even if its bucket hasn't been dropped yet.
+
+    :param cache_name: The name of the cache.
+    :type cache_name: str
+    :param timer: The function to get the current time (in seconds) from.
+    :type timer: callable[[], float]
+    :param max_size: The maximum number of entries in the cache, or None for no
+        limit. Once it is reached, adding an entry evicts the least recently used
+        one.
+    :type max_size: int or None
+    :param expiry_granularity: The width (in seconds) of the expiry buckets.
+    :type expiry_granularity: float
+    :param export_metrics: Whether to export the size of the cache and its hit,
+        miss and eviction counts to Prometheus, labelled with the cache's name.
+    :type export_metrics: bool
+    """
+
+    def __init__(
+        self,
+        cache_name,
+        timer=time.time,
+        max_size=None,
+        expiry_granularity=1.0,
+        export_metrics=False,
+    ):
+        self.cache_name = cache_name
+
+        # map from key to _CacheEntry, least recently used first
+        self._data = collections.OrderedDict()
+
+        # map from bucket index to the keys of the entries expiring in that bucket
+        self._buckets = {}
+        # the indexes of the buckets, as a heap
+        self._bucket_heap = []
 
-    def __init__(self, cache_name, timer=time.time):
-        # map from key to _CacheEntry
-        self._data = {}
+        self._timer = timer
+        self._max_size = max_size
+        self._granularity = expiry_granularity
 
-        # the _CacheEntries, sorted by expiry time
-        self._expiry_list = SortedList()
+        # Number of lookups which found an entry
+        self.hits = 0
+        # Number of lookups which didn't find an entry
+        self.misses = 0
+        # Number of entries evicted to make room for others
+        self.evictions = 0
+        # Number of entries removed because they expired
+        self.expirations = 0
 
-        self._timer = timer
+        if export_metrics:
+            _collector().add(self)
 
     def set(self, key, value, ttl):
         """Add/update an entry in the cache
@@ -46,16 +95,30 @@ class TTLCache(object):
         :param paramttl: TTL for this entry, in seconds.
         :type paramttl: float
         """
-        expiry = self._timer() + ttl
+        now = self._timer()
+        self._expire(now)
+
+        expiry = now + ttl
+        # The entries of a bucket have all expired by the time it starts.
+        bucket = int(-(-expiry // self._granularity))
 
-        self.expire()
         e = self._data.pop(key, SENTINEL)
-        if e != SENTINEL:
-            self._expiry_list.remove(e)
+        if e is not SENTINEL:
+            self._buckets[e.bucket].discard(key)
+
+        self._data[key] = _CacheEntry(expiry_time=expiry, bucket=bucket, value=value)
+
+        keys = self._buckets.get(bucket)
+        if keys is None:
+            keys = self._buckets[bucket] = set()
+            heapq.heappush(self._bucket_heap, bucket)
+        keys.add(key)
 
-        entry = _CacheEntry(expiry_time=expiry, key=key, value=value)
-        self._data[key] = entry
-        self._expiry_list.add(entry)
+        if self._max_size is not None:
+            while len(self._data) > self._max_size:
+                evicted_key, evicted = self._data.popitem(last=False)
+                self._buckets[evicted.bucket].discard(evicted_key)
+                self.evictions += 1
 
     def get(self, key, default=SENTINEL):
         """Get a value from the cache
@@ -66,10 +129,9 @@ class TTLCache(object):
 
         :returns a value from the cache, or the default.
         """
-        self.expire()
-        e = self._data.get(key, SENTINEL)
-        if e == SENTINEL:
-            if default == SENTINEL:
+        e = self._lookup(key)
+        if e is None:
+            if default is SENTINEL:
                 raise KeyError(key)
             return default
         return e.value
@@ -85,11 +147,9 @@ class TTLCache(object):
         Raises:
             KeyError if the entry is not found
         """
-        self.expire()
-        try:
-            e = self._data[key]
-        except KeyError:
-            raise
+        e = self._lookup(key)
+        if e is None:
+            raise KeyError(key)
         return e.value, e.expiry_time
 
     def pop(self, key, default=SENTINEL):
@@ -104,13 +164,16 @@ class TTLCache(object):
 
         :returns a value from the cache, or the default
         """
-        self.expire()
+        now = self._timer()
+        self._expire(now)
         e = self._data.pop(key, SENTINEL)
-        if e == SENTINEL:
-            if default == SENTINEL:
+        if e is SENTINEL or e.expiry_time <= now:
+            if e is not SENTINEL:
+                self._buckets[e.bucket].discard(key)
+            if default is SENTINEL:
                 raise KeyError(key)
             return default
-        self._expiry_list.remove(e)
+        self._buckets[e.bucket].discard(key)
         return e.value
 
     def __getitem__(self, key):
@@ -120,30 +183,136 @@ class TTLCache(object):
         self.pop(key)
 
     def __contains__(self, key):
-        return key in self._data
+        e = self._data.get(key)
+        return e is not None and e.expiry_time > self._timer()
 
     def __len__(self):
+        """The number of entries in the cache. It may include entries which expired
+        less than expiry_granularity seconds ago.
+        """
         self.expire()
         return len(self._data)
 
     def expire(self):
-        """Run the expiry on the cache. Any entries whose expiry times are due will
-        be removed
+        """Run the expiry on the cache. Any entries whose expiry bucket has passed
+        will be removed
+        """
+        self._expire(self._timer())
+
+    def _expire(self, now):
+        heap = self._bucket_heap
+        while heap and heap[0] * self._granularity <= now:
+            bucket = heapq.heappop(heap)
+            for key in self._buckets.pop(bucket, ()):
+                del self._data[key]
+                self.expirations += 1
+
+    def _lookup(self, key):
+        """
+        :param key: The key to look up.
+
+        :return: The entry for the key, if there's one which hasn't expired.
+        :rtype: _CacheEntry or None
         """
         now = self._timer()
-        while self._expiry_list:
-            first_entry = self._expiry_list[0]
-            if first_entry.expiry_time - now > 0.0:
-                break
-            del self._data[first_entry.key]
-            del self._expiry_list[0]
+        self._expire(now)
+
+        e = self._data.get(key)
+        if e is not None and e.expiry_time <= now:
+            # It expired since its bucket started.
+            del self._data[key]
+            self._buckets[e.bucket].discard(key)
+            self.expirations += 1
+            e = None
+
+        if e is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if self._max_size is not None:
+            self._data.move_to_end(key)
+        return e
 
 
 @attr.s(frozen=True, slots=True)
 class _CacheEntry(object):
     """TTLCache entry"""
 
-    # expiry_time is the first attribute, so that entries are sorted by expiry.
     expiry_time = attr.ib()
-    key = attr.ib()
+    # the index of the expiry bucket the entry is in
+    bucket = attr.ib()
     value = attr.ib()
+
+
+class TTLCacheCollector(object):
+    """
+    Exports the size and hit, miss and eviction counts of the caches created with
+    export_metrics, summed by cache name.
+
+    It is only registered with Prometheus once such a cache is created, and keeps
+    track of the caches through weak references, so that caches don't cost anything
+    per operation to instrument.
+    """
+
+    def __init__(self):
+        self._caches = weakref.WeakSet()
+
+    def add(self, cache):
+        """
+        :param cache: The cache to export metrics for.
+        :type cache: TTLCache
+        """
+        self._caches.add(cache)
+
+    def collect(self):
+        size = GaugeMetricFamily(
+            "sydent_cache_size", "Number of entries in the cache", labels=["name"]
+        )
+        hits = CounterMetricFamily(
+            "sydent_cache_hits",
+            "Number of lookups which found an entry in the cache",
+            labels=["name"],
+        )
+        misses = CounterMetricFamily(
+            "sydent_cache_misses",
+            "Number of lookups which didn't find an entry in the cache",
+            labels=["name"],
+        )
+        evictions = CounterMetricFamily(
+            "sydent_cache_evictions",
+            "Number of entries evicted from the cache to make room for others",
+            labels=["name"],
+        )
+
+        totals = collections.defaultdict(lambda: [0, 0, 0, 0])
+        for cache in list(self._caches):
+            total = totals[cache.cache_name]
+            total[0] += len(cache._data)
+            total[1] += cache.hits
+            total[2] += cache.misses
+            total[3] += cache.evictions
+
+        for name, total in sorted(totals.items()):
+            size.add_metric([name], total[0])
+            hits.add_metric([name], total[1])
+            misses.add_metric([name], total[2])
+            evictions.add_metric([name], total[3])
+
+        return [size, hits, misses, evictions]
+
+
+_the_collector = None
+
+
+def _collector():
+    """
+    :return: The collector of the metrics of caches, registered with Prometheus
+        the first time this is called.
+    :rtype: TTLCacheCollector
+    """
+    global _the_collector
+    if _the_collector is None:
+        _the_collector = TTLCacheCollector()
+        REGISTRY.register(_the_collector)
+    return _the_collector
@@ -69,11 +69,7 @@ class EmailValidator:
 
         valSessionStore.setMtime(valSession.id, time_msec())
 
-        templateFile = self.sydent.get_branded_template(
-            brand,
-            "verification_template.eml",
-            ("email", "email.template"),
-        )
+        template = self.sydent.templates.get(brand, "verification_template.eml")
 
         if int(valSession.sendAttemptNumber) >= int(sendAttempt):
             logger.info(
@@ -96,7 +92,7 @@ class EmailValidator:
             nextLink,
             emailAddress,
         )
-        sendEmail(self.sydent, templateFile, emailAddress, substitutions)
+        sendEmail(self.sydent, template, emailAddress, substitutions)
 
         valSessionStore.setSendAttemptNumber(valSession.id, sendAttempt)
 
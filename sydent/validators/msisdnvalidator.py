@@ -17,11 +17,9 @@
 from __future__ import absolute_import
 
 import logging
-import phonenumbers
 
 from sydent.db.valsession import ThreePidValSessionStore
 from sydent.validators import common
-from sydent.sms.openmarket import OpenMarketSMS
 
 from sydent.validators import DestinationRejectedException
 
@@ -33,7 +31,6 @@ logger = logging.getLogger(__name__)
 class MsisdnValidator:
     def __init__(self, sydent):
         self.sydent = sydent
-        self.omSms = OpenMarketSMS(sydent)
 
         # cache originators & sms rules from config file
         self.originators = {}
@@ -73,13 +70,24 @@ class MsisdnValidator:
 
                 self.smsRules[country] = action
 
+        # The originators to use for countries without their own
+        self.defaultOriginators = self.originators.get(
+            "default",
+            [
+                {
+                    "type": "alpha",
+                    "text": "Matrix",
+                }
+            ],
+        )
+
     def requestToken(self, phoneNumber, clientSecret, sendAttempt, brand=None):
         """
         Creates or retrieves a validation session and sends an text message to the
         corresponding phone number address with a token to use to verify the association.
 
         :param phoneNumber: The phone number to send the email to.
-        :type phoneNumber: phonenumbers.PhoneNumber
+        :type phoneNumber: sydent.util.msisdn.PhoneNumber
         :param clientSecret: The client secret to use.
         :type clientSecret: unicode
         :param sendAttempt: The current send attempt.
@@ -97,9 +105,7 @@ class MsisdnValidator:
 
         valSessionStore = ThreePidValSessionStore(self.sydent)
 
-        msisdn = phonenumbers.format_number(
-            phoneNumber, phonenumbers.PhoneNumberFormat.E164
-        )[1:]
+        msisdn = phoneNumber.msisdn
 
         valSession = valSessionStore.getOrCreateTokenSession(
             medium="msisdn", address=msisdn, clientSecret=clientSecret
@@ -128,7 +134,9 @@ class MsisdnValidator:
 
         smsBody = smsBodyTemplate.format(token=valSession.token)
 
-        self.omSms.sendTextSMS(smsBody, msisdn, originator)
+        self.sydent.smsQueue.enqueue(
+            msisdn, str(phoneNumber.country_code), smsBody, originator
+        )
 
         valSessionStore.setSendAttemptNumber(valSession.id, sendAttempt)
 
@@ -139,33 +147,21 @@ class MsisdnValidator:
         Gets an originator for a given phone number.
 
         :param destPhoneNumber: The phone number to find the originator for.
-        :type destPhoneNumber: phonenumbers.PhoneNumber
+        :type destPhoneNumber: sydent.util.msisdn.PhoneNumber
 
         :return: The originator (a dict with a "type" key and a "text" key).
         :rtype: dict[str, str]
         """
-        countryCode = str(destPhoneNumber.country_code)
-
-        origs = [
-            {
-                "type": "alpha",
-                "text": "Matrix",
-            }
-        ]
-        if countryCode in self.originators:
-            origs = self.originators[countryCode]
-        elif "default" in self.originators:
-            origs = self.originators["default"]
+        origs = self.originators.get(
+            str(destPhoneNumber.country_code), self.defaultOriginators
+        )
 
         # deterministically pick an originator from the list of possible
         # originators, so if someone requests multiple codes, they come from
         # a consistent number (if there's any chance that some originators are
         # more likley to work than others, we may want to change, but it feels
         # like this should be something other than just picking one randomly).
-        msisdn = phonenumbers.format_number(
-            destPhoneNumber, phonenumbers.PhoneNumberFormat.E164
-        )[1:]
-        return origs[sum([int(i) for i in msisdn]) % len(origs)]
+        return origs[sum([int(i) for i in destPhoneNumber.msisdn]) % len(origs)]
 
     def validateSessionWithToken(self, sid, clientSecret, token):
         """
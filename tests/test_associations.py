@@ -0,0 +1,126 @@
+import json
+
+from sydent.db.threepid_associations import (
+    GlobalAssociationStore,
+    LocalAssociationStore,
+)
+from sydent.threepid import ThreepidAssociation
+from sydent.util import time_msec
+from tests.utils import make_sydent
+from twisted.trial import unittest
+
+# Far enough in the future for associations to stay valid for the whole test.
+NOT_AFTER = 2**62
+
+
+class GlobalAssociationsMaintenanceTestCase(unittest.TestCase):
+    """Tests the background tasks which keep the global associations table small."""
+
+    def setUp(self):
+        self.sydent = make_sydent()
+        self.store = GlobalAssociationStore(self.sydent)
+
+    def _add(self, origin_server, origin_id, address, mxid, ts, not_after=NOT_AFTER):
+        assoc = ThreepidAssociation(
+            medium="email",
+            address=address,
+            lookup_hash=None,
+            mxid=mxid,
+            ts=ts,
+            not_before=0,
+            not_after=not_after,
+        )
+        self.store.addAssociation(
+            assoc, json.dumps({"mxid": mxid}), origin_server, origin_id, commit=False
+        )
+
+    def _remaining(self):
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT originServer, originId FROM global_threepid_associations"
+        )
+        return sorted(res.fetchall())
+
+    def _wait(self, d):
+        # The compaction yields to the reactor between batches.
+        while not d.called:
+            self.sydent.reactor.advance(0)
+        return self.successResultOf(d)
+
+    def test_history_compaction(self):
+        """Tests that superseded global associations are deleted, and only those."""
+        # Rebound twice: the first two bindings are superseded.
+        self._add("a.server", 1, "bob0@example.com", "@a:example.com", 1)
+        self._add("a.server", 2, "bob0@example.com", "@b:example.com", 2)
+        self._add("a.server", 3, "BOB0@example.com", "@c:example.com", 3)
+        # The newer binding expires first, so the older one is needed afterwards.
+        self._add("a.server", 4, "bob1@example.com", "@a:example.com", 1)
+        self._add(
+            "a.server", 5, "bob1@example.com", "@b:example.com", 2, time_msec() + 1000
+        )
+        # Superseded, but it's the latest association from a.server.
+        self._add("a.server", 6, "bob0@example.com", "@d:example.com", 0)
+        # Associations from different servers aren't compared.
+        self._add("b.server", 1, "bob0@example.com", "@z:example.com", 0)
+        self.sydent.db.commit()
+
+        # Go through the table in batches of two, as the compactor would.
+        last_id, count = self.store.removeSupersededAssociations(-1, 2)
+        self.assertEqual((last_id, count), (2, 2))
+        last_id, count = self.store.removeSupersededAssociations(last_id, 2)
+        self.assertEqual((last_id, count), (4, 0))
+
+        self.assertEqual(self._wait(self.sydent.historyCompactor.compact()), 0)
+        self.assertEqual(
+            self._remaining(),
+            [
+                ("a.server", 3),
+                ("a.server", 4),
+                ("a.server", 5),
+                ("a.server", 6),
+                ("b.server", 1),
+            ],
+        )
+
+        self.assertEqual(self.store.lastIdFromServer("a.server"), 6)
+        self.assertEqual(
+            self.store.getMxid("email", "bob0@example.com"), "@c:example.com"
+        )
+
+        # The hash tree's buckets were kept up to date.
+        buckets = self.store.getHashBuckets("a.server", 0, 0)
+        self.assertEqual(buckets[0][1], 4)
+
+    def test_expired_associations_reaper(self):
+        """Tests that expired associations are deleted from both tables, except for the
+        latest global association from each server, which replication relies on.
+        """
+        now = time_msec()
+        self._add("a.server", 1, "bob0@example.com", "@a:example.com", 1, now - 1)
+        self._add("a.server", 2, "bob1@example.com", "@b:example.com", 2)
+        self._add("a.server", 3, "bob2@example.com", "@c:example.com", 3, now - 1)
+        self._add("b.server", 1, "bob3@example.com", "@d:example.com", 4, now - 1)
+        self.sydent.db.commit()
+
+        local_store = LocalAssociationStore(self.sydent)
+        for i, not_after in enumerate([now - 1, NOT_AFTER, now - 1]):
+            local_store.addOrUpdateAssociation(
+                ThreepidAssociation(
+                    medium="email",
+                    address="alice%d@example.com" % i,
+                    lookup_hash=None,
+                    mxid="@alice%d:example.com" % i,
+                    ts=i,
+                    not_before=0,
+                    not_after=not_after,
+                )
+            )
+
+        self.assertEqual(self._wait(self.sydent.expiredAssociationReaper.reap()), 3)
+
+        self.assertEqual(
+            self._remaining(), [("a.server", 2), ("a.server", 3), ("b.server", 1)]
+        )
+        assocs, _ = local_store.getAssociationsAfterId(None)
+        self.assertEqual(sorted(assocs), [2])
+        self.assertEqual(self.store.getHashBuckets("a.server", 0, 0)[0][1], 2)
@@ -13,6 +13,9 @@
 #  limitations under the License.
 
 import os.path
+import socketserver
+import threading
+
 from mock import Mock, patch
 
 from twisted.web.client import Response
@@ -21,6 +24,7 @@ from twisted.trial import unittest
 from sydent.db.invite_tokens import JoinTokenStore
 from sydent.http.httpclient import FederationHttpClient
 from sydent.http.servlets.store_invite_servlet import StoreInviteServlet
+from sydent.util.emailutils import sendEmail
 from tests.utils import make_request, make_sydent
 
 
@@ -40,6 +44,8 @@ class TestRequestCode(unittest.TestCase):
         # Patch out the email sending so we can investigate the resulting email.
         with patch("sydent.util.emailutils.smtplib") as smtplib:
             request.render(self.sydent.servlets.emailRequestCode)
+            # Let the email queue send the email.
+            self.sydent.reactor.advance(0)
 
         # Fish out the SMTP object and return it.
         smtp = smtplib.SMTP.return_value
@@ -86,3 +92,235 @@ class TestRequestCode(unittest.TestCase):
         # Ensure the email is as expected.
         email_contents = smtp.sendmail.call_args[0][2].decode("utf-8")
         self.assertIn("Confirm your email address for Element", email_contents)
+
+
+class _FakeSmtpHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough SMTP to accept emails, and records them on the server."""
+
+    def handle(self):
+        self.server.connections += 1
+        self._reply(b"220 fake.smtp ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().upper()
+            if command.startswith(b"EHLO") or command.startswith(b"HELO"):
+                self._reply(b"250 fake.smtp")
+            elif command == b"DATA":
+                self._reply(b"354 Go ahead")
+                data = []
+                for data_line in iter(self.rfile.readline, b".\r\n"):
+                    data.append(data_line)
+                self._reply(self.server.data_reply)
+                if self.server.data_reply.startswith(b"250"):
+                    self.server.messages.append(b"".join(data))
+                if self.server.disconnect_after_message:
+                    return
+            elif command == b"QUIT":
+                self._reply(b"221 Bye")
+                return
+            else:
+                self._reply(b"250 OK")
+
+    def _reply(self, line):
+        self.wfile.write(line + b"\r\n")
+        self.wfile.flush()
+
+
+class SmtpTransportTestCase(unittest.TestCase):
+    """Tests sending emails to an SMTP server."""
+
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(
+            ("127.0.0.1", 0), _FakeSmtpHandler
+        )
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.messages = []
+        self.server.disconnect_after_message = False
+        self.server.data_reply = b"250 OK"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        config = {
+            "general": {
+                "templates.path": os.path.join(
+                    os.path.dirname(os.path.dirname(__file__)), "res"
+                ),
+            },
+            "email": {
+                "email.smtphost": "127.0.0.1",
+                "email.smtpport": str(self.server.server_address[1]),
+                "email.hostname": "sydent.test",
+                "email.smtp.idle_timeout": "0.5",
+                "email.queue.batch_size": "2",
+                "email.queue.rate": "0",
+                "email.queue.domain_rate": "0",
+            },
+        }
+        self.sydent = make_sydent(test_config=config)
+        self.transport = self.sydent.smtpTransport
+        self.queue = self.sydent.emailQueue
+
+    def _send(self, n):
+        d = self.transport.send(
+            "noreply@sydent.test", "alice@example.com", b"Subject: %d\r\n\r\nHi" % n
+        )
+        self.successResultOf(d)
+
+    def test_connection_reuse(self):
+        """Check that a connection is reused for following emails while it's recent
+        enough.
+        """
+        self._send(1)
+        self._send(2)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertIn(b"Subject: 2", self.server.messages[1])
+
+        # An idle connection is closed after a while.
+        self.sydent.reactor.advance(0.5)
+        self._send(3)
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.messages), 3)
+
+    def test_idle_connections_closed(self):
+        """Check that idle connections are closed once they've expired without
+        waiting for another email, and on shutdown.
+        """
+        # Idle connections are checked for expiry every second from the first email.
+        for n in range(3):
+            self._send(n)
+            self.sydent.reactor.advance(0.4)
+        self.assertEqual(self.server.connections, 1)
+
+        # The check after a second found it idle for 0.2s, so didn't close it.
+        self.assertEqual(len(self.transport._idle), 1)
+
+        self.sydent.reactor.advance(1)
+        self.assertEqual(self.transport._idle, [])
+
+        self._send(3)
+        self.assertEqual(len(self.transport._idle), 1)
+        for f, args, kwargs in self.sydent.reactor.triggers["before"]["shutdown"]:
+            f(*args, **kwargs)
+        self.assertEqual(self.transport._idle, [])
+
+    def test_reconnect(self):
+        """Check that an email is sent on a new connection if the server closed
+        the idle one.
+        """
+        self.server.disconnect_after_message = True
+
+        self._send(1)
+        self._send(2)
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.messages), 2)
+
+    def _queued(self):
+        """Returns the emails in the queue, whether they're due or not."""
+        return self.queue.store.getDueEmails(2**62, 100)
+
+    def test_failure(self):
+        """Check that an email which couldn't be sent is kept in the queue and
+        retried later.
+        """
+        self.server.server_close()
+        self.server.shutdown()
+
+        sendEmail(
+            self.sydent,
+            self.sydent.templates.get(None, "verification_template.eml"),
+            "alice@example.com",
+            {"ipaddress": "", "link": "", "token": ""},
+        )
+        self.sydent.reactor.advance(0)
+
+        queued = self._queued()
+        self.assertEqual(len(queued), 1)
+        emailId, _, attempts = queued[0]
+        self.assertEqual(attempts, 1)
+        self.assertEqual(
+            self.queue.store.getEmails([emailId])[emailId][1], "alice@example.com"
+        )
+        # It isn't due again straight away.
+        self.assertEqual(self.queue.store.getDueEmails(self.queue._now(), 100), [])
+
+    def test_retry(self):
+        """Check that an email refused with a transient error is sent again after
+        a backoff.
+        """
+        self.server.data_reply = b"451 Try again later"
+        self.queue.enqueue("noreply@sydent.test", "alice@example.com", b"Hi")
+        self.sydent.reactor.advance(0)
+        self.assertEqual(len(self._queued()), 1)
+        self.assertEqual(self.server.messages, [])
+
+        self.server.data_reply = b"250 OK"
+        self.sydent.reactor.advance(5)
+        # The queue is polled for the emails which have become due.
+        self.queue._process()
+        self.assertEqual(self._queued(), [])
+        self.assertEqual(self.server.messages, [b"Hi\r\n"])
+
+    def test_permanent_failure(self):
+        """Check that an email refused with a permanent error is given up on."""
+        self.server.data_reply = b"550 No such user"
+        self.queue.enqueue("noreply@sydent.test", "alice@example.com", b"Hi")
+        self.sydent.reactor.advance(0)
+        self.assertEqual(self._queued(), [])
+        self.assertEqual(self.server.messages, [])
+
+    def test_batches(self):
+        """Check that several due emails are sent over the same connection at
+        once.
+        """
+        self.transport.sendBatch = Mock(side_effect=self.transport.sendBatch)
+        for n in range(3):
+            self.queue.store.addEmail(
+                "noreply@sydent.test",
+                "user%d@example.com" % n,
+                "example.com",
+                b"Hi %d" % n,
+                self.queue._now(),
+            )
+
+        self.queue._process()
+        self.assertEqual(self._queued(), [])
+        self.assertEqual(len(self.server.messages), 3)
+        # Two batches of at most email.queue.batch_size emails.
+        self.assertEqual(self.transport.sendBatch.call_count, 2)
+        self.assertEqual(len(self.transport.sendBatch.call_args_list[0][0][0]), 2)
+
+    def test_domain_rate_limit(self):
+        """Check that the emails to a domain are sent no faster than the configured
+        rate, without holding back the emails to other domains.
+        """
+        self.queue.domain_rate = 1
+        store = self.queue.store
+        store.getDueEmails = Mock(side_effect=store.getDueEmails)
+        store.getEmails = Mock(side_effect=store.getEmails)
+
+        for n in range(3):
+            self.queue.enqueue("noreply@sydent.test", "user%d@example.com" % n, b"Hi")
+        self.queue.enqueue("noreply@sydent.test", "bob@example.org", b"Hi")
+        # The queue is processed once for all the emails queued at the same time.
+        self.assertEqual(store.getDueEmails.call_count, 0)
+        self.sydent.reactor.advance(0)
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(len(self._queued()), 2)
+
+        # Only the emails sent were read in full.
+        self.assertEqual(
+            sorted(i for call in store.getEmails.call_args_list for i in call[0][0]),
+            [1, 4],
+        )
+
+        self.sydent.reactor.advance(1)
+        self.assertEqual(len(self.server.messages), 3)
+
+        self.sydent.reactor.advance(1)
+        self.assertEqual(len(self.server.messages), 4)
+        self.assertEqual(self._queued(), [])
@@ -0,0 +1,67 @@
+from mock import patch
+from sydent.http.httpclient import HTTPClient
+from tests.utils import make_sydent
+from twisted.internet import defer
+from twisted.trial import unittest
+
+
+class FederationHttpClientTestCase(unittest.TestCase):
+    """Tests the federation HTTP client shared by everything talking to homeservers."""
+
+    def setUp(self):
+        config = {"http": {"federation.max_concurrent_per_host": "2"}}
+        self.sydent = make_sydent(test_config=config)
+
+    def test_shared_client(self):
+        client = self.sydent.federationHttpClient
+        self.assertIs(self.sydent.servlets.registerServlet.client, client)
+        self.assertIs(client.agent._pool, client.pool)
+
+    def test_concurrency_per_host(self):
+        """Check that only a limited number of requests are sent to a homeserver at
+        once, and that the others wait for them to complete.
+        """
+        client = self.sydent.federationHttpClient
+        pending = []
+
+        def get_json(uri, max_size=None):
+            d = defer.Deferred()
+            pending.append((uri, d))
+            return d
+
+        with patch.object(HTTPClient, "get_json", side_effect=get_json):
+            results = [
+                client.get_json("matrix://a.example.com/_matrix/key/v2/server/"),
+                client.get_json("matrix://a.example.com/_matrix/key/v2/server/"),
+                client.get_json("matrix://a.example.com/_matrix/key/v2/server/"),
+                client.get_json("matrix://b.example.com/_matrix/key/v2/server/"),
+            ]
+
+            self.assertEqual(
+                [uri for uri, _ in pending],
+                [
+                    "matrix://a.example.com/_matrix/key/v2/server/",
+                    "matrix://a.example.com/_matrix/key/v2/server/",
+                    "matrix://b.example.com/_matrix/key/v2/server/",
+                ],
+            )
+
+            # Completing a request to a.example.com lets the next one through.
+            pending[0][1].callback({"n": 0})
+            self.assertEqual(self.successResultOf(results[0]), {"n": 0})
+            self.assertEqual(len(pending), 4)
+            self.assertEqual(
+                pending[3][0], "matrix://a.example.com/_matrix/key/v2/server/"
+            )
+
+            # Failures release the slot too.
+            pending[1][1].errback(Exception("Connection refused"))
+            self.failureResultOf(results[1], Exception)
+
+            pending[2][1].callback({"n": 2})
+            pending[3][1].callback({"n": 3})
+            self.assertEqual(self.successResultOf(results[2]), {"n": 3})
+            self.assertEqual(self.successResultOf(results[3]), {"n": 2})
+
+        # Nothing is kept around for destinations without requests in flight.
+        self.assertEqual(client._limiters, {})
@@ -0,0 +1,183 @@
+#  Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from prometheus_client import REGISTRY
+
+from twisted.trial import unittest
+
+from sydent.db.instrumentation import normalise_sql
+from sydent.db.threepid_associations import LocalAssociationStore
+from sydent.http.httpcommon import SizeLimitingRequest
+from tests.utils import make_request, make_sydent
+
+
+def get_sample_value(name, labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sydent = make_sydent()
+
+    def test_http_metrics(self):
+        """Check that requests are counted by servlet and response code, and their
+        sizes recorded.
+        """
+        ok_labels = {
+            "servlet": "ReplicationStatusServlet",
+            "method": "GET",
+            "code": "200",
+        }
+        size_labels = {"servlet": "ReplicationStatusServlet"}
+        requests_before = get_sample_value("sydent_http_requests_total", ok_labels)
+        sizes_before = get_sample_value(
+            "sydent_http_response_size_bytes_count", size_labels
+        )
+
+        request, channel = make_request(
+            self.sydent.reactor,
+            "GET",
+            "/_matrix/identity/internal/replication/status",
+            request=SizeLimitingRequest,
+        )
+        request.render(self.sydent.servlets.replicationStatus)
+        self.assertEqual(channel.code, 200)
+
+        self.assertEqual(
+            get_sample_value("sydent_http_requests_total", ok_labels),
+            requests_before + 1,
+        )
+        self.assertEqual(
+            get_sample_value("sydent_http_response_size_bytes_count", size_labels),
+            sizes_before + 1,
+        )
+
+    def test_error_metrics(self):
+        """Check that the errors servlets respond with are counted by error code."""
+        labels = {"servlet": "ReactorStallsServlet", "errcode": "M_INVALID_PARAM"}
+        before = get_sample_value("sydent_http_servlet_errors_total", labels)
+
+        request, channel = make_request(
+            self.sydent.reactor,
+            "GET",
+            "/_matrix/identity/internal/stalls?limit=nope",
+        )
+        request.render(self.sydent.servlets.reactorStalls)
+        self.assertEqual(channel.code, 400)
+
+        self.assertEqual(
+            get_sample_value("sydent_http_servlet_errors_total", labels), before + 1
+        )
+
+    def test_lookup_metrics(self):
+        """Check that the size of lookup batches, and the database work they cause,
+        are recorded.
+        """
+        batch_labels = {"servlet": "BulkLookupServlet"}
+        db_labels = {"caller": "GlobalAssociationStore.getMxids"}
+
+        batches_before = get_sample_value("sydent_lookup_batch_size_sum", batch_labels)
+        statements_before = get_sample_value("sydent_db_statements_total", db_labels)
+
+        request, channel = make_request(
+            self.sydent.reactor,
+            "POST",
+            "/_matrix/identity/api/v1/bulk_lookup",
+            {
+                "threepids": [
+                    ["email", "alice@example.com"],
+                    ["email", "bob@example.com"],
+                    ["msisdn", "447700900123"],
+                ]
+            },
+        )
+        request.render(self.sydent.servlets.bulk_lookup)
+        self.assertEqual(channel.code, 200)
+
+        self.assertEqual(
+            get_sample_value("sydent_lookup_batch_size_sum", batch_labels),
+            batches_before + 3,
+        )
+        self.assertGreater(
+            get_sample_value("sydent_db_statements_total", db_labels),
+            statements_before,
+        )
+
+
+class SlowQueryLogTestCase(unittest.TestCase):
+    def setUp(self):
+        # Log every statement.
+        self.sydent = make_sydent(
+            {
+                "db": {
+                    "slow_query_log.enabled": "true",
+                    "slow_query_log.threshold": "0",
+                }
+            }
+        )
+
+    def get_statements(self):
+        request, channel = make_request(
+            self.sydent.reactor,
+            "GET",
+            "/_matrix/identity/internal/slow_queries?limit=1000",
+        )
+        request.render(self.sydent.servlets.slowQueries)
+        self.assertEqual(channel.code, 200)
+        return {s["sql"]: s for s in channel.json_body["statements"]}
+
+    def test_normalise_sql(self):
+        """Check that statements differing only by their arguments have the same
+        shape.
+        """
+        self.assertEqual(
+            normalise_sql(
+                "SELECT a FROM t1\n  WHERE b IN (?, ?,?) AND c = lower('it''s') AND d > 2"
+            ),
+            "SELECT a FROM t1 WHERE b IN (...) AND c = lower(?) AND d > ?",
+        )
+        self.assertEqual(
+            normalise_sql("INSERT INTO t (a, b) VALUES (?, ?), (?, ?)"),
+            "INSERT INTO t (a, b) VALUES (...)",
+        )
+
+    def test_slow_queries(self):
+        """Check that statements are aggregated by shape, with their query plan."""
+        store = LocalAssociationStore(self.sydent)
+        store.getMaxId()
+        store.getMaxId()
+
+        cur = self.sydent.db.cursor()
+        for ids in ((1,), (1, 2), (1, 2, 3)):
+            cur.execute(
+                "SELECT * FROM local_threepid_associations WHERE id IN (%s)"
+                % ",".join("?" * len(ids)),
+                ids,
+            )
+            self.assertEqual(cur.fetchall(), [])
+
+        statements = self.get_statements()
+
+        max_id = statements["SELECT max(id) FROM local_threepid_associations"]
+        self.assertEqual(max_id["count"], 2)
+        self.assertEqual(max_id["slow_count"], 2)
+        self.assertEqual(max_id["rows"], 2)
+        self.assertIn("local_threepid_associations", max_id["query_plan"])
+        self.assertEqual(max_id["caller"], "LocalAssociationStore.getMaxId")
+
+        by_id = statements[
+            "SELECT * FROM local_threepid_associations WHERE id IN (...)"
+        ]
+        self.assertEqual(by_id["count"], 3)
+        self.assertIn("SEARCH", by_id["query_plan"])
@@ -0,0 +1,126 @@
+from mock import patch
+from sydent.http.httpclient import FederationHttpClient
+from sydent.threepid.onbind import OnBindNotifier
+from tests.utils import make_sydent
+from twisted.internet import defer
+from twisted.web.client import Response
+from twisted.trial import unittest
+
+
+class OnBindNotifierTestCase(unittest.TestCase):
+    """Tests the delivery of bind notifications to homeservers."""
+
+    def setUp(self):
+        config = {
+            "general": {
+                "onbind.max_concurrency_per_destination": "2",
+                "onbind.max_retry_interval": "60",
+            },
+        }
+        self.sydent = make_sydent(test_config=config)
+
+        self.pending = []
+
+        def post_json_get_nothing(uri, post_json, opts):
+            d = defer.Deferred()
+            self.pending.append((uri, post_json["address"], d))
+            return d
+
+        patcher = patch.object(
+            FederationHttpClient,
+            "post_json_get_nothing",
+            side_effect=post_json_get_nothing,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _notify(self, address, server):
+        self.sydent.onBindNotifier.notify(
+            {
+                "medium": "email",
+                "address": address,
+                "mxid": "@someone:%s" % (server,),
+            }
+        )
+
+    def _respond(self, i, code):
+        self.pending[i][2].callback(
+            Response((b"HTTP", 1, 1), code, b"", None, None),
+        )
+
+    def _queued(self):
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT destination, attempts, nextAttemptTs FROM onbind_notifications "
+            "ORDER BY id"
+        )
+        return res.fetchall()
+
+    def test_concurrency_and_backoff(self):
+        self.sydent.run()
+
+        for i in range(3):
+            self._notify("alice%d@example.com" % (i,), "a.example.com")
+        self._notify("bob@example.com", "b.example.com")
+        # An invalid server name is never queued.
+        self._notify("carol@example.com", "-invalid-")
+        self.sydent.reactor.advance(0)
+
+        # Only two notifications are sent to a.example.com at once.
+        self.assertEqual(
+            [(uri, address) for uri, address, _ in self.pending],
+            [
+                (
+                    "matrix://a.example.com/_matrix/federation/v1/3pid/onbind",
+                    "alice0@example.com",
+                ),
+                (
+                    "matrix://a.example.com/_matrix/federation/v1/3pid/onbind",
+                    "alice1@example.com",
+                ),
+                (
+                    "matrix://b.example.com/_matrix/federation/v1/3pid/onbind",
+                    "bob@example.com",
+                ),
+            ],
+        )
+
+        # Delivered notifications leave the queue.
+        self._respond(2, 200)
+        self._respond(0, 200)
+        self.sydent.reactor.advance(0)
+        self.assertEqual(len(self.pending), 4)
+        self.assertEqual(self.pending[3][1], "alice2@example.com")
+
+        # A failure holds back every notification to the same destination.
+        now = self.sydent.reactor.seconds() * 1000
+        self._respond(1, 500)
+        queued = self._queued()
+        self.assertEqual(len(queued), 2)
+        self.assertEqual(queued[0][1], 1)
+        self.assertGreaterEqual(queued[0][2], now + 500)
+        self.assertLessEqual(queued[0][2], now + 1000)
+        self.assertEqual(queued[1][1], 0)
+        self.assertGreaterEqual(queued[1][2], queued[0][2])
+
+        # The backoff is capped.
+        self._respond(3, 500)
+        for _ in range(10):
+            self.sydent.reactor.advance(60)
+            self._respond(len(self.pending) - 1, 500)
+        now = self.sydent.reactor.seconds() * 1000
+        for _, _, nextAttemptTs in self._queued():
+            self.assertLessEqual(nextAttemptTs, now + 60 * 1000)
+
+    def test_queue_survives_restart(self):
+        self._notify("alice@example.com", "a.example.com")
+        self.assertEqual(len(self._queued()), 1)
+        self.assertEqual(self.pending, [])
+
+        # A new notifier picks up the queued notification when it starts.
+        self.sydent.onBindNotifier = OnBindNotifier(self.sydent)
+        self.sydent.onBindNotifier.setup()
+        self.assertEqual(len(self.pending), 1)
+
+        self._respond(0, 200)
+        self.assertEqual(self._queued(), [])
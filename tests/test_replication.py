@@ -1,14 +1,84 @@
+import gzip
 import json
+import os
+import tempfile
 
-from mock import Mock
-from sydent.threepid import ThreepidAssociation
+from canonicaljson import encode_canonical_json
+from mock import Mock, patch
+from prometheus_client import REGISTRY
+from zope.interface import implementer
+from sydent.db.peers import PeerStore
+from sydent.db.threepid_associations import (
+    GlobalAssociationStore,
+    LocalAssociationStore,
+)
+from sydent.http.httpsclient import ReplicationConnectionPool
+from sydent.replication.snapshot import (
+    SnapshotError,
+    export_snapshot,
+    import_snapshot,
+    mark_snapshot_sent,
+)
+from sydent.replication.wire import (
+    SGASSOCS_CONTENT_TYPE,
+    decode_sg_assocs,
+    encode_sg_assocs,
+)
+from sydent.threepid import ThreepidAssociation, threePidAssocFromDict
 from sydent.threepid.signer import Signer
+from sydent.util import time_msec
 from tests.utils import make_request, make_sydent
-from twisted.web.client import Response
+from twisted.web.client import Agent, FileBodyProducer, Response
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IAgentEndpointFactory
+from twisted.web.resource import Resource
+from twisted.web.server import Site
 from twisted.internet import defer
+from twisted.internet.task import Cooperator
+from twisted.test import iosim
 from twisted.trial import unittest
 
 
+class _AckResource(Resource):
+    """Acknowledges every replication push."""
+
+    isLeaf = True
+
+    def render_POST(self, request):
+        request.setHeader(b"Content-Type", b"application/json")
+        return b"{}"
+
+
+@implementer(IAgentEndpointFactory)
+class _LoopbackEndpointFactory(object):
+    """Connects every request to an in-memory HTTP server acknowledging pushes.
+
+    :param reactor: The reactor the server runs on.
+    :type reactor: twisted.internet.interfaces.IReactorTime
+    """
+
+    def __init__(self, reactor):
+        self.site = Site(_AckResource(), reactor=reactor)
+        # The pump of each connection opened, to move data between both ends
+        self.pumps = []
+
+    def endpointForURI(self, uri):
+        return self
+
+    def connect(self, protocolFactory):
+        client = protocolFactory.buildProtocol(None)
+        server = self.site.buildProtocol(None)
+        self.pumps.append(
+            iosim.connect(
+                server,
+                iosim.FakeTransport(server, isServer=True),
+                client,
+                iosim.FakeTransport(client, isServer=False),
+            )
+        )
+        return defer.succeed(client)
+
+
 class ReplicationTestCase(unittest.TestCase):
     """Test that a Sydent can correctly replicate data with another Sydent"""
 
@@ -104,6 +174,97 @@ class ReplicationTestCase(unittest.TestCase):
         for assoc_id, signed_assoc in signed_assocs.items():
             self.assertDictEqual(signed_assoc, res_assocs[assoc_id])
 
+    def test_incoming_compressed_replication(self):
+        """Impersonate a peer that sends a gzipped replication push to Sydent, then
+        checks that it decompresses and saves it correctly.
+        """
+        self.sydent.run()
+
+        config = {
+            "general": {"server.name": "fake.server"},
+            "crypto": {
+                "ed25519.signingkey": "ed25519 0 b29eXMMAYCFvFEtq9mLI42aivMtcg4Hl0wK89a+Vb6c"
+            },
+        }
+
+        fake_sender_sydent = make_sydent(config)
+        signer = Signer(fake_sender_sydent)
+
+        signed_assocs = {}
+        for assoc_id, assoc in enumerate(self.assocs):
+            signed_assocs[assoc_id] = signer.signedThreePidAssociation(assoc)
+
+        body = gzip.compress(json.dumps({"sgAssocs": signed_assocs}).encode("utf8"))
+        request, channel = make_request(
+            self.sydent.reactor, "POST", "/_matrix/identity/replicate/v1/push", body
+        )
+        request.requestHeaders.addRawHeader(b"Content-Encoding", b"gzip")
+        request.render(self.sydent.servlets.replicationPush)
+
+        self.assertEqual(channel.code, 200)
+        self.assertIn(
+            "gzip",
+            channel.headers.getRawHeaders(b"Accept-Encoding")[0].decode("ascii"),
+        )
+
+        cur = self.sydent.db.cursor()
+        res = cur.execute("SELECT count(*) FROM global_threepid_associations")
+        self.assertEqual(res.fetchone()[0], len(self.assocs))
+
+    def test_incoming_framed_replication(self):
+        """Impersonate a peer that sends a replication push using the binary framing,
+        then checks that Sydent stores each signed association as it was sent.
+        """
+        self.sydent.run()
+
+        config = {
+            "general": {"server.name": "fake.server"},
+            "crypto": {
+                "ed25519.signingkey": "ed25519 0 b29eXMMAYCFvFEtq9mLI42aivMtcg4Hl0wK89a+Vb6c"
+            },
+        }
+
+        fake_sender_sydent = make_sydent(config)
+        signer = Signer(fake_sender_sydent)
+
+        signed_assocs = {}
+        for assoc_id, assoc in enumerate(self.assocs):
+            signed_assocs[assoc_id] = signer.signedThreePidAssociation(assoc)
+
+        request, channel = make_request(
+            self.sydent.reactor,
+            "POST",
+            "/_matrix/identity/replicate/v1/push",
+            encode_sg_assocs(signed_assocs),
+        )
+        request.requestHeaders.setRawHeaders(b"Content-Type", [SGASSOCS_CONTENT_TYPE])
+        request.render(self.sydent.servlets.replicationPush)
+
+        self.assertEqual(channel.code, 200)
+        self.assertIn(
+            SGASSOCS_CONTENT_TYPE,
+            channel.headers.getRawHeaders(b"Accept-Post")[0].decode("ascii"),
+        )
+
+        cur = self.sydent.db.cursor()
+        res = cur.execute("SELECT originId, sgAssoc FROM global_threepid_associations")
+        stored = dict(res.fetchall())
+        for assoc_id, signed_assoc in signed_assocs.items():
+            self.assertEqual(
+                stored[assoc_id], encode_canonical_json(signed_assoc).decode("utf8")
+            )
+
+        # Truncated bodies are rejected.
+        request, channel = make_request(
+            self.sydent.reactor,
+            "POST",
+            "/_matrix/identity/replicate/v1/push",
+            encode_sg_assocs(signed_assocs)[:-1],
+        )
+        request.requestHeaders.setRawHeaders(b"Content-Type", [SGASSOCS_CONTENT_TYPE])
+        request.render(self.sydent.servlets.replicationPush)
+        self.assertEqual(channel.code, 400)
+
     def test_outgoing_replication(self):
         """Make a fake peer and associations and make sure Sydent tries to push to it."""
         cur = self.sydent.db.cursor()
@@ -165,9 +326,12 @@ class ReplicationTestCase(unittest.TestCase):
             for assoc_id, assoc in payload["sgAssocs"].items():
                 sent_assocs[assoc_id] = assoc
 
-            # Return with a fake response wrapped in a Deferred.
+            # Return with a fake response wrapped in a Deferred. The pusher reads the
+            # response's body, so mark it as having been fully received.
+            response = Response((b"HTTP", 1, 1), 200, b"OK", Headers(), None)
+            response._bodyDataFinished()
             d = defer.Deferred()
-            d.callback(Response((b"HTTP", 1, 1), 200, b"OK", None, None))
+            d.callback(response)
             return d
 
         # Mock the replication client's agent so it runs the custom code instead of
@@ -190,3 +354,713 @@ class ReplicationTestCase(unittest.TestCase):
             # will push will be 1, so we need to subtract 1 when figuring out which index
             # to lookup.
             self.assertDictEqual(assoc, signed_assocs[int(assoc_id) - 1])
+
+    def test_outgoing_replication_connection_reuse(self):
+        """Check that consecutive pushes to a peer reuse the same connection."""
+        pool = ReplicationConnectionPool(self.sydent.reactor)
+        endpoints = _LoopbackEndpointFactory(self.sydent.reactor)
+        self.sydent.replicationHttpsClient.agent = Agent.usingEndpointFactory(
+            self.sydent.reactor, endpoints, pool=pool
+        )
+
+        def get_sample_value(name):
+            return REGISTRY.get_sample_value(name) or 0
+
+        requests_before = get_sample_value(
+            "sydent_replication_connection_requests_total"
+        )
+        opened_before = get_sample_value("sydent_replication_connections_opened_total")
+
+        # Request bodies are written by a cooperator, which has to run on the fake
+        # reactor rather than the global one.
+        cooperator = Cooperator(scheduler=lambda f: self.sydent.reactor.callLater(0, f))
+
+        def body_producer(inputFile):
+            return FileBodyProducer(inputFile, cooperator=cooperator)
+
+        signer = Signer(self.sydent)
+        peer = self.sydent.peerRegistry.getPeerByName("fake.server")
+        for assoc_id in (1, 2):
+            with patch("sydent.http.httpsclient.FileBodyProducer", body_producer):
+                d = peer.pushUpdates(
+                    {assoc_id: signer.signedThreePidAssociation(self.assocs[assoc_id])}
+                )
+            self.sydent.reactor.advance(0)
+            for pump in endpoints.pumps:
+                pump.flush()
+            self.assertEqual(self.successResultOf(d).code, 200)
+
+        self.assertEqual(len(endpoints.pumps), 1)
+        self.assertEqual(
+            get_sample_value("sydent_replication_connection_requests_total"),
+            requests_before + 2,
+        )
+        self.assertEqual(
+            get_sample_value("sydent_replication_connections_opened_total"),
+            opened_before + 1,
+        )
+
+    def test_outgoing_replication_compression(self):
+        """Check that Sydent compresses its pushes once the peer has advertised that it
+        accepts compressed bodies.
+        """
+        cur = self.sydent.db.cursor()
+        cur.executemany(
+            "INSERT INTO  local_threepid_associations "
+            "(medium, address, lookup_hash, mxid, ts, notBefore, notAfter) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    assoc.medium,
+                    assoc.address,
+                    assoc.lookup_hash,
+                    assoc.mxid,
+                    assoc.ts,
+                    assoc.not_before,
+                    assoc.not_after,
+                )
+                for assoc in self.assocs
+            ],
+        )
+        self.sydent.db.commit()
+
+        sent_assocs = {}
+        content_encodings = []
+
+        def request(method, uri, headers, body):
+            encoding = headers.getRawHeaders("Content-Encoding", [None])[0]
+            content_encodings.append(encoding)
+
+            raw = body._inputFile.read()
+            if encoding == "gzip":
+                raw = gzip.decompress(raw)
+            payload = json.loads(raw.decode("utf8"))
+            sent_assocs.update(payload["sgAssocs"])
+
+            response = Response(
+                (b"HTTP", 1, 1),
+                200,
+                b"OK",
+                Headers({b"Accept-Encoding": [b"gzip"]}),
+                None,
+            )
+            response._bodyDataFinished()
+            return defer.succeed(response)
+
+        agent = Mock(spec=["request"])
+        agent.request.side_effect = request
+        self.sydent.replicationHttpsClient.agent = agent
+
+        self.sydent.run()
+        self.sydent.reactor.advance(1000)
+
+        # The first push can't be compressed since we don't know yet what the peer
+        # supports, but the following ones should be.
+        self.assertEqual(content_encodings, [None, "gzip"])
+        self.assertEqual(len(self.assocs), len(sent_assocs))
+
+    def test_outgoing_replication_framing(self):
+        """Check that Sydent switches to the binary framing once the peer has
+        advertised that it accepts it.
+        """
+        cur = self.sydent.db.cursor()
+        cur.executemany(
+            "INSERT INTO  local_threepid_associations "
+            "(medium, address, lookup_hash, mxid, ts, notBefore, notAfter) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    assoc.medium,
+                    assoc.address,
+                    assoc.lookup_hash,
+                    assoc.mxid,
+                    assoc.ts,
+                    assoc.not_before,
+                    assoc.not_after,
+                )
+                for assoc in self.assocs
+            ],
+        )
+        self.sydent.db.commit()
+
+        sent_ids = []
+        content_types = []
+
+        def request(method, uri, headers, body):
+            content_type = headers.getRawHeaders("Content-Type")[0]
+            content_types.append(content_type)
+
+            raw = body._inputFile.read()
+            if content_type == SGASSOCS_CONTENT_TYPE:
+                sent_ids.extend(i for i, _ in decode_sg_assocs(raw))
+            else:
+                sent_ids.extend(int(i) for i in json.loads(raw)["sgAssocs"])
+
+            response = Response(
+                (b"HTTP", 1, 1),
+                200,
+                b"OK",
+                Headers(
+                    {
+                        b"Accept-Post": [
+                            b"application/json, " + SGASSOCS_CONTENT_TYPE.encode()
+                        ]
+                    }
+                ),
+                None,
+            )
+            response._bodyDataFinished()
+            return defer.succeed(response)
+
+        agent = Mock(spec=["request"])
+        agent.request.side_effect = request
+        self.sydent.replicationHttpsClient.agent = agent
+
+        self.sydent.run()
+        self.sydent.reactor.advance(1000)
+
+        self.assertEqual(content_types, ["application/json", SGASSOCS_CONTENT_TYPE])
+        self.assertEqual(sent_ids, list(range(1, len(self.assocs) + 1)))
+
+    def test_snapshot_bootstrap(self):
+        """Export a snapshot from a peer, import it, and check that the associations
+        are stored and that the snapshot can only be imported from a known peer.
+        """
+        config = {
+            "general": {"server.name": "fake.server"},
+            "crypto": {
+                "ed25519.signingkey": "ed25519 0 b29eXMMAYCFvFEtq9mLI42aivMtcg4Hl0wK89a+Vb6c"
+            },
+        }
+        fake_sender_sydent = make_sydent(config)
+
+        cur = fake_sender_sydent.db.cursor()
+        cur.executemany(
+            "INSERT INTO  local_threepid_associations "
+            "(medium, address, lookup_hash, mxid, ts, notBefore, notAfter) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    assoc.medium,
+                    assoc.address,
+                    assoc.lookup_hash,
+                    assoc.mxid,
+                    assoc.ts,
+                    assoc.not_before,
+                    assoc.not_after,
+                )
+                for assoc in self.assocs
+            ],
+        )
+        fake_sender_sydent.db.commit()
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        high_water_mark = export_snapshot(fake_sender_sydent, path, chunk_size=40)
+        self.assertEqual(high_water_mark, len(self.assocs))
+
+        imported = import_snapshot(self.sydent, path, workers=2)
+        self.assertEqual(imported, len(self.assocs))
+
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT count(*), max(originId) FROM global_threepid_associations "
+            "WHERE originServer = ?",
+            ("fake.server",),
+        )
+        self.assertEqual(res.fetchone(), (len(self.assocs), high_water_mark))
+
+        # Once imported, the sender can carry on pushing from the high-water mark.
+        cur = fake_sender_sydent.db.cursor()
+        cur.execute(
+            "INSERT INTO peers (name, port, lastSentVersion, active) VALUES (?, ?, ?, ?)",
+            ("other.server", 1234, None, 0),
+        )
+        fake_sender_sydent.db.commit()
+        self.assertEqual(
+            mark_snapshot_sent(fake_sender_sydent, "other.server", path),
+            high_water_mark,
+        )
+
+        # The snapshot was exported by fake.server, which the sender doesn't know
+        # as a peer, so it can't import it (or mark it as sent by someone else).
+        self.assertRaises(SnapshotError, import_snapshot, fake_sender_sydent, path)
+        self.assertRaises(
+            SnapshotError, mark_snapshot_sent, self.sydent, "fake.server", path
+        )
+
+    def test_snapshot_import_chunk_is_atomic(self):
+        """Check that a chunk of a snapshot which fails to be stored partway through
+        is rolled back, deletions included.
+        """
+        config = {
+            "general": {"server.name": "fake.server"},
+            "crypto": {
+                "ed25519.signingkey": "ed25519 0 b29eXMMAYCFvFEtq9mLI42aivMtcg4Hl0wK89a+Vb6c"
+            },
+        }
+        fake_sender_sydent = make_sydent(config)
+
+        # Bind a 3PID, unbind it, then bind another one, so that the snapshot's only
+        # chunk starts with a deletion.
+        insert = (
+            "REPLACE INTO local_threepid_associations "
+            "(medium, address, lookup_hash, mxid, ts, notBefore, notAfter) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)"
+        )
+        first, second = self.assocs[:2]
+        cur = fake_sender_sydent.db.cursor()
+        cur.execute(
+            insert,
+            (first.medium, first.address, None, first.mxid, first.ts, 0, 99999999999),
+        )
+        cur.execute(insert, (first.medium, first.address, None, None, 1, None, None))
+        cur.execute(
+            insert,
+            (second.medium, second.address, None, second.mxid, 2, 0, 99999999999),
+        )
+        fake_sender_sydent.db.commit()
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        export_snapshot(fake_sender_sydent, path)
+
+        # The 3PID the snapshot deletes is bound on this server.
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "INSERT INTO global_threepid_associations "
+            "(medium, address, lookup_hash, mxid, ts, notBefore, notAfter, "
+            "originServer, originId, sgAssoc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                first.medium,
+                first.address,
+                None,
+                first.mxid,
+                first.ts,
+                0,
+                99999999999,
+                "other.server",
+                1,
+                "{}",
+            ),
+        )
+        self.sydent.db.commit()
+
+        with patch.object(
+            GlobalAssociationStore, "addAssociation", side_effect=Exception("boom")
+        ):
+            self.assertRaises(Exception, import_snapshot, self.sydent, path)
+
+        res = cur.execute(
+            "SELECT count(*) FROM global_threepid_associations WHERE address = ?",
+            (first.address,),
+        )
+        self.assertEqual(res.fetchone()[0], 1)
+
+    def test_antientropy_repair(self):
+        """Check that Sydent finds and repairs the buckets of associations from a peer
+        that differ from the peer's own copy, by comparing hash trees with it.
+        """
+        config = {
+            "general": {"server.name": "fake.server"},
+            "crypto": {
+                "ed25519.signingkey": "ed25519 0 b29eXMMAYCFvFEtq9mLI42aivMtcg4Hl0wK89a+Vb6c"
+            },
+        }
+        fake_sender_sydent = make_sydent(config)
+        signer = Signer(fake_sender_sydent)
+
+        # Expired associations aren't repaired, so make sure ours are still valid.
+        for assoc in self.assocs:
+            assoc.not_after = time_msec() + 3600 * 1000
+
+        # The peer only answers requests from servers it knows as peers. The test
+        # certificate's common name is fake.server.
+        cur = fake_sender_sydent.db.cursor()
+        cur.execute(
+            "INSERT INTO peers (name, port, lastSentVersion, active) VALUES (?, ?, ?, ?)",
+            ("fake.server", 1234, 0, 1),
+        )
+        cur.execute(
+            "INSERT INTO peer_pubkeys (peername, alg, key) VALUES (?, ?, ?)",
+            ("fake.server", "ed25519", "+vB8mTaooD/MA8YYZM8t9+vnGhP1937q2icrqPV9JTs"),
+        )
+        fake_sender_sydent.db.commit()
+
+        signed_assocs = {}
+        for assoc_id, assoc in enumerate(self.assocs):
+            signed_assocs[assoc_id] = signer.signedThreePidAssociation(assoc)
+
+        # We're missing one association, have a stale version of another one, and
+        # have one the peer has since deleted, in another bucket.
+        stale = ThreepidAssociation(
+            medium="email",
+            address="bob20@example.com",
+            lookup_hash=None,
+            mxid="@alice:example.com",
+            ts=1,
+            not_before=0,
+            not_after=99999999999,
+        )
+        ours = dict(signed_assocs)
+        del ours[10]
+        ours[20] = signer.signedThreePidAssociation(stale)
+        ours[2000] = signer.signedThreePidAssociation(stale)
+
+        for sydent, sg_assocs in (
+            (fake_sender_sydent, signed_assocs),
+            (self.sydent, ours),
+        ):
+            store = GlobalAssociationStore(sydent)
+            for assoc_id, sg_assoc in sg_assocs.items():
+                store.addAssociation(
+                    threePidAssocFromDict(sg_assoc),
+                    json.dumps(sg_assoc),
+                    "fake.server",
+                    assoc_id,
+                    commit=False,
+                )
+            sydent.db.commit()
+
+        servlets = {
+            b"nodes": fake_sender_sydent.servlets.hashTreeNodes,
+            b"bucket": fake_sender_sydent.servlets.hashTreeBucket,
+        }
+
+        def request(method, uri, headers, body):
+            path = uri.split(b"fake.server:1234", 1)[1]
+            req, channel = make_request(
+                fake_sender_sydent.reactor,
+                "POST",
+                path.decode("ascii"),
+                body._inputFile.read(),
+            )
+            req.render(servlets[path.rsplit(b"/", 1)[1]])
+
+            response = Response((b"HTTP", 1, 1), channel.code, b"", Headers(), None)
+            response._bodyDataReceived(channel.result["body"])
+            response._bodyDataFinished()
+            return defer.succeed(response)
+
+        agent = Mock(spec=["request"])
+        agent.request.side_effect = request
+        self.sydent.replicationHttpsClient.agent = agent
+
+        peer = PeerStore(self.sydent).getPeerByName("fake.server")
+
+        d = self.sydent.antiEntropy.checkPeer(peer)
+        self.assertEqual(self.successResultOf(d), 2)
+
+        our_buckets = GlobalAssociationStore(self.sydent).getHashBuckets(
+            "fake.server", 0, 10
+        )
+        their_buckets = GlobalAssociationStore(fake_sender_sydent).getHashBuckets(
+            "fake.server", 0, 10
+        )
+        self.assertEqual(our_buckets, their_buckets)
+
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT originId, sgAssoc FROM global_threepid_associations "
+            "WHERE originServer = ?",
+            ("fake.server",),
+        )
+        stored = {row[0]: json.loads(row[1]) for row in res.fetchall()}
+        self.assertEqual(stored, signed_assocs)
+
+        # Now that both agree, there's nothing left to repair.
+        d = self.sydent.antiEntropy.checkPeer(peer)
+        self.assertEqual(self.successResultOf(d), 0)
+
+    def test_outgoing_replication_window(self):
+        """Check that Sydent keeps several pushes in flight to a peer, only records
+        progress over the pushes that have all been acknowledged, and doesn't push
+        a change to a 3PID while an earlier change to it is still in flight.
+        """
+        self.sydent.pusher.push_window = 2
+
+        cur = self.sydent.db.cursor()
+        cur.executemany(
+            "INSERT INTO  local_threepid_associations "
+            "(medium, address, lookup_hash, mxid, ts, notBefore, notAfter) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    assoc.medium,
+                    assoc.address,
+                    assoc.lookup_hash,
+                    assoc.mxid,
+                    assoc.ts,
+                    assoc.not_before,
+                    assoc.not_after,
+                )
+                for assoc in self.assocs
+            ],
+        )
+        self.sydent.db.commit()
+
+        pending = []
+
+        def request(method, uri, headers, body):
+            payload = json.loads(body._inputFile.read().decode("utf8"))
+            d = defer.Deferred()
+            pending.append((sorted(int(i) for i in payload["sgAssocs"]), d))
+            return d
+
+        def ack(i):
+            response = Response((b"HTTP", 1, 1), 200, b"OK", Headers(), None)
+            response._bodyDataFinished()
+            pending[i][1].callback(response)
+
+        def last_sent_version():
+            res = cur.execute(
+                "SELECT lastSentVersion FROM peers WHERE name = ?", ("fake.server",)
+            )
+            return res.fetchone()[0]
+
+        agent = Mock(spec=["request"])
+        agent.request.side_effect = request
+        self.sydent.replicationHttpsClient.agent = agent
+
+        self.sydent.run()
+
+        # Both batches are sent without waiting for the first one to be acknowledged.
+        self.assertEqual(len(pending), 2)
+        self.assertEqual(pending[0][0], list(range(1, 101)))
+        self.assertEqual(pending[1][0], list(range(101, 151)))
+
+        # Rebind a 3PID from the first batch while it's still in flight.
+        cur.execute(
+            "REPLACE INTO local_threepid_associations "
+            "(medium, address, lookup_hash, mxid, ts, notBefore, notAfter) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ("email", "bob0@example.com", None, "@alice:example.com", 1, 0, 1),
+        )
+        self.sydent.db.commit()
+
+        # Acknowledging the second batch doesn't move the peer forward past the
+        # first one, and the rebind waits for the first batch.
+        ack(1)
+        self.assertEqual(last_sent_version(), 0)
+        self.assertEqual(len(pending), 2)
+
+        ack(0)
+        self.assertEqual(last_sent_version(), 150)
+        self.assertEqual(len(pending), 3)
+        self.assertEqual(pending[2][0], [151])
+
+        ack(2)
+        self.assertEqual(last_sent_version(), 151)
+
+    def test_outgoing_replication_ack_after_emptying(self):
+        """Check that a push acknowledged after the local associations table was
+        emptied is still recorded, and the peer's backlog updated.
+        """
+        cur = self.sydent.db.cursor()
+        assoc = self.assocs[0]
+        cur.execute(
+            "INSERT INTO  local_threepid_associations "
+            "(medium, address, lookup_hash, mxid, ts, notBefore, notAfter) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                assoc.medium,
+                assoc.address,
+                assoc.lookup_hash,
+                assoc.mxid,
+                assoc.ts,
+                assoc.not_before,
+                assoc.not_after,
+            ),
+        )
+        self.sydent.db.commit()
+
+        pending = []
+
+        def request(method, uri, headers, body):
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+
+        agent = Mock(spec=["request"])
+        agent.request.side_effect = request
+        self.sydent.replicationHttpsClient.agent = agent
+
+        self.sydent.run()
+        self.assertEqual(len(pending), 1)
+
+        # Empty the table while the batch is in flight.
+        cur.execute("DELETE FROM local_threepid_associations")
+        self.sydent.db.commit()
+
+        response = Response((b"HTTP", 1, 1), 200, b"OK", Headers(), None)
+        response._bodyDataFinished()
+        pending[0].callback(response)
+
+        cur.execute(
+            "SELECT lastSentVersion FROM peers WHERE name = ?", ("fake.server",)
+        )
+        self.assertEqual(cur.fetchone()[0], 1)
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                "sydent_replication_peer_backlog", {"peer": "fake.server"}
+            ),
+            0,
+        )
+
+    def test_invalid_push_window(self):
+        """Check that a push window which would never send anything is rejected at
+        startup.
+        """
+        with self.assertRaises(Exception):
+            make_sydent({"general": {"replication.push_window": "0"}})
+
+    def test_replication_status(self):
+        """Check that the internal replication status endpoint reports how far
+        behind each peer is and how much has been sent to it.
+        """
+        self.sydent.pusher.push_window = 1
+
+        cur = self.sydent.db.cursor()
+        cur.executemany(
+            "INSERT INTO  local_threepid_associations "
+            "(medium, address, lookup_hash, mxid, ts, notBefore, notAfter) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    assoc.medium,
+                    assoc.address,
+                    assoc.lookup_hash,
+                    assoc.mxid,
+                    assoc.ts,
+                    assoc.not_before,
+                    assoc.not_after,
+                )
+                for assoc in self.assocs
+            ],
+        )
+        self.sydent.db.commit()
+
+        pending = []
+
+        def request(method, uri, headers, body):
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+
+        agent = Mock(spec=["request"])
+        agent.request.side_effect = request
+        self.sydent.replicationHttpsClient.agent = agent
+
+        def get_status():
+            request, channel = make_request(
+                self.sydent.reactor,
+                "GET",
+                "/_matrix/identity/internal/replication/status",
+            )
+            request.render(self.sydent.servlets.replicationStatus)
+            self.assertEqual(channel.code, 200)
+            return channel.json_body
+
+        self.sydent.run()
+
+        # Nothing has been acknowledged yet.
+        status = get_status()
+        self.assertEqual(status["max_local_id"], 150)
+        peer_status = status["peers"]["fake.server"]
+        self.assertEqual(peer_status["backlog"], 150)
+        self.assertEqual(peer_status["sent_total"], 0)
+        self.assertIsNone(peer_status["last_push_success_ts"])
+
+        # Acknowledge the first batch after a second.
+        self.sydent.reactor.advance(1)
+        response = Response((b"HTTP", 1, 1), 200, b"OK", Headers(), None)
+        response._bodyDataFinished()
+        pending[0].callback(response)
+
+        status = get_status()
+        peer_status = status["peers"]["fake.server"]
+        self.assertEqual(peer_status["backlog"], 50)
+        self.assertEqual(peer_status["last_sent_version"], 100)
+        self.assertEqual(peer_status["sent_total"], 100)
+        self.assertEqual(peer_status["last_batch_latency_seconds"], 1)
+        self.assertIsNotNone(peer_status["last_push_success_ts"])
+
+        # Fail the second batch.
+        pending[1].errback(Exception("Connection refused"))
+
+        status = get_status()
+        peer_status = status["peers"]["fake.server"]
+        self.assertEqual(peer_status["backlog"], 50)
+        self.assertEqual(peer_status["push_failures"], 1)
+
+    def test_peer_registry(self):
+        """Check that peers are kept in memory between lookups, and reloaded when
+        their config changes.
+        """
+        registry = self.sydent.peerRegistry
+
+        peer = registry.getPeerByName("fake.server")
+        self.assertEqual(
+            peer.replication_url,
+            "https://fake.server:1234/_matrix/identity/replicate/v1/push",
+        )
+        self.assertIs(registry.getAllPeers()[0], peer)
+
+        registry.setLastSentVersionAndPokeSucceeded("fake.server", 42, 0)
+        self.assertEqual(registry.getPeerByName("fake.server").lastSentVersion, 42)
+
+        self.sydent.cfg.add_section("peer.fake.server")
+        self.sydent.cfg.set(
+            "peer.fake.server", "base_replication_url", "https://other.example.com"
+        )
+        reloaded = registry.getPeerByName("fake.server")
+        self.assertIsNot(reloaded, peer)
+        self.assertEqual(reloaded.lastSentVersion, 42)
+        self.assertEqual(
+            reloaded.replication_url,
+            "https://other.example.com/_matrix/identity/replicate/v1/push",
+        )
+
+        cur = self.sydent.db.cursor()
+        cur.execute("UPDATE peers SET active = 0 WHERE name = ?", ("fake.server",))
+        self.sydent.db.commit()
+        self.assertIs(registry.getPeerByName("fake.server"), reloaded)
+        registry.invalidate()
+        self.assertIsNone(registry.getPeerByName("fake.server"))
+
+    def test_tombstone_compaction(self):
+        """Check that tombstones are only deleted once every active peer has been sent
+        them.
+        """
+        local_assoc_store = LocalAssociationStore(self.sydent)
+        for assoc in self.assocs[:10]:
+            local_assoc_store.addOrUpdateAssociation(assoc)
+        for assoc in self.assocs[:6]:
+            local_assoc_store.removeAssociation(
+                {"medium": assoc.medium, "address": assoc.address}, assoc.mxid
+            )
+
+        # The tombstones replaced the first 6 associations, and got IDs 11 to 16.
+        self.assertEqual(local_assoc_store.countTombstones(), 6)
+
+        compactor = self.sydent.tombstoneCompactor
+
+        # fake.server hasn't been sent any of them yet.
+        self.assertEqual(self.successResultOf(compactor.compact()), 0)
+
+        self.sydent.peerRegistry.setLastSentVersionAndPokeSucceeded(
+            "fake.server", 13, 0
+        )
+        self.assertEqual(self.successResultOf(compactor.compact()), 3)
+        self.assertEqual(local_assoc_store.countTombstones(), 3)
+
+        # Live associations are never compacted.
+        self.sydent.peerRegistry.setLastSentVersionAndPokeSucceeded(
+            "fake.server", 16, 0
+        )
+        self.assertEqual(self.successResultOf(compactor.compact()), 3)
+        assocs, _ = local_assoc_store.getAssociationsAfterId(None)
+        self.assertEqual(sorted(assocs), list(range(7, 11)))
@@ -0,0 +1,147 @@
+#  Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.web.client import Response
+from twisted.web.http_headers import Headers
+
+from sydent.sms import SmsSendException
+from sydent.sms.openmarket import OpenMarketSMS
+from sydent.util.msisdn import parse_phone_number
+from tests.utils import make_request, make_sydent
+
+
+class SmsQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        config = {
+            "sms": {
+                "provider": "stub",
+                "ratelimit.default": "0",
+                "ratelimit.44": "1",
+                "originators.44": "long:447700900001, long:447700900002",
+            },
+        }
+        self.sydent = make_sydent(test_config=config)
+        self.queue = self.sydent.smsQueue
+
+    def _queued(self):
+        """Returns the messages in the queue, whether they're due or not."""
+        return self.queue.store.getDueMessages(2**62, 100)
+
+    def test_request_token(self):
+        """Check that requesting a token texts it through the provider."""
+        self.sydent.run()
+
+        request, channel = make_request(
+            self.sydent.reactor,
+            "POST",
+            "/_matrix/identity/api/v1/validate/msisdn/requestToken",
+            {
+                "phone_number": "07700900123",
+                "country": "GB",
+                "client_secret": "oursecret",
+                "send_attempt": 0,
+            },
+        )
+        request.render(self.sydent.servlets.msisdnRequestCode)
+        self.assertEqual(channel.code, 200)
+
+        self.assertEqual(len(self.queue.provider.sent), 1)
+        body, dest, source = self.queue.provider.sent[0]
+        self.assertEqual(dest, "447700900123")
+        self.assertTrue(body.startswith("Your code is "))
+        self.assertEqual(self._queued(), [])
+
+    def test_originators(self):
+        """Check that the originator of a message depends on its destination."""
+        validator = self.sydent.validators.msisdn
+
+        originator = validator.getOriginator(parse_phone_number("07700900123", "GB"))
+        self.assertEqual(originator, {"type": "long", "text": "447700900002"})
+        originator = validator.getOriginator(parse_phone_number("07700900124", "GB"))
+        self.assertEqual(originator, {"type": "long", "text": "447700900001"})
+
+        originator = validator.getOriginator(parse_phone_number("0612345678", "FR"))
+        self.assertEqual(originator, {"type": "alpha", "text": "Matrix"})
+
+    def test_retry(self):
+        """Check that a message which couldn't be sent is sent again after a
+        backoff, unless the gateway refused it for good.
+        """
+        self.queue.provider.sendTextSMS = Mock(
+            side_effect=[
+                defer.fail(SmsSendException("Gateway unavailable")),
+                defer.succeed(None),
+                defer.fail(SmsSendException("Invalid number", permanent=True)),
+            ]
+        )
+
+        self.queue.enqueue("447700900123", "44", "Hi")
+        self.assertEqual(len(self._queued()), 1)
+
+        self.sydent.reactor.advance(5)
+        self.assertEqual(self.queue.provider.sendTextSMS.call_count, 2)
+        self.assertEqual(self._queued(), [])
+
+        self.queue.enqueue("33612345678", "33", "Hi")
+        self.assertEqual(self.queue.provider.sendTextSMS.call_count, 3)
+        self.assertEqual(self._queued(), [])
+
+    def test_country_rate_limit(self):
+        """Check that the messages to a country are sent no faster than its rate
+        limit, without holding back the messages to other countries.
+        """
+        for n in range(3):
+            self.queue.enqueue("44770090012%d" % n, "44", "Hi")
+        self.queue.enqueue("33612345678", "33", "Hi")
+        self.assertEqual(len(self.queue.provider.sent), 2)
+
+        self.sydent.reactor.advance(1)
+        self.assertEqual(len(self.queue.provider.sent), 3)
+
+        self.sydent.reactor.advance(1)
+        self.assertEqual(len(self.queue.provider.sent), 4)
+        self.assertEqual(self._queued(), [])
+
+
+class OpenMarketTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sydent = make_sydent()
+        self.sms = OpenMarketSMS(self.sydent)
+        self.sms.http_cli.post_json_get_nothing = Mock()
+
+    def _respond(self, code, headers):
+        self.sms.http_cli.post_json_get_nothing.return_value = defer.succeed(
+            Response((b"HTTP", 1, 1), code, b"", Headers(headers), None)
+        )
+
+    def test_accepted(self):
+        self._respond(202, {b"Location": [b"https://smsc.openmarket.com/mt/1234"]})
+        self.successResultOf(self.sms.sendTextSMS("Hi", "447700900123"))
+
+    def test_refused(self):
+        self._respond(400, {})
+        f = self.failureResultOf(
+            self.sms.sendTextSMS("Hi", "447700900123"), SmsSendException
+        )
+        self.assertTrue(f.value.permanent)
+
+        self._respond(503, {})
+        f = self.failureResultOf(
+            self.sms.sendTextSMS("Hi", "447700900123"), SmsSendException
+        )
+        self.assertFalse(f.value.permanent)
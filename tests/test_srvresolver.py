@@ -0,0 +1,124 @@
+import collections
+
+from mock import Mock
+from sydent.http.srvresolver import SrvResolver
+from twisted.internet import defer
+from twisted.names import dns
+from twisted.names.error import DNSNameError
+from twisted.trial import unittest
+
+
+def _srv_answer(target, ttl):
+    return dns.RRHeader(
+        type=dns.SRV,
+        ttl=ttl,
+        payload=dns.Record_SRV(target=target, port=8448, priority=0, weight=0),
+    )
+
+
+class SrvResolverTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.lookups = []
+
+        def lookupService(name):
+            d = defer.Deferred()
+            self.lookups.append((name, d))
+            return d
+
+        dns_client = Mock(spec=["lookupService"])
+        dns_client.lookupService.side_effect = lookupService
+
+        self.cache = collections.OrderedDict()
+        self.resolver = SrvResolver(
+            dns_client=dns_client,
+            cache=self.cache,
+            get_time=lambda: self.now,
+            max_cache_size=2,
+        )
+
+    def test_concurrent_lookups(self):
+        """Check that concurrent lookups for a name share a DNS query, and that its
+        result is cached until the records expire.
+        """
+        name = b"_matrix._tcp.example.com"
+        d1 = self.resolver.resolve_service(name)
+        d2 = self.resolver.resolve_service(name)
+        self.assertEqual(len(self.lookups), 1)
+
+        self.lookups[0][1].callback(([_srv_answer(b"host.example.com", 100)], [], []))
+        servers = self.successResultOf(d1)
+        self.assertEqual([s.host for s in servers], [b"host.example.com"])
+        self.assertEqual(self.successResultOf(d2), servers)
+
+        self.now += 50
+        self.assertEqual(
+            self.successResultOf(self.resolver.resolve_service(name)), servers
+        )
+        self.assertEqual(len(self.lookups), 1)
+
+        self.now += 50
+        self.resolver.resolve_service(name)
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_negative_caching(self):
+        """Check that the absence of records is cached for as long as the SOA
+        allows, within bounds.
+        """
+        name = b"_matrix._tcp.example.com"
+        soa = dns.RRHeader(type=dns.SOA, ttl=30, payload=dns.Record_SOA(minimum=3600))
+        message = dns.Message(rCode=dns.ENAME)
+        message.authority = [soa]
+
+        d = self.resolver.resolve_service(name)
+        self.lookups[0][1].errback(DNSNameError(message))
+        self.assertEqual(self.successResultOf(d), [])
+
+        self.now += 20
+        self.assertEqual(self.successResultOf(self.resolver.resolve_service(name)), [])
+        self.assertEqual(len(self.lookups), 1)
+
+        self.now += 10
+        d = self.resolver.resolve_service(name)
+        self.assertEqual(len(self.lookups), 2)
+
+        # A response without any SRV record is cached too.
+        self.lookups[1][1].callback(([], [], []))
+        self.assertEqual(self.successResultOf(d), [])
+        self.resolver.resolve_service(name)
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_refresh_ahead(self):
+        """Check that looking up a name shortly before its records expire refreshes
+        them in the background.
+        """
+        name = b"_matrix._tcp.example.com"
+        d = self.resolver.resolve_service(name)
+        self.lookups[0][1].callback(([_srv_answer(b"old.example.com", 100)], [], []))
+        self.successResultOf(d)
+
+        self.now += 85
+        servers = self.successResultOf(self.resolver.resolve_service(name))
+        self.assertEqual([s.host for s in servers], [b"old.example.com"])
+        self.assertEqual(len(self.lookups), 2)
+
+        self.lookups[1][1].callback(([_srv_answer(b"new.example.com", 100)], [], []))
+        self.now += 50
+        servers = self.successResultOf(self.resolver.resolve_service(name))
+        self.assertEqual([s.host for s in servers], [b"new.example.com"])
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_lru_eviction(self):
+        for name in (b"a", b"b"):
+            d = self.resolver.resolve_service(name)
+            self.lookups[-1][1].callback(([_srv_answer(name, 100)], [], []))
+            self.successResultOf(d)
+
+        # Using a makes b the least recently used name.
+        self.resolver.resolve_service(b"a")
+
+        d = self.resolver.resolve_service(b"c")
+        self.lookups[-1][1].callback(([_srv_answer(b"c", 100)], [], []))
+        self.successResultOf(d)
+
+        self.assertEqual(list(self.cache), [b"a", b"c"])
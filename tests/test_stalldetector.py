@@ -0,0 +1,97 @@
+#  Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import threading
+import time
+import traceback
+
+from twisted.trial import unittest
+
+from sydent.util.stalldetector import _SYDENT_DIR, _call_site
+from tests.utils import make_request, make_sydent
+
+
+class ReactorStallDetectorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sydent = make_sydent()
+        self.detector = self.sydent.stallDetector
+        # Pretend that this thread is the reactor's.
+        self.detector._reactor_thread = threading.get_ident()
+        self.detector._last_tick = time.monotonic()
+
+    def get_stalls(self, query=""):
+        request, channel = make_request(
+            self.sydent.reactor,
+            "GET",
+            "/_matrix/identity/internal/stalls" + query,
+        )
+        request.render(self.sydent.servlets.reactorStalls)
+        return channel
+
+    def check_from_watchdog(self):
+        """Checks for a stall from another thread, like the watchdog does, while
+        this one is blocked waiting for it.
+        """
+        watchdog = threading.Thread(target=self.detector.check)
+        watchdog.start()
+        watchdog.join()
+
+    def test_stall(self):
+        """Check that a stall is recorded once, under the call site of the reactor's
+        thread, along with how long it ended up lasting.
+        """
+        self.check_from_watchdog()
+        self.assertEqual(self.detector.getTopCallSites(10), [])
+
+        self.detector._last_tick -= 10
+        self.check_from_watchdog()
+        # The stall is only recorded when it's first noticed.
+        self.check_from_watchdog()
+
+        sites = self.detector.getTopCallSites(10)
+        self.assertEqual(len(sites), 1)
+        self.assertEqual(sites[0]["count"], 1)
+        self.assertIn("threading.py", sites[0]["blocked_in"])
+        self.assertEqual(sites[0]["total_seconds"], 0.0)
+
+        # The reactor gets going again.
+        self.detector._tick()
+        sites = self.detector.getTopCallSites(10)
+        self.assertGreaterEqual(sites[0]["total_seconds"], 9.9)
+        self.assertEqual(sites[0]["max_seconds"], sites[0]["total_seconds"])
+
+        channel = self.get_stalls()
+        self.assertEqual(channel.code, 200)
+        self.assertEqual(channel.json_body["call_sites"], sites)
+
+        self.assertEqual(self.get_stalls("?limit=0").json_body["call_sites"], [])
+        self.assertEqual(self.get_stalls("?limit=nope").code, 400)
+
+    def test_call_site(self):
+        """Check that a stall is attributed to the innermost frame of Sydent's code."""
+        stack = traceback.StackSummary.from_list(
+            [
+                ("/usr/lib/twisted/web/server.py", 1, "render", None),
+                (os.path.join(_SYDENT_DIR, "db", "peers.py"), 42, "getPeers", None),
+                ("/usr/lib/python3/sqlite3.py", 2, "execute", None),
+            ]
+        )
+        self.assertEqual(
+            _call_site(stack),
+            (
+                "sydent/db/peers.py:42 in getPeers",
+                "/usr/lib/python3/sqlite3.py:2 in execute",
+            ),
+        )
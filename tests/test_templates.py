@@ -0,0 +1,93 @@
+#  Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+from sydent.util.emailutils import sendEmail
+from tests.utils import make_sydent
+
+
+class TemplateRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        # Work on a copy of the templates, so they can be changed.
+        self.templates_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.templates_path)
+        res = os.path.join(os.path.dirname(os.path.dirname(__file__)), "res")
+        for brand in os.listdir(res):
+            shutil.copytree(
+                os.path.join(res, brand), os.path.join(self.templates_path, brand)
+            )
+
+        config = {
+            "general": {"templates.path": self.templates_path},
+            "email": {"email.queue.rate": "0", "email.queue.domain_rate": "0"},
+        }
+        self.sydent = make_sydent(test_config=config)
+
+    def test_branded_templates(self):
+        """Check that the templates of every brand are loaded, with a fallback to the
+        default brand.
+        """
+        self.assertEqual(self.sydent.valid_brands, {"matrix-org", "vector-im"})
+
+        template = self.sydent.templates.get("vector-im", "verification_template.eml")
+        self.assertIn("Element", template.source)
+        self.assertIn("link", template.placeholders)
+        self.assertIn("multipart_boundary", template.placeholders)
+
+        template = self.sydent.templates.get("unknown", "verification_template.eml")
+        self.assertEqual(
+            template.path,
+            os.path.join(
+                self.templates_path, "matrix-org", "verification_template.eml"
+            ),
+        )
+
+    def test_reload(self):
+        """Check that the templates are only read from disk again when reloaded, and
+        that only the placeholders they use are filled.
+        """
+        path = os.path.join(
+            self.templates_path, "matrix-org", "verify_response_template.html"
+        )
+        with open(path, "w") as f:
+            f.write("<p>%(message_forhtml)s</p> 100%%")
+
+        template = self.sydent.templates.get(None, "verify_response_template.html")
+        self.assertIn("%(message)s", template.source)
+
+        self.sydent.reload_templates()
+        template = self.sydent.templates.get(None, "verify_response_template.html")
+        self.assertEqual(template.placeholders, {"message_forhtml"})
+
+        with open(path, "w") as f:
+            f.write("%(room_name_forhtml)s")
+        self.sydent.reload_templates()
+
+        sent = []
+        self.sydent.emailQueue.enqueue = lambda mailFrom, mailTo, message: sent.append(
+            message
+        )
+        sendEmail(
+            self.sydent,
+            self.sydent.templates.get(None, "verify_response_template.html"),
+            "alice@example.com",
+            # Substitutions the template doesn't use aren't escaped at all.
+            {"room_name": "<b>", "unused": None},
+        )
+        self.assertEqual(sent, [b"&lt;b&gt;"])
@@ -0,0 +1,84 @@
+#  Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from mock import Mock
+from prometheus_client import REGISTRY
+
+from twisted.trial import unittest
+
+from sydent.util.ttlcache import TTLCache
+
+
+class TTLCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.timer = Mock(return_value=0.0)
+
+    def test_expiry(self):
+        """Check that entries aren't returned once they've expired, and are removed
+        once their bucket has passed.
+        """
+        cache = TTLCache("test", timer=self.timer, expiry_granularity=10)
+        cache.set("a", 1, 5)
+        cache.set("b", 2, 25)
+
+        self.timer.return_value = 4.9
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get_with_expiry("b"), (2, 25))
+
+        self.timer.return_value = 5
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.get("a", None), None)
+        self.assertEqual(len(cache), 1)
+
+        # Replacing an entry moves it to another bucket.
+        cache.set("b", 3, 30)
+        self.timer.return_value = 25
+        self.assertEqual(cache["b"], 3)
+
+        self.timer.return_value = 40
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.expirations, 2)
+        self.assertRaises(KeyError, cache.pop, "b")
+
+    def test_max_size(self):
+        """Check that the least recently used entries are evicted to keep the cache
+        under its maximum size.
+        """
+        cache = TTLCache("test", timer=self.timer, max_size=2)
+        cache.set("a", 1, 30)
+        cache.set("b", 2, 10)
+        cache.get("a")
+        cache.set("c", 3, 20)
+
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_metrics(self):
+        """Check that the statistics of caches are exported to Prometheus by name."""
+        cache = TTLCache("test-metrics", timer=self.timer, export_metrics=True)
+        cache.set("a", 1, 30)
+        cache.get("a")
+        cache.get("b", None)
+
+        labels = {"name": "test-metrics"}
+        self.assertEqual(REGISTRY.get_sample_value("sydent_cache_size", labels), 1)
+        self.assertEqual(
+            REGISTRY.get_sample_value("sydent_cache_hits_total", labels), 1
+        )
+        self.assertEqual(
+            REGISTRY.get_sample_value("sydent_cache_misses_total", labels), 1
+        )
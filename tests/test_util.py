@@ -1,5 +1,11 @@
+from mock import Mock, patch
+from twisted.internet.task import Clock
 from twisted.trial import unittest
+
+from sydent.util.gcutils import GarbageCollector
+from sydent.util.msisdn import parse_phone_number
 from sydent.util.stringutils import is_valid_matrix_server_name
+from tests.utils import make_sydent
 
 
 class UtilTests(unittest.TestCase):
@@ -35,3 +41,63 @@ class UtilTests(unittest.TestCase):
         self.assertFalse(is_valid_matrix_server_name("example.com: 4242"))
         self.assertFalse(is_valid_matrix_server_name("example.com/example.com"))
         self.assertFalse(is_valid_matrix_server_name("example.com#example.com"))
+
+    def test_parse_phone_number(self):
+        """Tests that phone numbers are parsed and formatted, and the result
+        remembered.
+        """
+        parse_phone_number.cache_clear()
+
+        phone_number = parse_phone_number("07700 900123", "GB")
+        self.assertEqual(phone_number.msisdn, "447700900123")
+        self.assertEqual(phone_number.international, "+44 7700 900123")
+        self.assertEqual(phone_number.country_code, 44)
+
+        self.assertIs(parse_phone_number("07700 900123", "GB"), phone_number)
+        self.assertEqual(parse_phone_number.cache_info().hits, 1)
+
+        with self.assertRaises(Exception):
+            parse_phone_number("not a number", "GB")
+
+    def test_garbage_collector(self):
+        """Tests that the oldest generation over its threshold is collected, at most
+        once per its minimum interval.
+        """
+        # Use a clock of our own, which the collections Sydent runs itself don't
+        # follow.
+        clock = Clock()
+        collector = GarbageCollector(Mock(cfg=make_sydent().cfg, reactor=clock))
+
+        with patch("sydent.util.gcutils.gc") as gc:
+            gc.collect.return_value = 0
+
+            # Generation 2 is over its threshold, and has never been collected.
+            gc.get_count.return_value = (800, 20, 20)
+            collector.collect()
+            gc.collect.assert_called_once_with(2)
+
+            # It can't be collected again for 30s, but generation 1 can after 10s.
+            gc.collect.reset_mock()
+            clock.advance(10)
+            collector.collect()
+            gc.collect.assert_called_once_with(1)
+
+            gc.collect.reset_mock()
+            clock.advance(20)
+            collector.collect()
+            gc.collect.assert_called_once_with(2)
+
+            # Nothing is collected while the counts are under the thresholds.
+            gc.collect.reset_mock()
+            gc.get_count.return_value = (10, 0, 0)
+            clock.advance(60)
+            collector.collect()
+            gc.collect.assert_not_called()
+
+    def test_garbage_collector_freeze_unsupported(self):
+        """Tests that freezing is skipped on Pythons without gc.freeze()."""
+        collector = GarbageCollector(Mock(cfg=make_sydent().cfg, reactor=Clock()))
+
+        with patch("sydent.util.gcutils.gc", Mock(spec=["collect"])) as gc:
+            collector.freeze()
+            gc.collect.assert_not_called()
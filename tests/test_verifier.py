@@ -0,0 +1,114 @@
+import signedjson.key
+import signedjson.sign
+from sydent.hs_federation.keycache import ServerKeyCache
+from tests.utils import make_sydent
+from twisted.internet import defer
+from twisted.trial import unittest
+
+
+class ServerKeyCacheTestCase(unittest.TestCase):
+    """Tests the caching of the keys of homeservers by the verifier."""
+
+    def setUp(self):
+        self.sydent = make_sydent()
+
+        self.signing_key = signedjson.key.generate_signing_key("1")
+        self.verify_key_base64 = signedjson.key.encode_verify_key_base64(
+            signedjson.key.get_verify_key(self.signing_key)
+        )
+
+        self.fetches = []
+
+        def fetch(server_name):
+            d = defer.Deferred()
+            self.fetches.append((server_name, d))
+            return d
+
+        self.fetch = fetch
+        self.sydent.sig_verifier.key_cache = ServerKeyCache(self.sydent, fetch)
+
+    def _keys_response(self, valid_for):
+        return {
+            "server_name": "example.com",
+            "verify_keys": {"ed25519:1": {"key": self.verify_key_base64}},
+            "valid_until_ts": int((self.sydent.reactor.seconds() + valid_for) * 1000),
+        }
+
+    def test_verify_with_cached_keys(self):
+        """Check that concurrent verifications only fetch the keys once, and that
+        later ones use the cached keys.
+        """
+        signed = signedjson.sign.sign_json(
+            {"foo": "bar"}, "example.com", self.signing_key
+        )
+
+        d1 = self.sydent.sig_verifier.verifyServerSignedJson(signed)
+        d2 = self.sydent.sig_verifier.verifyServerSignedJson(signed)
+        self.assertEqual(len(self.fetches), 1)
+
+        self.fetches[0][1].callback(self._keys_response(3600))
+        self.assertEqual(self.successResultOf(d1), ("example.com", "ed25519:1"))
+        self.assertEqual(self.successResultOf(d2), ("example.com", "ed25519:1"))
+
+        d3 = self.sydent.sig_verifier.verifyServerSignedJson(signed)
+        self.assertEqual(self.successResultOf(d3), ("example.com", "ed25519:1"))
+        self.assertEqual(len(self.fetches), 1)
+
+        # Once the keys have expired, they're fetched again.
+        self.sydent.reactor.advance(3600)
+        self.sydent.sig_verifier.verifyServerSignedJson(signed)
+        self.assertEqual(len(self.fetches), 2)
+
+    def test_failures_are_cached(self):
+        """Check that failing to fetch keys is cached for increasingly long."""
+        cache = self.sydent.sig_verifier.key_cache
+
+        d = cache.getVerifyKeys("example.com")
+        self.fetches[0][1].errback(Exception("Connection refused"))
+        self.failureResultOf(d, Exception)
+
+        # The failure is cached for 10s.
+        self.sydent.reactor.advance(9)
+        self.failureResultOf(cache.getVerifyKeys("example.com"), Exception)
+        self.assertEqual(len(self.fetches), 1)
+
+        self.sydent.reactor.advance(1)
+        d = cache.getVerifyKeys("example.com")
+        self.assertEqual(len(self.fetches), 2)
+
+        # Then for 20s after a second failure.
+        self.fetches[1][1].errback(Exception("Connection refused"))
+        self.failureResultOf(d, Exception)
+        self.sydent.reactor.advance(19)
+        self.failureResultOf(cache.getVerifyKeys("example.com"), Exception)
+        self.assertEqual(len(self.fetches), 2)
+
+        # A successful fetch resets the backoff.
+        self.sydent.reactor.advance(1)
+        d = cache.getVerifyKeys("example.com")
+        self.fetches[2][1].callback(self._keys_response(1))
+        self.assertIn("ed25519:1", self.successResultOf(d))
+
+        self.sydent.reactor.advance(1)
+        d = cache.getVerifyKeys("example.com")
+        self.fetches[3][1].errback(Exception("Connection refused"))
+        self.failureResultOf(d, Exception)
+        self.sydent.reactor.advance(10)
+        cache.getVerifyKeys("example.com")
+        self.assertEqual(len(self.fetches), 5)
+
+    def test_keys_are_persisted(self):
+        """Check that the keys are saved to the database, and read from it by a new
+        cache.
+        """
+        d = self.sydent.sig_verifier.key_cache.getVerifyKeys("example.com")
+        self.fetches[0][1].callback(self._keys_response(3600))
+        self.successResultOf(d)
+
+        cache = ServerKeyCache(self.sydent, self.fetch)
+        keys = self.successResultOf(cache.getVerifyKeys("example.com"))
+        self.assertEqual(
+            signedjson.key.encode_verify_key_base64(keys["ed25519:1"]),
+            self.verify_key_base64,
+        )
+        self.assertEqual(len(self.fetches), 1)
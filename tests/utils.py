@@ -16,6 +16,7 @@ from twisted.internet.interfaces import (
 )
 
 from twisted.internet import address
+from twisted.python.failure import Failure
 import twisted.logger
 from twisted.web.http_headers import Headers
 from twisted.web.server import Request, Site
@@ -68,13 +69,25 @@ def make_sydent(test_config={}):
     else:
         test_config["db"].setdefault("db.file", ":memory:")
 
+    # The reactor is a fake one, which doesn't run on the wall clock the stall detector
+    # watches it with.
+    general = test_config.setdefault("general", {})
+    general.setdefault("stall_detector.enabled", "false")
+    # Don't freeze the test process's whole heap again for each test.
+    general.setdefault("gc.freeze_after_startup", "false")
+
     reactor = ResolvingMemoryReactorClock()
-    return Sydent(
+    sydent = Sydent(
         reactor=reactor,
         cfg=parse_config_dict(test_config),
         use_tls_for_federation=False,
     )
 
+    # Send emails from the main thread, so that tests don't have to wait for them.
+    sydent.smtpTransport.threadpool = ThreadlessThreadPool()
+
+    return sydent
+
 
 @attr.s
 class FakeChannel(object):
@@ -300,3 +313,28 @@ class ResolvingMemoryReactorClock(MemoryReactorClock):
 
     def installNameResolver(self, resolver: IHostnameResolver) -> IHostnameResolver:
         raise NotImplementedError()
+
+    def callFromThread(self, f, *args, **kwargs):
+        # Work given to a ThreadlessThreadPool runs in the main thread, so its
+        # result can be handled straight away.
+        f(*args, **kwargs)
+
+
+class ThreadlessThreadPool:
+    """
+    A thread pool which runs the work it's given straight away, in the calling thread.
+    """
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        try:
+            result = f(*args, **kwargs)
+        except Exception:
+            onResult(False, Failure())
+        else:
+            onResult(True, result)